@@ -0,0 +1,67 @@
+"""
+Searching the choices of large ModelChoiceFields as they're typed, rather than rendering every option in the page.
+
+Forms list the fields to search with autocomplete_fields, mapping each field to the lookups its words are matched
+against. Those fields are rendered with AutocompleteSelect, which only includes the selected option, and select2 fetches
+the rest from autocomplete() a page at a time. The endpoint builds the same form for the request, so it searches the
+field's own queryset, scoped to the company, and shows the options with the field's labels. The names and batch codes
+searched have trigram indexes (see trigram_index) which the istartswith lookups use.
+"""
+
+from urllib.parse import urlencode
+
+from django.db.models import Q
+from django.http import Http404, JsonResponse
+from django.urls import reverse
+
+AUTOCOMPLETE_PAGE_SIZE = 20
+
+# Forms with autocomplete fields by name, filled in as they're defined (see SVFormMixin.__init_subclass__).
+AUTOCOMPLETE_FORMS = {}
+
+
+def register_autocomplete_form(form_cls):
+    name = form_cls.__name__
+    assert AUTOCOMPLETE_FORMS.get(name, form_cls) is form_cls, f'Autocomplete form {name} is already registered'
+    AUTOCOMPLETE_FORMS[name] = form_cls
+
+
+def autocomplete_url(form, field_name: str) -> str:
+    url = reverse('autocomplete', kwargs={'form': type(form).__name__, 'field': field_name})
+    if params := form.get_autocomplete_params():
+        url += f'?{urlencode(params)}'
+    return url
+
+
+def _search_filter(lookups: list[str], q: str) -> Q:
+    # Every word has to be the start of one of the lookups.
+    query = Q()
+    for word in q.split():
+        query &= Q(*[Q(**{f'{lookup}__istartswith': word}) for lookup in lookups], _connector=Q.OR)
+    return query
+
+
+def autocomplete(request, form: str, field: str):
+    form_cls = AUTOCOMPLETE_FORMS.get(form)
+    if not form_cls or field not in form_cls.autocomplete_fields:
+        raise Http404('Nothing to search')
+    form_field = form_cls.for_autocomplete(request).fields[field]
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+    start = (page - 1) * AUTOCOMPLETE_PAGE_SIZE
+    qs = form_field.queryset.filter(_search_filter(form_cls.autocomplete_fields[field], request.GET.get('q', '')[:100]))
+    # Options often share a name, so the pk breaks ties to keep them in the same order from one page to the next.
+    qs = qs.order_by(*(qs.query.order_by or qs.model._meta.ordering), 'pk')
+    # One more than a page, to know whether there's another.
+    objs = list(qs[start : start + AUTOCOMPLETE_PAGE_SIZE + 1])
+    return JsonResponse(
+        {
+            'results': [
+                {'id': obj.pk, 'text': str(form_field.label_from_instance(obj))}
+                for obj in objs[:AUTOCOMPLETE_PAGE_SIZE]
+            ],
+            'pagination': {'more': len(objs) > AUTOCOMPLETE_PAGE_SIZE},
+        }
+    )
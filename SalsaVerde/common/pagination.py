@@ -0,0 +1,248 @@
+import datetime
+import json
+from decimal import Decimal
+from typing import NamedTuple
+
+from django.core import signing
+from django.core.paginator import EmptyPage, Page, PageNotAnInteger, Paginator
+from django.db import connections
+from django.db.models import F, Q, QuerySet
+from django.utils.functional import cached_property
+
+# Lists longer than this get an approximate count rather than an exact one.
+COUNT_CAP = 1000
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def _is_nullable(model, lookup: str) -> bool:
+    for name in lookup.split('__'):
+        if name == 'pk':
+            return False
+        field = model._meta.get_field(name)
+        if field.null:
+            return True
+        if field.is_relation:
+            model = field.related_model
+    return False
+
+
+def _dump_value(v):
+    if isinstance(v, (datetime.datetime, datetime.date)):
+        return v.isoformat()
+    elif isinstance(v, Decimal):
+        return str(v)
+    return v
+
+
+class ObjectCount(NamedTuple):
+    value: int
+    exact: bool = True
+
+    def __str__(self):
+        if self.exact:
+            return f'{self.value:,}'
+        elif self.value > COUNT_CAP:
+            return f'~{self.value:,}'
+        return f'{self.value:,}+'
+
+
+def exact_count(qs: QuerySet) -> ObjectCount:
+    return ObjectCount(qs.count())
+
+
+def capped_count(qs: QuerySet) -> ObjectCount:
+    """
+    Counts at most COUNT_CAP + 1 rows, so the cost is bounded however many rows match.
+    """
+    count = qs[: COUNT_CAP + 1].count()
+    if count > COUNT_CAP:
+        return ObjectCount(COUNT_CAP, exact=False)
+    return ObjectCount(count)
+
+
+def estimated_count(qs: QuerySet) -> ObjectCount:
+    """
+    Uses the planner's row estimate for lists with more than COUNT_CAP rows. Lists are always scoped to the company, so
+    this uses EXPLAIN rather than pg_class.reltuples which would give the size of the whole table.
+    """
+    count = capped_count(qs)
+    if count.exact:
+        return count
+    sql, params = qs.query.sql_with_params()
+    with connections[qs.db].cursor() as cursor:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return ObjectCount(max(int(plan[0]['Plan']['Plan Rows']), COUNT_CAP + 1), exact=False)
+
+
+class ApproximatePage(Page):
+    """
+    A page from a list with an approximate count, so whether there's a next page comes from fetching one row more than
+    the page holds rather than from num_pages.
+    """
+
+    def __init__(self, object_list, number, paginator, has_next: bool):
+        super().__init__(object_list, number, paginator)
+        self._has_next = has_next
+
+    def has_next(self):
+        return self._has_next
+
+
+class SVPaginator(Paginator):
+    """
+    Paginator that gets its count from a count strategy (one of the *_count functions above) rather than always running
+    an exact COUNT. When the count is approximate we can't know where the last page is, so any page past the first is
+    allowed, whether there's a next page is found by fetching an extra row, and an empty page past the end is a 404.
+    """
+
+    def __init__(self, *args, count_strategy=exact_count, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.count_strategy = count_strategy
+
+    @cached_property
+    def object_count(self) -> ObjectCount:
+        return self.count_strategy(self.object_list)
+
+    @cached_property
+    def count(self):
+        return self.object_count.value
+
+    def validate_number(self, number):
+        if self.object_count.exact:
+            return super().validate_number(number)
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger('That page number is not an integer')
+        if number < 1:
+            raise EmptyPage('That page number is less than 1')
+        return number
+
+    def page(self, number):
+        if self.object_count.exact:
+            return super().page(number)
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        rows = list(self.object_list[bottom : bottom + self.per_page + 1])
+        if number > 1 and not rows:
+            raise EmptyPage('That page contains no results')
+        return ApproximatePage(rows[: self.per_page], number, self, has_next=len(rows) > self.per_page)
+
+
+class KeysetPage:
+    is_keyset = True
+
+    def __init__(self, object_list: list, next_cursor: str = None, previous_cursor: str = None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def has_next(self):
+        return bool(self.next_cursor)
+
+    def has_previous(self):
+        return bool(self.previous_cursor)
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+class KeysetPaginator:
+    """
+    Paginates by seeking past the last row shown rather than using an OFFSET, so a deep page is as cheap as the first
+    one and no COUNT is needed. Rows are sorted by the given ordering with the pk as a tiebreaker, and NULLs always
+    come last.
+
+    The cursors are signed so they're opaque to the user and can't be tampered with.
+    """
+
+    salt = 'SalsaVerde.keyset-cursor'
+
+    def __init__(self, queryset: QuerySet, ordering: list[str], per_page: int):
+        self.per_page = per_page
+        self.keys = []
+        for lookup in ordering:
+            descending = lookup.startswith('-')
+            lookup = lookup.lstrip('-')
+            if lookup in {'pk', 'id'}:
+                break
+            self.keys.append((lookup, descending, _is_nullable(queryset.model, lookup)))
+        self.keys.append(('pk', self.keys[-1][1] if self.keys else False, False))
+        self.queryset = queryset.annotate(**{f'_seek_{i}': F(lookup) for i, (lookup, _, _) in enumerate(self.keys)})
+
+    def _order_by(self, forwards: bool):
+        order_by = []
+        for lookup, descending, nullable in self.keys:
+            # Only nullable keys get a NULLS clause, so the ordering can be matched by a plain index.
+            nulls = ({'nulls_last': True} if forwards else {'nulls_first': True}) if nullable else {}
+            if forwards:
+                order_by.append(F(lookup).desc(**nulls) if descending else F(lookup).asc(**nulls))
+            else:
+                order_by.append(F(lookup).asc(**nulls) if descending else F(lookup).desc(**nulls))
+        return order_by
+
+    def _seek(self, keys: list, values: list, forwards: bool) -> Q:
+        """
+        Builds the filter for rows that come after (or before if not forwards) the given values.
+        """
+        (lookup, descending, nullable), value = keys[0], values[0]
+        rest = self._seek(keys[1:], values[1:], forwards) if keys[1:] else None
+        if value is None:
+            if forwards:
+                return Q(**{f'{lookup}__isnull': True}) & rest
+            return Q(**{f'{lookup}__isnull': False}) | (Q(**{f'{lookup}__isnull': True}) & rest)
+        cmp = 'gt' if descending != forwards else 'lt'
+        q = Q(**{f'{lookup}__{cmp}': value})
+        if nullable and forwards:
+            q |= Q(**{f'{lookup}__isnull': True})
+        if rest is not None:
+            q |= Q(**{lookup: value}) & rest
+        return q
+
+    def _cursor(self, obj, forwards: bool) -> str:
+        values = [_dump_value(getattr(obj, f'_seek_{i}')) for i in range(len(self.keys))]
+        return signing.dumps({'v': values, 'f': forwards, 'k': self._key_names()}, salt=self.salt, compress=True)
+
+    def _key_names(self) -> list[str]:
+        return [f'-{lookup}' if descending else lookup for lookup, descending, _ in self.keys]
+
+    def _load_cursor(self, cursor: str) -> tuple[list, bool]:
+        try:
+            data = signing.loads(cursor, salt=self.salt)
+        except signing.BadSignature as e:
+            raise InvalidCursor('Invalid cursor') from e
+        # A cursor from the list sorted another way can't be used to seek through this one.
+        if len(data.get('v', [])) != len(self.keys) or data.get('k', self._key_names()) != self._key_names():
+            raise InvalidCursor('Cursor does not match ordering')
+        return data['v'], data['f']
+
+    def page(self, cursor: str = None) -> KeysetPage:
+        qs, forwards = self.queryset, True
+        if cursor:
+            values, forwards = self._load_cursor(cursor)
+            qs = qs.filter(self._seek(self.keys, values, forwards))
+        rows = list(qs.order_by(*self._order_by(forwards))[: self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[: self.per_page]
+        if forwards:
+            has_next, has_previous = has_more, bool(cursor)
+        else:
+            rows.reverse()
+            has_next, has_previous = True, has_more
+        return KeysetPage(
+            rows,
+            next_cursor=has_next and rows and self._cursor(rows[-1], forwards=True) or None,
+            previous_cursor=has_previous and rows and self._cursor(rows[0], forwards=False) or None,
+        )
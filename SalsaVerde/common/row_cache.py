@@ -0,0 +1,124 @@
+"""
+Caches the rendered values of list view rows in Redis so that rows which haven't changed skip the display pipeline.
+
+Every object has a version token (stored under its own key) which is changed whenever the object is saved or deleted,
+and again when the transaction that changed it commits. A cached row stores the versions of the object and every
+related object it was rendered from, and is only used if they all still match. A row and the versions it depends on
+are fetched with a single get_many.
+"""
+
+import hashlib
+import uuid
+from functools import partial
+from typing import Iterator
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Manager
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from django.utils.safestring import SafeData
+
+ROW_CACHE_TIMEOUT = 60 * 60 * 24
+# A version that's expired is the same as one that's been evicted, so it only needs to outlive the rows that use it.
+VERSION_TIMEOUT = ROW_CACHE_TIMEOUT
+APPS = {'company', 'stock', 'orders'}
+
+
+def _version_key(obj) -> str:
+    return f'sv-rowver:{obj._meta.label_lower}:{obj.pk}'
+
+
+def bump_row_versions(model, pks):
+    """
+    Invalidates the cached rows of the given objects, and any rows that display them. Anything that changes objects
+    without sending signals (eg. QuerySet.update()) needs to call this.
+
+    The versions are changed again once the transaction commits, since until then other requests still read the old
+    objects and could cache them under the new versions.
+    """
+    pks = list(pks)
+    _set_versions(model, pks)
+    transaction.on_commit(partial(_set_versions, model, pks))
+
+
+def _set_versions(model, pks):
+    cache.set_many(
+        {f'sv-rowver:{model._meta.label_lower}:{pk}': uuid.uuid4().hex for pk in pks}, timeout=VERSION_TIMEOUT
+    )
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def _bump_on_change(sender, instance, **kwargs):
+    if sender._meta.app_label in APPS:
+        bump_row_versions(sender, [instance.pk])
+
+
+@receiver(m2m_changed)
+def _bump_on_m2m_change(sender, instance, **kwargs):
+    if kwargs['action'].startswith('post_') and instance._meta.app_label in APPS:
+        bump_row_versions(type(instance), [instance.pk])
+
+
+def _related_objects(obj, path: str) -> Iterator:
+    """
+    Walks a select_related/prefetch_related path through objects that have already been fetched.
+    """
+    objs = [obj]
+    for name in path.split('__'):
+        next_objs = []
+        for o in objs:
+            related = getattr(o, name, None)
+            if isinstance(related, Manager):
+                next_objs.extend(related.all())
+            elif related is not None:
+                next_objs.append(related)
+        objs = next_objs
+    yield from objs
+
+
+def _freeze(v):
+    # Everything is rendered with str() in the template, so only safe strings need to keep their type.
+    return v if isinstance(v, SafeData) else str(v)
+
+
+def cached_rows(view, plan, objects: list, related_paths) -> Iterator[tuple[str, list]]:
+    """
+    Yields the (url, values) for each object in the same way as ModelListView.get_field_data, getting the rows from
+    the cache where the object and all the related objects in related_paths are unchanged.
+    """
+    view_cls = type(view)
+    plan_key = f'{view_cls.__module__}.{view_cls.__qualname__}:{plan.model._meta.label_lower}:{plan.display_items!r}'
+    prefix = f'sv-row:{hashlib.md5(plan_key.encode()).hexdigest()}'
+
+    row_keys, version_keys = [], []
+    for obj in objects:
+        row_keys.append(f'{prefix}:{obj.pk}')
+        keys = {_version_key(obj)}
+        for path in related_paths:
+            keys.update(_version_key(r) for r in _related_objects(obj, path))
+        version_keys.append(sorted(keys))
+
+    cached = cache.get_many(row_keys + list({k for keys in version_keys for k in keys}))
+    to_cache = {}
+    for obj, row_key, keys in zip(objects, row_keys, version_keys):
+        versions = [cached.get(k) for k in keys]
+        if (row := cached.get(row_key)) and row[0] == versions:
+            yield row[1], row[2]
+            continue
+        url, values = obj.get_absolute_url(), plan.values(view, obj)
+        yield url, values
+        if None in versions:
+            # The object has no version yet (or it's been evicted). Only cache the row if we're the one to set it,
+            # otherwise it could have been changed since we fetched it.
+            for i, k in enumerate(keys):
+                if versions[i] is None:
+                    token = uuid.uuid4().hex
+                    if cache.add(k, token, timeout=VERSION_TIMEOUT):
+                        cached[k] = versions[i] = token
+            if None in versions:
+                continue
+        to_cache[row_key] = (versions, url, [_freeze(v) for v in values])
+    if to_cache:
+        cache.set_many(to_cache, timeout=ROW_CACHE_TIMEOUT)
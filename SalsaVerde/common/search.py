@@ -0,0 +1,107 @@
+"""
+Global search across the things people look things up by: batch codes, suppliers, product sizes, orders and users.
+
+Each model has a GIN index on a tsvector (see search_vector) and every word searched for is matched as a prefix, so a
+partial batch code typed from a label finds the batch. Batch codes and names also have a trigram index (see
+trigram_index) so the search can be found anywhere in them, eg. the date in the middle of a batch code. All the models
+are searched in one UNION ALL query.
+"""
+
+import re
+
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db.models import CharField, F, Q, Value
+from django.db.models.fields.json import KT
+from django.db.models.functions import Cast, Coalesce, Concat
+from django.http import JsonResponse
+from django.urls import reverse
+
+from SalsaVerde.company.models import User
+from SalsaVerde.orders.models import Order
+from SalsaVerde.stock.models import Container, Ingredient, Product, ProductTypeSize, Supplier
+
+SEARCH_LIMIT = 20
+# Trigram indexes can't help with anything shorter, so shorter searches are only matched as prefixes.
+SUBSTRING_MIN_LENGTH = 3
+
+# The model, the title shown for a hit, the url name and the field of its pk to link to, and the field with a trigram
+# index to match anywhere in.
+SEARCH_SOURCES = [
+    (
+        Ingredient,
+        Concat('ingredient_type__name', Value(' - '), 'batch_code'),
+        'ingredients-details',
+        'pk',
+        'batch_code',
+    ),
+    (Container, Concat('container_type__name', Value(' - '), 'batch_code'), 'containers-details', 'pk', 'batch_code'),
+    (Product, Concat('product_type__name', Value(' - '), 'batch_code'), 'products-details', 'pk', 'batch_code'),
+    (
+        ProductTypeSize,
+        Concat('product_type__name', Value(' - '), 'name'),
+        'product-types-details',
+        'product_type_id',
+        'name',
+    ),
+    (Supplier, F('name'), 'suppliers-details', 'pk', 'name'),
+    (
+        Order,
+        Concat(Value('Order '), Coalesce(KT('extra_data__name'), 'shopify_id', Cast('id', CharField()))),
+        'order-details',
+        'pk',
+        None,
+    ),
+    (User, Concat('first_name', Value(' '), 'last_name'), 'users-details', 'pk', None),
+]
+
+
+def _search_vector(model):
+    # The same expression as the model's search index, so the index is used.
+    (index,) = [i for i in model._meta.indexes if i.name.endswith('_search_idx')]
+    return index.expressions[0]
+
+
+def _search_query(q: str) -> SearchQuery | None:
+    # Split the same way as search_vector splits the documents.
+    if terms := re.findall(r'[^\W_]+', q):
+        return SearchQuery(' & '.join(f'{t}:*' for t in terms), search_type='raw', config='simple')
+
+
+def global_search(request, q: str, limit: int = SEARCH_LIMIT) -> list[dict]:
+    """
+    Returns the best matches for q across all of SEARCH_SOURCES, scoped to the user's company.
+    """
+    if not (query := _search_query(q)):
+        return []
+    q = q.strip()
+    parts = []
+    for i, (model, title, _, link_field, substring_field) in enumerate(SEARCH_SOURCES):
+        match = Q(_search=query)
+        if substring_field and len(q) >= SUBSTRING_MIN_LENGTH:
+            match |= Q(**{f'{substring_field}__icontains': q})
+        parts.append(
+            model.objects.request_qs(request)
+            .annotate(_search=_search_vector(model))
+            .filter(match)
+            .annotate(
+                _source=Value(i),
+                _link_id=F(link_field),
+                _title=Cast(title, CharField()),
+                _rank=SearchRank(F('_search'), query),
+            )
+            .order_by('-_rank')
+            .values_list('_source', '_link_id', '_title', '_rank')[:limit]
+        )
+    results = parts[0].union(*parts[1:], all=True).order_by('-_rank', '_title')[:limit]
+    return [
+        {
+            'type': SEARCH_SOURCES[source][0]._meta.verbose_name,
+            'title': title,
+            'url': reverse(SEARCH_SOURCES[source][2], kwargs={'pk': link_id}),
+        }
+        for source, link_id, title, _ in results
+    ]
+
+
+def search(request):
+    return JsonResponse({'results': global_search(request, request.GET.get('q', '')[:100])})
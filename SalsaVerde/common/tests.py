@@ -1,3 +1,4 @@
+from django.http import HttpResponse
 from django.test import TestCase
 
 
@@ -11,3 +12,25 @@ class SVTestCase(TestCase):
                 if errors:
                     raise AssertionError(f"Response didn't redirect because of form errors:\n{errors.get_json_data()}")
             raise
+
+    @staticmethod
+    def consume(response):
+        """
+        A streaming response can only be read once, so this reads it into a normal response that can be checked as many
+        times as needed.
+        """
+        if not response.streaming:
+            return response
+        if not hasattr(response, '_consumed'):
+            response._consumed = HttpResponse(
+                b''.join(response.streaming_content),
+                status=response.status_code,
+                content_type=response['Content-Type'],
+            )
+        return response._consumed
+
+    def assertContains(self, response, *args, **kwargs):
+        super().assertContains(self.consume(response), *args, **kwargs)
+
+    def assertNotContains(self, response, *args, **kwargs):
+        super().assertNotContains(self.consume(response), *args, **kwargs)
@@ -1,43 +1,209 @@
+import csv
 import datetime
 from functools import partial
+from operator import attrgetter
 from typing import Iterator
 
 from django.conf import settings
 from django.contrib.auth import user_logged_in
 from django.contrib.auth.views import LoginView
+from django.contrib.messages import get_messages
+from django.core.exceptions import FieldDoesNotExist
 from django.db.models import QuerySet
 from django.dispatch import receiver
+from django.http import Http404, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, redirect
+from django.template.loader import select_template
 from django.urls import NoReverseMatch, reverse
 from django.utils import timezone
 from django.utils.functional import cached_property
-from django.utils.safestring import mark_safe
+from django.utils.html import strip_tags
+from django.utils.safestring import SafeData, mark_safe
+from django.utils.text import slugify
 from django.views import View
 from django.views.generic import CreateView, FormView, ListView as DjListView, TemplateView, UpdateView
 
 from SalsaVerde.common.forms import AuthForm
+from SalsaVerde.common.pagination import (
+    InvalidCursor,
+    KeysetPaginator,
+    SVPaginator,
+    capped_count,
+    estimated_count,
+    exact_count,
+)
+from SalsaVerde.common.row_cache import cached_rows
 
 
 class QuerySetMixin:
     order_by = None
 
+    def get_order_by(self):
+        return self.order_by
+
     def get_queryset(self):
         if self.request.user.is_authenticated:
             qs = self.model.objects.request_qs(self.request)
-            if self.order_by:
-                qs = qs.order_by(self.order_by)
-            return qs
+            if order_by := self.get_order_by():
+                qs = qs.order_by(order_by)
+            return self.select_display_related(qs, self.get_display_items(), self.select_related, self.prefetch_related)
         return self.model.objects.none()
 
 
 VIEW_FUNC = 'func|'
 OBJ_URL = 'obj_url|'
+TICK = mark_safe('<span class="fa fa-check"></span')
+CROSS = mark_safe('<span class="fa fa-times"></span')
+# GET args used by list views themselves, rather than by the filter form.
+LIST_ARGS = {'page', 'cursor', 'exact_count', 'export', 'sort'}
+
+
+def _attr_getter(attr_name: str):
+    """
+    Returns a function which follows a chain of attributes separated by "__", stopping at the first empty one.
+    """
+    chain = attr_name.split('__')
+    if len(chain) == 1:
+        return attrgetter(attr_name)
+
+    def _get_attr(obj):
+        for b in chain:
+            if obj:
+                obj = getattr(obj, b)
+        return obj
+
+    return _get_attr
+
+
+def _format_value(v):
+    if isinstance(v, datetime.datetime):
+        return display_dt(v)
+    elif v is True:
+        return TICK
+    elif v is False:
+        return CROSS
+    return v or '–'
+
+
+def _compile_getter(model, field: str):
+    """
+    Works out how to get the value for a display item once, returning a function that takes (view, obj).
+    """
+    if hasattr(model, f'display_{field}'):
+        display_method = f'display_{field}'
+        return lambda view, obj: getattr(obj, display_method)()
+    elif field.startswith(VIEW_FUNC):
+        view_method = field[len(VIEW_FUNC) :]
+        return lambda view, obj: getattr(view, view_method)(obj)
+    elif field.startswith(OBJ_URL):
+        get_related = _attr_getter(field[len(OBJ_URL) :])
+
+        def _obj_url(view, obj):
+            if related_obj := get_related(obj):
+                return mark_safe(f'<a href="{related_obj.get_absolute_url()}">{related_obj}</a>')
+            return '–'
+
+        return _obj_url
+
+    get_attr = _attr_getter(field)
+
+    def _value(view, obj):
+        attr = get_attr(obj)
+        if isinstance(attr, partial) or callable(attr):
+            attr = attr()
+        return _format_value(attr)
+
+    return _value
+
+
+def _relation_lookups(model, lookup: str) -> tuple[str | None, str | None]:
+    """
+    Follows a "__" separated lookup through the model's relations, returning the part that can be fetched with
+    select_related, or the part that has to be prefetched if it crosses a to-many relation.
+    """
+    path = []
+    for name in lookup.split('__'):
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            break
+        if not field.is_relation:
+            break
+        path.append(name)
+        if field.many_to_many or field.one_to_many:
+            return None, '__'.join(path)
+        model = field.related_model
+    return '__'.join(path) or None, None
+
+
+def _display_lookups(model, field: str) -> list[str]:
+    if field.startswith(VIEW_FUNC):
+        # We can't tell what a view function reads, views declare those relations themselves.
+        return []
+    lookups = [field.removeprefix(OBJ_URL)]
+    if display_method := getattr(model, f'display_{field}', None):
+        lookups += getattr(display_method, 'related_lookups', [])
+    return lookups
+
+
+def _compile_label(model, item, display_funcs) -> str:
+    if isinstance(item, tuple):
+        return item[0]
+    for func in {'display_', *display_funcs}:
+        item = item.replace(func, '')
+    for i in item.split('__'):
+        field = model._meta.get_field(i)
+        if field.remote_field:
+            model = field.remote_field.model
+    return field.verbose_name
+
+
+class DisplayPlan:
+    """
+    The compiled version of a list of display items for a model. Parsing the display items (prefixes, "__" chains,
+    display_ methods and verbose names) happens once when the plan is built, so rendering a row is just a matter of
+    calling each getter.
+    """
+
+    def __init__(self, model, display_items: tuple, display_funcs):
+        self.model = model
+        self.display_items = display_items
+        self.display_funcs = display_funcs
+        self.getters = []
+        self.select_related, self.prefetch_related = set(), set()
+        for item in display_items:
+            field = item[1] if isinstance(item, tuple) else item
+            self.getters.append(_compile_getter(model, field))
+            for lookup in _display_lookups(model, field):
+                select, prefetch = _relation_lookups(model, lookup)
+                if select:
+                    self.select_related.add(select)
+                elif prefetch:
+                    self.prefetch_related.add(prefetch)
+
+    @cached_property
+    def labels(self) -> list[str]:
+        return [_compile_label(self.model, item, self.display_funcs) for item in self.display_items]
+
+    def values(self, view, obj) -> list:
+        return [getter(view, obj) for getter in self.getters]
+
+
+# Display plans are cached by view class, model and display items so they are shared between requests.
+_display_plans: dict[tuple, DisplayPlan] = {}
 
 
 class DisplayHelpers:
     title = None
     display_items = None
     display_funcs = {VIEW_FUNC, OBJ_URL}
+    # Relations to fetch on top of the ones needed by display_items, eg. ones read by view functions.
+    select_related = ()
+    prefetch_related = ()
+    # Stream the template as it renders rather than rendering it to a string first. Anything lazy in the context (eg.
+    # field_data and panels) is then only evaluated as the response is sent.
+    stream_response = False
+    stream_buffer_size = 50
 
     def get_title(self):
         return mark_safe(self.title)
@@ -45,6 +211,28 @@ class DisplayHelpers:
     def get_display_items(self):
         return self.display_items
 
+    @classmethod
+    def get_display_plan(cls, display_items, model=None) -> DisplayPlan:
+        model = model or cls.model
+        key = cls, model, tuple(display_items or ())
+        try:
+            return _display_plans[key]
+        except KeyError:
+            plan = _display_plans[key] = DisplayPlan(model, key[2], cls.display_funcs)
+            return plan
+
+    def select_display_related(self, qs: QuerySet, display_items, select_related=(), prefetch_related=()) -> QuerySet:
+        """
+        Selects/prefetches the relations needed to render display_items for every object in the queryset, so rendering
+        doesn't run a query per row.
+        """
+        plan = self.get_display_plan(display_items, qs.model)
+        if select := {*plan.select_related, *select_related}:
+            qs = qs.select_related(*select)
+        if prefetch := {*plan.prefetch_related, *prefetch_related}:
+            qs = qs.prefetch_related(*prefetch)
+        return qs
+
     def get_context_data(self, **kwargs) -> dict:
         return super().get_context_data(
             nav_links=get_nav_menu(self.request),
@@ -53,6 +241,17 @@ class DisplayHelpers:
             **kwargs,
         )
 
+    def render_to_response(self, context, **response_kwargs):
+        if not self.stream_response:
+            return super().render_to_response(context, **response_kwargs)
+        # Messages are marked as seen when the template reads them, which would be after the middleware has saved
+        # them, so read them now.
+        list(get_messages(self.request))
+        stream = select_template(self.get_template_names()).stream(context, self.request)
+        stream.enable_buffering(self.stream_buffer_size)
+        response_kwargs.setdefault('content_type', self.content_type)
+        return StreamingHttpResponse(stream, **response_kwargs)
+
     def _object_url(self, rurl):
         try:
             return reverse(rurl)
@@ -80,61 +279,11 @@ class DisplayHelpers:
             btns.append(button)
         return btns
 
-    def _get_attr(self, obj, attr_name):
-        for b in attr_name.split('__'):
-            if obj:
-                obj = getattr(obj, b)
-        return obj
-
-    def _get_v(self, obj, field):
-        if hasattr(obj, f'display_{field}'):
-            return getattr(obj, f'display_{field}')()
-        elif field.startswith(VIEW_FUNC):
-            field = field.replace(VIEW_FUNC, '')
-            return getattr(self, field)(obj)
-        elif field.startswith(OBJ_URL):
-            field = field.replace(OBJ_URL, '')
-            related_obj = self._get_attr(obj, field)
-            if related_obj:
-                return mark_safe(f'<a href="{related_obj.get_absolute_url()}">{related_obj}</a>')
-            return '–'
-        attr = self._get_attr(obj, field)
-        if isinstance(attr, partial) or callable(attr):
-            v = attr()
-        else:
-            v = attr
-        if isinstance(v, datetime.datetime):
-            return display_dt(v)
-        elif v is True:
-            return mark_safe('<span class="fa fa-check"></span')
-        elif v is False:
-            return mark_safe('<span class="fa fa-times"></span')
-        return v or '–'
-
-    def _display_label(self, item, obj):
-        display_funcs = {'display_', *self.display_funcs}
-        if isinstance(item, tuple):
-            return item[0]
-        for func in display_funcs:
-            item = item.replace(func, '')
-        model = obj and type(obj) or self.model
-        for i in item.split('__'):
-            field = model._meta.get_field(i)
-            if field.remote_field:
-                model = field.remote_field.model
-        return field.verbose_name
-
-    def display_value(self, obj, item):
-        if isinstance(item, tuple):
-            return self._get_v(obj, item[1])
-        else:
-            return self._get_v(obj, item)
-
     def get_display_values(self, obj, display_items):
-        return [self.display_value(obj, f) for f in (display_items or [])]
+        return self.get_display_plan(display_items, type(obj)).values(self, obj)
 
     def get_display_labels(self, display_items, obj=None):
-        return [self._display_label(item, obj) for item in (display_items or [])]
+        return self.get_display_plan(display_items, obj and type(obj) or self.model).labels
 
 
 class BasicView(DisplayHelpers, TemplateView):
@@ -198,12 +347,38 @@ def display_dt(dt):
     return dt.strftime(settings.DT_FORMAT)
 
 
+class _Echo:
+    # csv.writer needs a file to write to, this just hands back each line so it can be streamed.
+    def write(self, value):
+        return value
+
+
+def export_value(v) -> str:
+    if v is TICK:
+        return 'Yes'
+    elif v is CROSS:
+        return 'No'
+    v = strip_tags(v) if isinstance(v, SafeData) else str(v)
+    # Stop spreadsheets from treating values as formulas.
+    return f"'{v}" if v[:1] in {'=', '+', '-', '@', '\t', '\r'} else v
+
+
 class ModelListView(QuerySetMixin, DisplayHelpers, DjListView):
     template_name = 'list_view.jinja'
     model = None
     filter_form = None
     filter_info = None
     paginate_by = 40
+    # Seek through the list by its ordering rather than by page number, so deep pages don't need an OFFSET scan or a
+    # COUNT. See KeysetPaginator.
+    keyset_pagination = False
+    paginator_class = SVPaginator
+    # Cache rendered rows in redis, see SalsaVerde.common.row_cache. Only for views whose view functions depend on
+    # nothing but the object and its select_related/prefetch_related relations.
+    cache_rows = False
+    export_chunk_size = 2000
+    # Other orderings the list can be sorted by with ?sort=<key>, as {key: (label, order_by)}.
+    sort_options = {}
 
     @cached_property
     def _mutable_get_args(self):
@@ -213,7 +388,8 @@ class ModelListView(QuerySetMixin, DisplayHelpers, DjListView):
         """
         args = self.request.GET.copy()
         args._mutable = True
-        args.pop('page', None)
+        for arg in LIST_ARGS:
+            args.pop(arg, None)
         query_params = {}
         for key, value in args.lists():
             if not value or value == ['']:
@@ -241,12 +417,81 @@ class ModelListView(QuerySetMixin, DisplayHelpers, DjListView):
         else:
             return qs
 
+    def get_order_by(self):
+        if option := self.sort_options.get(self.request.GET.get('sort')):
+            return option[1]
+        return super().get_order_by()
+
+    def get_sort_links(self) -> list[tuple[str, str, bool]]:
+        if not self.sort_options:
+            return []
+        args = self.request.GET.copy()
+        for arg in LIST_ARGS:
+            args.pop(arg, None)
+        current = self.request.GET.get('sort')
+        links = [('Default', f'?{args.urlencode()}', current not in self.sort_options)]
+        for key, (label, _) in self.sort_options.items():
+            args['sort'] = key
+            links.append((label, f'?{args.urlencode()}', current == key))
+        return links
+
+    def get_count_strategy(self):
+        """
+        Exact counts are only done when asked for, filtered lists are capped and unfiltered lists are estimated.
+        """
+        if self.request.GET.get('exact_count'):
+            return exact_count
+        elif self._mutable_get_args:
+            return capped_count
+        return estimated_count
+
+    def get_paginator(self, queryset, per_page, **kwargs):
+        return super().get_paginator(queryset, per_page, count_strategy=self.get_count_strategy(), **kwargs)
+
+    def paginate_queryset(self, queryset, page_size):
+        if not self.keyset_pagination:
+            return super().paginate_queryset(queryset, page_size)
+        order_by = self.get_order_by()
+        ordering = [order_by] if order_by else list(queryset.model._meta.ordering)
+        paginator = KeysetPaginator(queryset, ordering, page_size)
+        try:
+            page = paginator.page(self.request.GET.get('cursor'))
+        except InvalidCursor:
+            raise Http404('Invalid cursor')
+        return paginator, page, page.object_list, page.has_other_pages()
+
+    def get(self, request, *args, **kwargs):
+        if request.GET.get('export') == 'csv':
+            return self.export_csv()
+        return super().get(request, *args, **kwargs)
+
+    def export_rows(self) -> Iterator[list]:
+        """
+        Every row matching the filters, read through a server-side cursor so memory use doesn't grow with the list.
+        """
+        plan = self.get_display_plan(self.get_display_items())
+        yield plan.labels
+        for obj in self.get_queryset().iterator(chunk_size=self.export_chunk_size):
+            yield [export_value(v) for v in plan.values(self, obj)]
+
+    def export_csv(self) -> StreamingHttpResponse:
+        writer = csv.writer(_Echo())
+        response = StreamingHttpResponse((writer.writerow(row) for row in self.export_rows()), content_type='text/csv')
+        filename = f'{slugify(self.get_title())}-{timezone.now():%Y-%m-%d}.csv'
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+
     def get_button_menu(self):
         yield {'name': f'Add new {self.model._meta.verbose_name}', 'url': reverse(f'{self.model.prefix()}-add')}
 
     def get_field_data(self, object_list: list) -> Iterator[tuple[str, list]]:
+        plan = self.get_display_plan(self.get_display_items())
+        if self.cache_rows:
+            related_paths = {*plan.select_related, *plan.prefetch_related, *self.select_related, *self.prefetch_related}
+            yield from cached_rows(self, plan, object_list, related_paths)
+            return
         for obj in object_list:
-            yield obj.get_absolute_url(), self.get_display_values(obj, self.get_display_items())
+            yield obj.get_absolute_url(), plan.values(self, obj)
 
     def get_title(self):
         return self.model._meta.verbose_name_plural
@@ -260,16 +505,25 @@ class ModelListView(QuerySetMixin, DisplayHelpers, DjListView):
                 filter_form=filter_form,
                 start_filter_form_open=self._propped_filter_form and self._propped_filter_form.filter_kwargs(),
             )
+        get_without_page = self.request.GET.copy()
+        for arg in LIST_ARGS - {'exact_count', 'sort'}:
+            get_without_page.pop(arg, None)
         ctx.update(
             field_names=self.get_display_labels(self.get_display_items()),
-            field_data=list(self.get_field_data(ctx['object_list'])),
+            field_data=self.get_field_data(ctx['object_list']),
+            get_without_page=get_without_page,
+            sort_links=self.get_sort_links(),
         )
         return ctx
 
 
 class ObjMixin:
     def dispatch(self, request, *args, **kwargs):
-        self.object = self.model.objects.get(pk=kwargs['pk'])
+        # get_display_items() can depend on the object, so we can only use the display_items defined on the class here.
+        qs = self.select_display_related(
+            self.model.objects.all(), self.display_items, self.select_related, self.prefetch_related
+        )
+        self.object = qs.get(pk=kwargs['pk'])
         return super().dispatch(request, *args, **kwargs)
 
 
@@ -315,6 +569,45 @@ class UpdateModelView(QuerySetMixin, SVModelFormView, UpdateView, ObjMixin):
         return self.cancel_url or self.object.get_absolute_url()
 
 
+class ExtraContentPanel:
+    """
+    A table of related objects on a details page. Nothing is queried until the template renders the panel, and then a
+    single query gets the first `size` rows (or all of them with show_all). One more row than is shown is fetched to
+    know whether to link to the rest, rather than counting them all.
+    """
+
+    size = 20
+
+    def __init__(self, view, title, qs, fields, add_url=None, icon=None, list_url=None, show_all=False):
+        self.view = view
+        self.show_all = show_all
+        self.title = title
+        self.qs = qs
+        self.fields = fields
+        self.add_url = add_url
+        self.icon = icon
+        self.list_url = list_url
+
+    @cached_property
+    def _objects(self) -> list:
+        qs = self.view.select_display_related(self.qs, self.fields)
+        return list(qs if self.show_all else qs[: self.size + 1])
+
+    @cached_property
+    def field_names(self) -> list:
+        return self.view.get_display_plan(self.fields, self.qs.model).labels
+
+    @cached_property
+    def field_vals(self) -> list:
+        plan = self.view.get_display_plan(self.fields, self.qs.model)
+        objs = self._objects[: self.size] if self.has_more else self._objects
+        return [(self.view.get_absolute_url(obj), plan.values(self.view, obj)) for obj in objs]
+
+    @cached_property
+    def has_more(self) -> bool:
+        return not self.show_all and len(self._objects) > self.size
+
+
 class ExtraContentView(ModelBasicView):
     template_name = 'details_view.jinja'
 
@@ -326,22 +619,8 @@ class ExtraContentView(ModelBasicView):
         if hasattr(obj, 'get_absolute_url'):
             return obj.get_absolute_url()
 
-    def _get_extra_content(self):
-        for item in self.extra_display_items():
-            _extra_content = {
-                'title': item['title'],
-                'add_url': item.get('add_url'),
-                'icon': item.get('icon'),
-            }
-            if item['qs'].exists():
-                objects = list(item['qs'])[:20]
-                _extra_content.update(
-                    field_names=self.get_display_labels(item['fields'], obj=item['qs'][0]),
-                    field_vals=[
-                        (self.get_absolute_url(obj), self.get_display_values(obj, item['fields'])) for obj in objects
-                    ],
-                )
-            yield _extra_content
+    def _get_extra_content(self) -> list[ExtraContentPanel]:
+        return [ExtraContentPanel(self, **item) for item in self.extra_display_items()]
 
     def get_context_data(self, **kwargs):
         return super().get_context_data(extra_content=self._get_extra_content(), **kwargs)
@@ -349,12 +628,14 @@ class ExtraContentView(ModelBasicView):
 
 class DetailView(ObjMixin, ExtraContentView):
     model = None
+    # The node type (see SalsaVerde.stock.trace) to link to the object's trace with, if it can be traced.
+    trace_node = None
 
     def get_title(self):
         return str(self.object)
 
     def get_button_menu(self):
-        return [
+        buttons = [
             {
                 'name': f'Back to all {self.model._meta.verbose_name_plural}',
                 'url': reverse(self.model.prefix()),
@@ -376,6 +657,16 @@ class DetailView(ObjMixin, ExtraContentView):
                 'group': 2,
             },
         ]
+        if self.trace_node:
+            buttons.append(
+                {
+                    'name': 'Trace',
+                    'url': reverse('trace', kwargs={'node_type': self.trace_node, 'pk': self.object.pk}),
+                    'icon': 'fa-route',
+                    'group': 1,
+                }
+            )
+        return buttons
 
     def get_context_data(self, **kwargs):
         display_vals = self.get_display_values(self.object, self.get_display_items())
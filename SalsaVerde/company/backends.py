@@ -0,0 +1,17 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+
+
+class TenantBackend(ModelBackend):
+    """
+    Nearly every request reads the user's company (every request_qs does), and often the company's main contact, so
+    load them along with the user in a single query.
+    """
+
+    def get_user(self, user_id):
+        User = get_user_model()
+        try:
+            user = User._default_manager.select_related('company__main_contact').get(pk=user_id)
+        except User.DoesNotExist:
+            return None
+        return user if self.user_can_authenticate(user) else None
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('company', '0007_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='company',
+            name='shopify_synced_to',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -2,8 +2,11 @@ from datetime import datetime
 
 from django.contrib.auth.base_user import BaseUserManager
 from django.contrib.auth.models import AbstractUser
+from django.contrib.postgres.indexes import GinIndex, OpClass
+from django.contrib.postgres.search import SearchVector
 from django.db import models
-from django.db.models import QuerySet
+from django.db.models import Func, QuerySet, TextField, Value
+from django.db.models.functions import Upper
 from django.urls import reverse
 from pytz import utc
 
@@ -44,6 +47,8 @@ class Company(models.Model):
     shopify_webhook_key = models.CharField(null=True, blank=True, max_length=255)
     shopify_api_key = models.CharField(null=True, blank=True, max_length=255)
     shopify_password = models.CharField(null=True, blank=True, max_length=255)
+    # The updated_at of the last order synced from Shopify, the next sync fetches the orders updated since.
+    shopify_synced_to = models.DateTimeField(null=True, blank=True, editable=False)
 
     street = models.TextField('Street Address', null=True, blank=True)
     town = models.CharField('Town', max_length=50, null=True, blank=True)
@@ -66,7 +71,7 @@ class Company(models.Model):
 
 class CompanyQueryset(QuerySet):
     def request_qs(self, request):
-        return self.filter(company=request.user.company)
+        return self.filter(company_id=request.user.company_id)
 
 
 class NoQS(QuerySet):
@@ -74,6 +79,41 @@ class NoQS(QuerySet):
         raise NotImplementedError
 
 
+def display_related(*lookups):
+    """
+    Marks the relations a display_ method reads, so that views showing it can select them up front rather than per row.
+    """
+
+    def decorator(func):
+        func.related_lookups = lookups
+        return func
+
+    return decorator
+
+
+def search_vector(*expressions):
+    """
+    The document searched by the global search, used for both its GIN indexes and its queries so the indexes match.
+    The simple config doesn't stem or drop stop words, so codes and names are matched as they're typed. Punctuation is
+    replaced with spaces first, otherwise the parser reads the "-2024" in "BB-2024" as a negative number.
+    """
+    return SearchVector(
+        *(
+            Func(e, Value('[^[:alnum:]]+'), Value(' '), Value('g'), function='regexp_replace', output_field=TextField())
+            for e in expressions
+        ),
+        config='simple',
+    )
+
+
+def trigram_index(field: str, name: str) -> GinIndex:
+    """
+    A pg_trgm index for matching anywhere in a column with icontains, or at the start of it with istartswith. Django
+    runs those as UPPER(col) LIKE UPPER(...) so the index is on UPPER(col) to match.
+    """
+    return GinIndex(OpClass(Upper(field), name='gin_trgm_ops'), name=name)
+
+
 class BaseModel(models.Model):
     objects = NoQS.as_manager()
 
@@ -81,6 +121,31 @@ class BaseModel(models.Model):
         abstract = True
 
 
+class CompanyScopedModel(BaseModel):
+    """
+    A model that belongs to a company through a parent (or the first of company_from that's set). The company is
+    copied from the parent on save so that querysets can be scoped with a single indexed column rather than joining
+    up to the parent.
+    """
+
+    company_from: tuple[str, ...] = ()
+
+    company = models.ForeignKey(
+        Company, verbose_name='Company', on_delete=models.CASCADE, editable=False, related_name='+'
+    )
+    objects = CompanyQueryset.as_manager()
+
+    def save(self, *args, **kwargs):
+        for attr in self.company_from:
+            if parent := getattr(self, attr):
+                self.company_id = parent.company_id
+                break
+        super().save(*args, **kwargs)
+
+    class Meta:
+        abstract = True
+
+
 class CompanyNameBaseModel(BaseModel):
     name = models.CharField('Name', max_length=255)
     company = models.ForeignKey(Company, verbose_name='Company', on_delete=models.CASCADE)
@@ -95,7 +160,7 @@ class CompanyNameBaseModel(BaseModel):
 
 class UserQueryset(QuerySet):
     def request_qs(self, request, only_admins=True):
-        return self.filter(company=request.user.company, administrator=only_admins)
+        return self.filter(company_id=request.user.company_id, administrator=only_admins)
 
 
 class UserManager(BaseUserManager):
@@ -158,3 +223,4 @@ class User(AbstractUser):
         verbose_name = 'User'
         verbose_name_plural = 'Users'
         ordering = ['first_name', 'last_name']
+        indexes = [GinIndex(search_vector('first_name', 'last_name', 'email'), name='user_search_idx')]
@@ -1,9 +1,17 @@
+from types import SimpleNamespace
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
 from SalsaVerde.common.tests import SVTestCase
 from SalsaVerde.company.models import Company
+from SalsaVerde.orders.factories.orders import OrderFactory
+from SalsaVerde.orders.models import ProductOrder
 from SalsaVerde.stock.factories.company import CompanyFactory
+from SalsaVerde.stock.factories.product import ProductFactory
 from SalsaVerde.stock.factories.users import UserFactory
+from SalsaVerde.stock.models import Container, Document, Ingredient, Product, ProductIngredient, YieldContainer
 from SalsaVerde.stock.tests.test_common import AuthenticatedClient
 
 
@@ -32,3 +40,47 @@ class CompanySetupTestCase(SVTestCase):
         c = Company.objects.get(id=self.company.id)
         assert c.name == 'Byebye'
         assert c.website == 'https://foocar.com'
+
+
+class TenantContextTestCase(SVTestCase):
+    def setUp(self):
+        self.company = CompanyFactory(name='Burren')
+        self.client = AuthenticatedClient(company=self.company)
+        self.company.main_contact = self.client.user
+        self.company.save()
+
+    def test_user_company_one_query(self):
+        with CaptureQueriesContext(connection) as queries:
+            r = self.client.get(reverse('setup'))
+        self.assertContains(r, 'Burren')
+        sqls = [q['sql'] for q in queries.captured_queries]
+        # The user, company and main contact are all loaded by the query that gets the user for the session.
+        assert not any('FROM "company_company"' in q for q in sqls)
+        user_queries = [q for q in sqls if 'FROM "company_user"' in q and 'INNER JOIN "company_company"' in q]
+        assert len(user_queries) == 1
+        assert 'LEFT OUTER JOIN "company_user"' in user_queries[0]
+
+    def test_company_copied_from_parent(self):
+        product = ProductFactory(product_type__company=self.company)
+        assert product.company == self.company
+        assert {pi.company_id for pi in product.product_ingredients.all()} == {self.company.id}
+        assert {pi.ingredient.company_id for pi in product.product_ingredients.all()} == {self.company.id}
+        assert {yc.company_id for yc in product.yield_containers.all()} == {self.company.id}
+        assert {yc.container.company_id for yc in product.yield_containers.all()} == {self.company.id}
+
+        order = OrderFactory(company=self.company)
+        assert ProductOrder.objects.create(order=order, product=product, quantity=2).company == self.company
+        assert Document.objects.create(author=self.client.user).company == self.company
+        assert Document.objects.create(order=order).company == self.company
+
+    def test_request_qs_single_column(self):
+        request = SimpleNamespace(user=self.client.user)
+        other_product = ProductFactory()
+        ProductFactory(product_type__company=self.company)
+        for model in [Ingredient, Container, Product, ProductIngredient, YieldContainer, ProductOrder, Document]:
+            qs = model.objects.request_qs(request).order_by()
+            sql = str(qs.query)
+            assert 'JOIN' not in sql, model
+            assert f'."company_id" = {self.company.id}' in sql, model
+        assert not Product.objects.request_qs(request).filter(pk=other_product.pk).exists()
+        assert Product.objects.request_qs(request).count() == 1
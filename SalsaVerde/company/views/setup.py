@@ -45,24 +45,28 @@ class Setup(ExtraContentView):
                 'qs': ProductType.objects.request_qs(self.request),
                 'fields': ['name', 'ingredient_types', 'code'],
                 'add_url': reverse('product-types-add'),
+                'list_url': reverse('product-types'),
             },
             {
                 'title': 'Raw Ingredient Types',
                 'qs': IngredientType.objects.request_qs(self.request),
                 'fields': ['name', 'unit'],
                 'add_url': reverse('ingredient-types-add'),
+                'list_url': reverse('ingredient-types'),
             },
             {
                 'title': 'Packaging Types',
                 'qs': ContainerType.objects.request_qs(self.request),
                 'fields': ['name', 'size', 'type'],
                 'add_url': reverse('container-types-add'),
+                'list_url': reverse('container-types'),
             },
             {
                 'title': 'Package Templates',
                 'qs': PackageTemplate.objects.request_qs(self.request),
                 'fields': ['name', 'length', 'width', 'height'],
                 'add_url': reverse('package-temps-add'),
+                'list_url': reverse('package-temps'),
             },
         ]
 
@@ -1,9 +1,12 @@
+from collections import defaultdict
+
 from django import forms
+from django.db.models import Exists, OuterRef, Prefetch
 from django.forms import BaseFormSet
 
-from SalsaVerde.orders.models import PackageTemplate
+from SalsaVerde.orders.models import Order, PackageTemplate, ProductOrder
 from SalsaVerde.stock.forms.base_forms import SVForm
-from SalsaVerde.stock.models import Product
+from SalsaVerde.stock.models import ContainerType, Product, ProductInventory
 
 
 class PackageForm(SVForm):
@@ -39,21 +42,131 @@ class SVBaseFormSet(BaseFormSet):
             prefix=self.add_prefix('__prefix__'),
             empty_permitted=True,
             use_required_attribute=False,
+            **self.get_form_kwargs(None),
         )
         self.add_fields(form, None)
         return form
 
 
+def available_to_order(order, product_ids, lock: bool = False) -> dict:
+    """
+    How much of each of the products is left in each size, by (product_id, container_type_id), counting what the order
+    has already packed as available since that's being replaced. With lock the inventory rows are locked until the end
+    of the transaction, so nothing else can pack them in the meantime.
+    """
+    inventory = ProductInventory.objects.filter(product__in=product_ids).order_by('pk')
+    if lock:
+        inventory = inventory.select_for_update()
+    available = defaultdict(int)
+    for product_id, container_type_id, bottled, packed in inventory.values_list(
+        'product_id', 'container_type_id', 'bottled', 'packed'
+    ):
+        available[(product_id, container_type_id)] += bottled - packed
+    for product_id, container_type_id, packed in ProductOrder.objects.filter(
+        order=order, product__in=product_ids
+    ).values_list('product_id', 'container_type_id', 'quantity'):
+        available[(product_id, container_type_id)] += packed
+    return available
+
+
+def _stock_error(left, size) -> str:
+    if size:
+        return f'Only {float(left):,g} of this batch left in {size.name}'
+    elif left:
+        # Packed into this order before packing was recorded by size.
+        return f'Only {float(left):,g} of this batch left'
+    return 'None of this batch left'
+
+
+class InventoryChoiceField(forms.ModelChoiceField):
+    def label_from_instance(self, obj):
+        if stock := ', '.join(str(inv) for inv in obj.available_inventory):
+            return f'{obj} ({stock})'
+        return str(obj)
+
+
 class PackedProductForm(SVForm):
     title = 'Products Used'
-    product = forms.ModelChoiceField(Product.objects.none())
+    product = InventoryChoiceField(Product.objects.none())
+    container_type = forms.ModelChoiceField(
+        ContainerType.objects.exclude(type=ContainerType.TYPE_CAP),
+        label='Size',
+        required=False,
+        help_text='Only needed if the batch was bottled in more than one size',
+    )
     quantity = forms.IntegerField()
+    autocomplete_fields = {'product': ['product_type__name', 'batch_code']}
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, order=None, **kwargs):
+        self.order = order
         super().__init__(*args, **kwargs)
+        # Only batches with stock left can be packed, along with those already packed into this order so it can be
+        # edited. The stock is looked up from the product inventory so this doesn't depend on how much has been made.
+        available = ProductInventory.objects.request_qs(self.request).available()
         self.fields['product'].queryset = (
-            Product.objects.request_qs(self.request).select_related('product_type').filter(finished=False)
+            Product.objects.request_qs(self.request)
+            .filter(finished=False)
+            .filter(
+                Exists(available.filter(product=OuterRef('pk')))
+                | Exists(ProductOrder.objects.filter(order=self.order, product=OuterRef('pk')))
+            )
+            .select_related('product_type')
+            .prefetch_related(
+                Prefetch('inventory', available.select_related('container_type'), to_attr='available_inventory')
+            )
         )
 
-
-PackedProductFormSet = forms.formset_factory(PackedProductForm, formset=SVBaseFormSet)
+    @classmethod
+    def for_autocomplete(cls, request):
+        order_id = request.GET.get('order', '')
+        order = order_id.isdigit() and Order.objects.request_qs(request).filter(pk=order_id).first()
+        return cls(request=request, order=order or None)
+
+    def get_autocomplete_params(self) -> dict:
+        return {'order': self.order.pk} if self.order else {}
+
+    def clean(self):
+        cleaned_data = super().clean()
+        product, size, quantity = (cleaned_data.get(f) for f in ['product', 'container_type', 'quantity'])
+        if not product or not quantity:
+            return cleaned_data
+        available = {ct: left for (_, ct), left in available_to_order(self.order, [product.pk]).items()}
+        if not size:
+            sizes = {ct for ct, left in available.items() if ct and left > 0}
+            if len(sizes) > 1:
+                raise forms.ValidationError({'container_type': 'This batch was bottled in more than one size'})
+            elif sizes:
+                size = cleaned_data['container_type'] = ContainerType.objects.get(pk=sizes.pop())
+        if quantity > (left := available.get(size and size.pk, 0)):
+            raise forms.ValidationError({'quantity': _stock_error(left, size)})
+        return cleaned_data
+
+
+class PackedProductBaseFormSet(SVBaseFormSet):
+    def clean(self):
+        super().clean()
+        self.check_stock()
+
+    def check_stock(self, lock: bool = False) -> bool:
+        """
+        Each row is checked against the stock on its own, so this checks the rows packing the same batch and size
+        don't add up to more than is left between them. Adds an error to the last of those rows if they do.
+        """
+        rows = defaultdict(list)
+        for form in self.forms:
+            cd = getattr(form, 'cleaned_data', {})
+            if cd.get('product') and cd.get('quantity'):
+                rows[(cd['product'].pk, cd.get('container_type') and cd['container_type'].pk)].append(form)
+        if not rows:
+            return True
+        available = available_to_order(self.form_kwargs.get('order'), {p for p, _ in rows}, lock=lock)
+        ok = True
+        for key, forms_ in rows.items():
+            if sum(f.cleaned_data['quantity'] for f in forms_) > (left := available.get(key, 0)):
+                size = forms_[-1].cleaned_data.get('container_type')
+                forms_[-1].add_error('quantity', f'{_stock_error(left, size)} across all the rows')
+                ok = False
+        return ok
+
+
+PackedProductFormSet = forms.formset_factory(PackedProductForm, formset=PackedProductBaseFormSet)
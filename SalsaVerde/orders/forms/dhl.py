@@ -30,6 +30,7 @@ class DHLLabelForm(SVForm):
     county = forms.CharField(required=False)
     country = forms.ModelChoiceField(Country.objects.all())
     dispatch_date = forms.DateTimeField(initial=now())
+    autocomplete_fields = {'country': ['name', 'iso_2']}
 
     def __init__(self, instance: Order, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -44,3 +45,7 @@ class DHLLabelForm(SVForm):
             self.fields['phone'].initial = address['phone']
             self.fields['shopify_order'].initial = instance.shopify_id
             self.fields['country'].initial = Country.objects.filter(iso_2=address['country_code']).first()
+
+    @classmethod
+    def for_autocomplete(cls, request):
+        return cls(Order(), request=request)
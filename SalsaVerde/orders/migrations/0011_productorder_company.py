@@ -0,0 +1,24 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('company', '0006_alter_user_options'),
+        ('orders', '0010_auto_20201114_1143'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productorder',
+            name='company',
+            field=models.ForeignKey(
+                editable=False,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name='+',
+                to='company.company',
+                verbose_name='Company',
+            ),
+        ),
+    ]
@@ -0,0 +1,29 @@
+from django.db import migrations
+from django.db.models import OuterRef, Subquery
+
+BATCH_SIZE = 5000
+
+
+def backfill_company(apps, schema_editor):
+    """
+    Sets the company in batches of primary keys, each committed on its own, so the table isn't locked for the whole
+    backfill and it can be resumed if it's interrupted.
+    """
+    ProductOrder = apps.get_model('orders', 'ProductOrder')
+    company_id = ProductOrder.objects.filter(pk=OuterRef('pk')).values('order__company_id')
+    last_pk = 0
+    while pks := list(
+        ProductOrder.objects.filter(pk__gt=last_pk, company__isnull=True)
+        .order_by('pk')
+        .values_list('pk', flat=True)[:BATCH_SIZE]
+    ):
+        ProductOrder.objects.filter(pk__in=pks).update(company_id=Subquery(company_id))
+        last_pk = pks[-1]
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [('orders', '0011_productorder_company')]
+
+    operations = [migrations.RunPython(backfill_company, migrations.RunPython.noop)]
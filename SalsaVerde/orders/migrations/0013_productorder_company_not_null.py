@@ -0,0 +1,20 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [('orders', '0012_backfill_productorder_company')]
+
+    operations = [
+        migrations.AlterField(
+            model_name='productorder',
+            name='company',
+            field=models.ForeignKey(
+                editable=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name='+',
+                to='company.company',
+                verbose_name='Company',
+            ),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.9 on 2026-10-18 07:58
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+import django.db.models.fields.json
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('orders', '0013_productorder_company_not_null'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='order',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.search.SearchVector(models.Func(django.db.models.fields.json.KeyTextTransform('name', 'extra_data'), models.Value('[^[:alnum:]]+'), models.Value(' '), models.Value('g'), function='regexp_replace', output_field=models.TextField()), models.Func(django.db.models.fields.json.KeyTextTransform('first_name', django.db.models.fields.json.KeyTextTransform('customer', 'extra_data')), models.Value('[^[:alnum:]]+'), models.Value(' '), models.Value('g'), function='regexp_replace', output_field=models.TextField()), models.Func(django.db.models.fields.json.KeyTextTransform('last_name', django.db.models.fields.json.KeyTextTransform('customer', 'extra_data')), models.Value('[^[:alnum:]]+'), models.Value(' '), models.Value('g'), function='regexp_replace', output_field=models.TextField()), models.Func(django.db.models.fields.json.KeyTextTransform('name', django.db.models.fields.json.KeyTextTransform('shipping_address', 'extra_data')), models.Value('[^[:alnum:]]+'), models.Value(' '), models.Value('g'), function='regexp_replace', output_field=models.TextField()), config='simple'), name='order_search_idx'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('stock', '0017_product_inventory'),
+        ('orders', '0014_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productorder',
+            name='container_type',
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name='+',
+                to='stock.containertype',
+                verbose_name='Size',
+            ),
+        ),
+    ]
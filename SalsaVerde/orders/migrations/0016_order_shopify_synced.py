@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('orders', '0015_productorder_container_type'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='shopify_synced',
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name='Synced with Shopify'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.9 on 2026-10-18 09:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('company', '0008_company_shopify_synced_to'),
+        ('orders', '0016_order_shopify_synced'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ShopifyEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('webhook_id', models.CharField(max_length=255, unique=True)),
+                ('topic', models.CharField(max_length=255)),
+                ('shopify_id', models.CharField(max_length=255)),
+                ('data', models.JSONField()),
+                ('received', models.DateTimeField(auto_now_add=True)),
+                ('processed', models.DateTimeField(blank=True, null=True)),
+                ('company', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='company.company')),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('processed__isnull', True)), fields=['company', 'received'], name='pending_event_idx')],
+            },
+        ),
+    ]
@@ -1,9 +1,17 @@
+from django.contrib.postgres.indexes import GinIndex
 from django.db import models
-from django.db.models import QuerySet
+from django.db.models.fields.json import KT
 from django.urls import reverse
 
-from SalsaVerde.company.models import Company, CompanyNameBaseModel, CompanyQueryset, User
-from SalsaVerde.stock.models import Product
+from SalsaVerde.company.models import (
+    Company,
+    CompanyNameBaseModel,
+    CompanyQueryset,
+    CompanyScopedModel,
+    User,
+    search_vector,
+)
+from SalsaVerde.stock.models import ContainerType, Product
 
 
 class Order(models.Model):
@@ -33,6 +41,8 @@ class Order(models.Model):
     shipment_details = models.JSONField(blank=True, null=True)
     carrier = models.CharField(choices=CARRIER_CHOICES, max_length=20, null=True, blank=True)
     extra_data = models.JSONField(blank=True, null=True, default=dict)
+    # When extra_data was last fetched from Shopify.
+    shopify_synced = models.DateTimeField('Synced with Shopify', null=True, blank=True, editable=False)
     user = models.ForeignKey(User, blank=True, null=True, on_delete=models.SET_NULL)
 
     @classmethod
@@ -47,6 +57,42 @@ class Order(models.Model):
 
     class Meta:
         ordering = ('-created',)
+        indexes = [
+            GinIndex(
+                search_vector(
+                    KT('extra_data__name'),
+                    KT('extra_data__customer__first_name'),
+                    KT('extra_data__customer__last_name'),
+                    KT('extra_data__shipping_address__name'),
+                ),
+                name='order_search_idx',
+            ),
+        ]
+
+
+class ShopifyEvent(models.Model):
+    """
+    A webhook from Shopify, stored as it was received until a worker processes it. Shopify can send a webhook more than
+    once, so they're unique by the id it gives each one.
+    """
+
+    company = models.ForeignKey(Company, on_delete=models.CASCADE)
+    webhook_id = models.CharField(max_length=255, unique=True)
+    topic = models.CharField(max_length=255)
+    shopify_id = models.CharField(max_length=255)
+    data = models.JSONField()
+    received = models.DateTimeField(auto_now_add=True)
+    processed = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'{self.topic} {self.shopify_id}'
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['company', 'received'], condition=models.Q(processed__isnull=True), name='pending_event_idx'
+            )
+        ]
 
 
 class PackageTemplate(CompanyNameBaseModel):
@@ -68,13 +114,13 @@ class PackageTemplate(CompanyNameBaseModel):
         verbose_name_plural = 'Package Templates'
 
 
-class ProductOrderQueryset(QuerySet):
-    def request_qs(self, request):
-        return self.filter(order__company=request.user.company)
+class ProductOrder(CompanyScopedModel):
+    company_from = ('order',)
 
-
-class ProductOrder(models.Model):
-    objects = ProductOrderQueryset.as_manager()
     quantity = models.IntegerField()
     order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='products')
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='orders')
+    # Older orders were packed without recording the size, they aren't counted in the product's inventory.
+    container_type = models.ForeignKey(
+        ContainerType, verbose_name='Size', null=True, blank=True, on_delete=models.SET_NULL, related_name='+'
+    )
@@ -1,16 +1,48 @@
 import logging
-from datetime import datetime
+import uuid
+from datetime import datetime, timedelta
 
-from django.db import IntegrityError
+import django_rq
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Case, DateTimeField, Q, Value, When
+from django.db.models.functions import Concat, Lower
+from django.utils import timezone
 from django.utils.text import slugify
 from django_rq import job
+from rq import get_current_job
 
+from SalsaVerde.common.row_cache import bump_row_versions
 from SalsaVerde.company.models import Company, User
-from SalsaVerde.orders.models import Order
-from SalsaVerde.orders.views.shopify import get_shopify_order, shopify_request
+from SalsaVerde.orders.models import Order, ShopifyEvent
+from SalsaVerde.orders.views.shopify import ORDER_FIELDS, get_shopify_order, shopify_pages, shopify_request
 
 logger = logging.getLogger('salsa.shopify')
 
+# How long a refresh of an order that's been asked for stops it being asked for again, if the job doesn't finish.
+REFRESH_LOCK_TIMEOUT = 5 * 60
+# The most orders Shopify returns in a page.
+SYNC_PAGE_SIZE = 250
+# The id of the sync job that's next to run, see schedule_shopify_sync().
+SYNC_JOB_KEY = 'shopify-sync-job'
+# The webhooks that are processed, see process_shopify_events().
+SHOPIFY_CHANGE_EVENTS = {'orders/create', 'orders/updated', 'orders/paid', 'orders/fulfilled'}
+SHOPIFY_CANCEL_EVENTS = {'orders/cancelled', 'orders/delete'}
+SHOPIFY_EVENTS = SHOPIFY_CHANGE_EVENTS | SHOPIFY_CANCEL_EVENTS
+# How long webhooks are kept after they're processed, so the ones Shopify sends again are known.
+EVENT_RETENTION = timedelta(days=7)
+# How long processing a company's webhooks that's been queued stops it being queued again, if the job doesn't finish.
+EVENTS_LOCK_TIMEOUT = 5 * 60
+# How long after processing a company's webhooks fails it's tried again.
+EVENTS_RETRY_DELAY = 60
+# Webhooks still waiting this long after they were received are queued again by the scheduled sync.
+EVENTS_STALE_AFTER = timedelta(minutes=10)
+
+
+class ShopifySyncError(Exception):
+    pass
+
 
 @job
 def shopify_fulfill_order(order_id: int):
@@ -26,7 +58,11 @@ def shopify_fulfill_order(order_id: int):
         }
     }
     success, content = shopify_request(
-        f'orders/{order.shopify_id}/fulfillments.json', method='POST', data=data, company=order.company
+        f'orders/{order.shopify_id}/fulfillments.json',
+        method='POST',
+        data=data,
+        company=order.company,
+        max_wait=settings.SHOPIFY_JOB_MAX_WAIT,
     )
     if success:
         order.status = Order.STATUS_FULFILLED
@@ -46,7 +82,7 @@ def get_or_create_user(order_data: dict, company: Company):
         user = user_qs.filter(
             last_name__iexact=user_details['last_name'], first_name__iexact=user_details['first_name']
         ).first()
-    inactive_email_ending = f'@inactive.{slugify(company.name)}.com'
+    inactive_email_ending = _inactive_email_ending(company)
     if not user:
         email = (email or f"{user_details['first_name']}_{user_details['last_name']}{inactive_email_ending}").lower()
         user = User.objects.create(
@@ -64,11 +100,230 @@ def get_or_create_user(order_data: dict, company: Company):
     return user
 
 
+def _inactive_email_ending(company: Company) -> str:
+    return f'@inactive.{slugify(company.name)}.com'
+
+
+def _customer_name(customer: dict) -> str:
+    return f"{customer.get('first_name') or ''} {customer.get('last_name') or ''}".lower()
+
+
+def customer_key(customer: dict) -> str:
+    return (customer.get('email') or '').lower() or _customer_name(customer)
+
+
+def get_or_create_users(customers: list[dict], company: Company) -> dict[str, int]:
+    """
+    get_or_create_user for the customers of many orders at once, with a query each to find users by email and by name
+    and a bulk_create for the new ones. Returns the ids of the users by customer_key(). A customer whose email belongs
+    to a user of another company or an administrator is left without one.
+    """
+    customers = {customer_key(c): c for c in customers}
+    emails = {key for key, c in customers.items() if c.get('email')}
+    names = {_customer_name(c) for c in customers.values()}
+    user_qs = User.objects.filter(company=company, administrator=False)
+    by_email, taken = {}, set()
+    for user in User.objects.annotate(_email=Lower('email')).filter(_email__in=emails).order_by(*User._meta.ordering):
+        if user.company_id == company.id and not user.administrator:
+            by_email.setdefault(user._email, user)
+        else:
+            taken.add(user._email)
+    by_name = {}
+    for user in user_qs.annotate(_name=Lower(Concat('first_name', Value(' '), 'last_name'))).filter(_name__in=names):
+        by_name.setdefault(user._name, user)
+
+    inactive_email_ending = _inactive_email_ending(company)
+    users, new_users, changed_emails = {}, [], []
+    for key, customer in customers.items():
+        email = (customer.get('email') or '').lower()
+        name = _customer_name(customer)
+        if email in taken:
+            logger.warning('Email %s of Shopify customer %s is used by another user', email, name)
+            continue
+        if not (user := by_email.get(email) or by_name.get(name)):
+            first_name, last_name = customer.get('first_name') or '', customer.get('last_name') or ''
+            user = User(
+                email=email or f'{first_name}_{last_name}{inactive_email_ending}'.lower(),
+                first_name=first_name.title(),
+                last_name=last_name.title(),
+                company=company,
+                administrator=False,
+            )
+            user.set_unusable_password()
+            new_users.append(user)
+        elif user.email.endswith(inactive_email_ending) and email:
+            user.email = email
+            changed_emails.append(user)
+        # Later customers match the users of earlier ones, as they would if their orders were synced one by one.
+        by_name.setdefault(name, user)
+        if email:
+            by_email[email] = user
+        users[key] = user
+    User.objects.bulk_create(new_users)
+    User.objects.bulk_update(changed_emails, ['email'])
+    bump_row_versions(User, [u.pk for u in changed_emails])
+    return {key: user.pk for key, user in users.items()}
+
+
+def upsert_orders(orders_data: list[dict], company: Company) -> list[int]:
+    """
+    Creates or updates orders from their Shopify data with a single upsert, resolving their customers in one batch.
+    As with update_order_details, an order's user is only set if it doesn't have one and an order's status only goes
+    from unfulfilled to fulfilled. Returns the ids of the orders.
+    """
+    orders_data = {str(o['id']): o for o in orders_data}
+    if not orders_data:
+        return []
+    now = timezone.now()
+    with transaction.atomic():
+        existing = {
+            shopify_id: (company_id, status, user_id)
+            for shopify_id, company_id, status, user_id in Order.objects.filter(shopify_id__in=orders_data).values_list(
+                'shopify_id', 'company_id', 'status', 'user_id'
+            )
+        }
+        customers = [
+            o['customer'] for sid, o in orders_data.items() if o.get('customer') and not existing.get(sid, (0, 0, 0))[2]
+        ]
+        user_ids = get_or_create_users(customers, company)
+        orders = []
+        for shopify_id, data in orders_data.items():
+            company_id, status, user_id = existing.get(shopify_id, (company.id, Order.STATUS_UNFULFILLED, None))
+            if company_id != company.id:
+                logger.warning('Shopify order %s belongs to another company', shopify_id)
+                continue
+            if status == Order.STATUS_UNFULFILLED and data.get('fulfillment_status') == 'fulfilled':
+                status = Order.STATUS_FULFILLED
+            if not user_id and data.get('customer'):
+                user_id = user_ids.get(customer_key(data['customer']))
+            orders.append(
+                Order(
+                    shopify_id=shopify_id,
+                    company=company,
+                    status=status,
+                    user_id=user_id,
+                    extra_data=data,
+                    shopify_synced=now,
+                )
+            )
+        Order.objects.bulk_create(
+            orders,
+            update_conflicts=True,
+            unique_fields=['shopify_id'],
+            update_fields=['status', 'user', 'extra_data', 'shopify_synced'],
+        )
+        # created is auto_now_add, so bulk_create sets it to now rather than when the order was made.
+        orders = Order.objects.filter(shopify_id__in=[o.shopify_id for o in orders])
+        orders.update(
+            created=Case(
+                *[
+                    When(shopify_id=sid, then=Value(datetime.fromisoformat(orders_data[sid]['created_at'])))
+                    for sid in orders_data
+                    if orders_data[sid].get('created_at')
+                ],
+                default='created',
+                output_field=DateTimeField(),
+            )
+        )
+        order_ids = list(orders.values_list('id', flat=True))
+        bump_row_versions(Order, order_ids)
+    return order_ids
+
+
+def sync_orders(company: Company, *, advance_watermark: bool = False, **params) -> int:
+    """
+    Fetches the company's orders from Shopify, with all their ORDER_FIELDS so they don't need fetching again one by
+    one, and upserts each page of them. params are the filters for the orders, eg. created_at_min. Returns the number
+    of orders synced.
+
+    With advance_watermark the orders must be in order of updated_at, and company.shopify_synced_to is moved on to the
+    last order of each page in the same transaction as the page, so a sync that fails part way carries on from there.
+    """
+    params = {'limit': SYNC_PAGE_SIZE, 'status': 'any', **params, 'fields': ','.join(ORDER_FIELDS)}
+    count = 0
+    for success, data in shopify_pages('orders.json', params, company=company, max_wait=settings.SHOPIFY_JOB_MAX_WAIT):
+        if not success:
+            raise ShopifySyncError(f'Error syncing Shopify orders for {company}: {data}')
+        with transaction.atomic():
+            count += len(upsert_orders(data['orders'], company))
+            if advance_watermark and data['orders']:
+                synced_to = max(datetime.fromisoformat(o['updated_at']) for o in data['orders'])
+                # It's never moved back, by an older sync that finished later.
+                Company.objects.filter(
+                    Q(shopify_synced_to__isnull=True) | Q(shopify_synced_to__lt=synced_to), id=company.id
+                ).update(shopify_synced_to=synced_to)
+    logger.info('Synced %d Shopify orders for %s', count, company)
+    return count
+
+
+def sync_changed_orders(company: Company) -> int:
+    """
+    Syncs the orders updated in Shopify since the company's last sync, or in the last SHOPIFY_SYNC_FIRST_DAYS if it
+    hasn't been synced. updated_at_min includes the orders updated at that time, so the last order synced is fetched
+    again, and a sync when nothing has changed is a single request for that one order.
+    """
+    updated_at_min = company.shopify_synced_to or timezone.now() - timedelta(days=settings.SHOPIFY_SYNC_FIRST_DAYS)
+    return sync_orders(
+        company, advance_watermark=True, updated_at_min=updated_at_min.isoformat(), order='updated_at asc'
+    )
+
+
+@job
+def sync_shopify_orders():
+    """
+    Syncs the orders of every company with Shopify that have changed since the last sync, then schedules the next.
+    """
+    if (current := get_current_job()) and cache.get(SYNC_JOB_KEY) not in (None, current.id):
+        # The sync has been scheduled again since this one was, and that's the one that carries on.
+        return
+    try:
+        companies = (
+            Company.objects.filter(shopify_password__isnull=False, shopify_api_key__isnull=False)
+            .exclude(shopify_password='')
+            .exclude(shopify_api_key='')
+        )
+        for company in companies:
+            try:
+                sync_changed_orders(company)
+            except ShopifySyncError as e:
+                logger.error('%s', e)
+        # Webhooks whose processing was lost, eg. when the worker was restarted.
+        stale = ShopifyEvent.objects.filter(processed__isnull=True, received__lt=timezone.now() - EVENTS_STALE_AFTER)
+        for company_id in set(stale.values_list('company_id', flat=True)):
+            queue_shopify_events(company_id)
+    finally:
+        schedule_shopify_sync(timedelta(seconds=settings.SHOPIFY_SYNC_INTERVAL))
+
+
+def schedule_shopify_sync(delay: timedelta | None = None):
+    """
+    Runs sync_shopify_orders after delay, or now. The job schedules itself again each time it runs (the worker must be
+    run with --with-scheduler), and only the last one scheduled does, so scheduling it again never runs it twice over.
+    """
+    queue = django_rq.get_queue()
+    job_id = uuid.uuid4().hex
+    cache.set(SYNC_JOB_KEY, job_id, timeout=None)
+    if delay:
+        queue.enqueue_in(delay, sync_shopify_orders, job_id=job_id)
+    else:
+        queue.enqueue(sync_shopify_orders, job_id=job_id)
+
+
+def _refresh_lock_key(pk) -> str:
+    return f'shopify-refresh:{pk}'
+
+
 @job
 def update_order_details(pk, company_id):
     order = Order.objects.get(id=pk, company_id=company_id)
     assert order.shopify_id
-    _, order_data = get_shopify_order(order.shopify_id, company=order.company)
+    success, order_data = get_shopify_order(
+        order.shopify_id, company=order.company, max_wait=settings.SHOPIFY_JOB_MAX_WAIT
+    )
+    cache.delete(_refresh_lock_key(pk))
+    if not success:
+        logger.warning('Error getting Shopify order %s: %s', order.id, order_data)
+        return
     order_data = order_data['order']
     if not order.user:
         order.user = get_or_create_user(order_data, order.company)
@@ -79,36 +334,98 @@ def update_order_details(pk, company_id):
     if order_data != order.extra_data:
         logger.info('Updated order %s with shopify data', order.id)
         Order.objects.filter(id=order.id).update(
-            extra_data=order_data, created=datetime.fromisoformat(order_data['created_at'])
+            extra_data=order_data,
+            created=datetime.fromisoformat(order_data['created_at']),
+            shopify_synced=timezone.now(),
         )
+        bump_row_versions(Order, [order.id])
+    else:
+        Order.objects.filter(id=order.id).update(shopify_synced=timezone.now())
 
 
-def process_shopify_event(topic, event_data, company: Company):
-    obj, event = topic.split('/')
-    msg = f'Unknown event {topic}'
-    status = 220
-    if obj == 'orders':
-        if event == 'create':
-            try:
-                order = Order.objects.create(shopify_id=event_data['id'], company=company)
-            except IntegrityError:
-                # Order already exists
-                msg = f"Order {event_data['id']} already exists"
-                status = 213
-            else:
-                msg = f'Order {order.shopify_id} created'
-                status = 212
-                update_order_details.delay(order.id, company.id)
-        elif event in {'updated', 'paid', 'fulfilled'}:
-            try:
-                order = Order.objects.get(shopify_id=event_data['id'], company=company)
-            except Order.MultipleObjectsReturned:
-                order = Order.objects.filter(shopify_id=event_data['id'], company=company).first()
-            msg = f'Order {order.shopify_id} updated'
-            status = 210
-            update_order_details.delay(order.id, company.id)
-        elif event in {'cancelled', 'delete'}:
-            Order.objects.filter(shopify_id=event_data['id']).update(status=Order.STATUS_CANCELLED)
-            msg = f"Order {event_data['id']} deleted"
-            status = 211
-    return msg, status
+def refresh_order(order: Order):
+    """
+    Refreshes the order's Shopify data in the background, unless a refresh has already been asked for.
+    """
+    if cache.add(_refresh_lock_key(order.pk), 1, REFRESH_LOCK_TIMEOUT):
+        update_order_details.delay(order.pk, order.company_id)
+
+
+def get_order_data(order: Order) -> dict | None:
+    """
+    Returns the order's Shopify data as it was last fetched, so pages can show it without waiting on Shopify. If it's
+    older than SHOPIFY_ORDER_TTL it's refreshed in the background for next time.
+    """
+    if not order.shopify_id:
+        return None
+    stale_before = timezone.now() - timedelta(seconds=settings.SHOPIFY_ORDER_TTL)
+    if not order.shopify_synced or order.shopify_synced < stale_before:
+        refresh_order(order)
+    return order.extra_data or None
+
+
+def _events_lock_key(company_id: int) -> str:
+    return f'shopify-events:{company_id}'
+
+
+def queue_shopify_events(company_id: int, delay: int | None = None):
+    """
+    Queues processing the company's stored webhooks after delay, by default SHOPIFY_EVENT_DELAY so the webhooks for an
+    order that come together are processed together, unless it's already queued or running.
+    """
+    delay = settings.SHOPIFY_EVENT_DELAY if delay is None else delay
+    if cache.add(_events_lock_key(company_id), 1, delay + EVENTS_LOCK_TIMEOUT):
+        if delay:
+            django_rq.get_queue().enqueue_in(timedelta(seconds=delay), process_shopify_events, company_id)
+        else:
+            process_shopify_events.delay(company_id)
+
+
+@job
+def process_shopify_events(company_id: int):
+    """
+    Processes the company's stored webhooks, see _process_events(). The company stays queued until it's finished, so
+    webhooks received in the meantime are picked up by queueing it again at the end. If it fails the webhooks are left
+    unprocessed and it's queued again after EVENTS_RETRY_DELAY.
+    """
+    try:
+        _process_events(company_id)
+    except Exception:
+        cache.delete(_events_lock_key(company_id))
+        queue_shopify_events(company_id, delay=EVENTS_RETRY_DELAY)
+        raise
+    cache.delete(_events_lock_key(company_id))
+    if ShopifyEvent.objects.filter(company_id=company_id, processed__isnull=True).exists():
+        queue_shopify_events(company_id)
+
+
+def _process_events(company_id: int):
+    """
+    Brings each order the company's stored webhooks are for up to date once however many webhooks there are for it.
+    The orders created or changed are fetched from Shopify together and upserted, then the orders cancelled or deleted
+    are cancelled.
+    """
+    events = list(
+        ShopifyEvent.objects.filter(company_id=company_id, processed__isnull=True).values_list(
+            'id', 'topic', 'shopify_id'
+        )
+    )
+    if not events:
+        return
+    company = Company.objects.get(id=company_id)
+    changed = {shopify_id for _, topic, shopify_id in events if topic in SHOPIFY_CHANGE_EVENTS}
+    cancelled = {shopify_id for _, topic, shopify_id in events if topic in SHOPIFY_CANCEL_EVENTS}
+    deleted = {shopify_id for _, topic, shopify_id in events if topic == 'orders/delete'}
+    # Deleted orders can't be fetched.
+    to_fetch = sorted(changed - deleted)
+    for i in range(0, len(to_fetch), SYNC_PAGE_SIZE):
+        sync_orders(company, ids=','.join(to_fetch[i : i + SYNC_PAGE_SIZE]))
+    if cancelled:
+        orders = Order.objects.filter(company_id=company_id, shopify_id__in=cancelled)
+        order_ids = list(orders.values_list('id', flat=True))
+        orders.update(status=Order.STATUS_CANCELLED)
+        bump_row_versions(Order, order_ids)
+    now = timezone.now()
+    ShopifyEvent.objects.filter(id__in=[event_id for event_id, *_ in events]).update(processed=now)
+    ShopifyEvent.objects.filter(company_id=company_id, processed__lt=now - EVENT_RETENTION).delete()
+    logger.info('Processed %d Shopify events for %d orders of %s', len(events), len(changed | cancelled), company)
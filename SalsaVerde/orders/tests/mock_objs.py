@@ -1,6 +1,13 @@
 import base64
+import json
+import math
 import re
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
+from urllib.parse import parse_qs, quote, urlparse
 
 from requests.exceptions import HTTPError
 
@@ -141,7 +148,10 @@ def fake_shopify(error=False):
             },
         ]
 
-        def __init__(self, method, url, auth, json=None):
+        headers = {}
+        links = {}
+
+        def __init__(self, method, url, auth, json=None, **kwargs):
             self.url = url
             self.method = method
             self.status_code = 400 if error else 200
@@ -156,9 +166,100 @@ def fake_shopify(error=False):
                 order_id = re.search(r'orders/(\d+)\.json', self.url).group(1)
                 return {'order': next(o for o in self.orders if o['id'] == order_id)}
             elif re.match(r'.*orders\.json', self.url) and self.method == 'GET':
-                if 'shipped' in self.url:
+                if ids := parse_qs(urlparse(self.url).query).get('ids'):
+                    return {'orders': [o for o in self.orders if o['id'] in ids[0].split(',')]}
+                elif 'shipped' in self.url:
                     return {'orders': [o for o in self.orders if o['fulfillment_status'] == 'fulfilled']}
                 else:
                     return {'orders': [o for o in self.orders if not o['fulfillment_status']]}
 
     return MockShopify
+
+
+class ShopifyStandIn:
+    """
+    A local server standing in for Shopify's REST API, with a leaky bucket rate limit per shop (by API key) that
+    responds with 429s when it's exceeded, as Shopify does. The first `fail` requests get a fail_status error.
+
+    orders.json lists `orders` a page at a time, with the next page's cursor in the Link header. They can be filtered
+    with updated_at_min, which sorts them by updated_at.
+    """
+
+    def __init__(self, bucket_size=40, leak_rate=2, fail=0, fail_status=503, retry_after='1.0', orders=()):
+        self.bucket_size, self.leak_rate, self.retry_after = bucket_size, leak_rate, retry_after
+        self.fail, self.fail_status = fail, fail_status
+        self.orders = list(orders)
+        self.requests, self.rate_limited = 0, 0
+        self.paths = []
+        self.buckets = {}
+        self.lock = threading.Lock()
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stand_in.handle(self)
+
+            do_POST = do_GET
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/admin/api'
+
+    def handle(self, handler):
+        with self.lock:
+            self.requests += 1
+            shop = handler.headers.get('Authorization', '')
+            now = time.monotonic()
+            level, at = self.buckets.get(shop, (0, now))
+            level = max(level - (now - at) * self.leak_rate, 0)
+            if self.fail:
+                self.fail -= 1
+                status = self.fail_status
+            elif level + 1 > self.bucket_size:
+                self.rate_limited += 1
+                status = 429
+            else:
+                level += 1
+                status = 200
+            headers = {'Retry-After': self.retry_after} if status == 429 else {}
+            self.buckets[shop] = (level, now)
+            headers['X-Shopify-Shop-Api-Call-Limit'] = f'{math.ceil(level)}/{self.bucket_size}'
+            self.paths.append(handler.path)
+        if status == 200:
+            url = urlparse(handler.path)
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+            # The cursor is the position of the page and the filter, as the filter can't be given with it.
+            start, _, updated_at_min = query.get('page_info', f"0,{query.get('updated_at_min', '')}").partition(',')
+            start, limit = int(start), int(query.get('limit', 50))
+            orders = self.orders
+            if updated_at_min:
+                updated_at_min = datetime.fromisoformat(updated_at_min)
+                orders = [o for o in orders if datetime.fromisoformat(o['updated_at']) >= updated_at_min]
+                orders.sort(key=lambda o: datetime.fromisoformat(o['updated_at']))
+                updated_at_min = quote(updated_at_min.isoformat())
+            if url.path.endswith('/orders.json') and start + limit < len(orders):
+                next_query = (
+                    f"limit={limit}&fields={query.get('fields', '')}&page_info={start + limit},{updated_at_min}"
+                )
+                headers['Link'] = f'<{self.url}/orders.json?{next_query}>; rel="next"'
+            body = {'orders': orders[start : start + limit]}
+        else:
+            body = {'errors': 'Exceeded call limit'}
+        body = json.dumps(body).encode()
+        handler.send_response(status)
+        for k, v in headers.items():
+            handler.send_header(k, v)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
@@ -1,21 +1,27 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 from unittest import mock
 
 from django.conf import settings
 from django.core.cache import cache
 from django.core.files.base import ContentFile
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 from pytz import utc
 
 from SalsaVerde.common.tests import SVTestCase
 from SalsaVerde.company.models import User
 from SalsaVerde.orders.factories.orders import OrderFactory
-from SalsaVerde.orders.models import Order
+from SalsaVerde.orders.forms.common import PackedProductForm
+from SalsaVerde.orders.models import Order, ProductOrder
+from SalsaVerde.orders.shopify import update_order_details
 from SalsaVerde.orders.tests.mock_objs import fake_dhl, fake_ef, fake_shopify
 from SalsaVerde.stock.factories.company import CompanyFactory
 from SalsaVerde.stock.factories.product import ProductFactory
 from SalsaVerde.stock.factories.users import UserFactory
-from SalsaVerde.stock.models import Document
+from SalsaVerde.stock.models import Document, Product, ProductInventory
 from SalsaVerde.stock.tests.test_common import AuthenticatedClient, empty_formset
 
 
@@ -287,6 +293,47 @@ class OrderTestCase(SVTestCase):
         self.assertNotContains(r, 'Update Product Batch Codes')
         self.assertNotContains(r, 'Tracking')
 
+    @mock.patch('SalsaVerde.orders.shopify.update_order_details.delay')
+    @mock.patch('SalsaVerde.orders.views.shopify.session.request')
+    def test_order_shopify_cached(self, mock_shopify, mock_refresh):
+        data = fake_shopify().orders[0]
+        order = OrderFactory(company=self.company, shopify_id=123, extra_data=data, shopify_synced=timezone.now())
+        r = self.client.get(order.get_absolute_url())
+        self.assertContains(r, 'Bramley apple')
+        r = self.client.get(reverse('order-packed-product', args=[order.id]))
+        self.assertContains(r, 'Bramley apple')
+        assert not mock_shopify.called
+        assert not mock_refresh.called
+
+        # Once it's out of date the page still shows what we have, and it's refreshed once in the background.
+        Order.objects.filter(id=order.id).update(shopify_synced=timezone.now() - timedelta(hours=1))
+        for _ in range(2):
+            r = self.client.get(order.get_absolute_url())
+            self.assertContains(r, 'Bramley apple')
+        assert not mock_shopify.called
+        mock_refresh.assert_called_once_with(order.id, self.company.id)
+
+    @mock.patch('SalsaVerde.orders.views.shopify.session.request')
+    def test_order_refresh(self, mock_shopify):
+        mock_shopify.side_effect = fake_shopify()
+        order = OrderFactory(company=self.company, shopify_id=123, shopify_synced=timezone.now())
+        r = self.client.get(order.get_absolute_url())
+        url = reverse('order-refresh', args=[order.id])
+        self.assertContains(r, url)
+        self.assertNotContains(r, 'Products ordered')
+
+        assert self.client.get(url).status_code == 405
+        r = self.client.post(url, follow=True)
+        self.assertRedirects(r, order.get_absolute_url())
+        self.assertContains(r, 'Refreshing the order from Shopify')
+        self.assertContains(r, 'Products ordered')
+        assert mock_shopify.call_count == 1
+
+        assert (
+            self.client.post(reverse('order-refresh', args=[OrderFactory(company=self.company).id])).status_code == 404
+        )
+        assert self.client.post(reverse('order-refresh', args=[OrderFactory(shopify_id=789).id])).status_code == 404
+
     def test_order_deets_fulfilled(self):
         order = OrderFactory(company=self.company, status=Order.STATUS_FULFILLED)
         r = self.client.get(order.get_absolute_url())
@@ -323,22 +370,30 @@ class OrderTestCase(SVTestCase):
         r = self.client.get(order.get_absolute_url())
         self.assertNotContains(r, 'Fulfill with')
         self.assertContains(r, 'View in Shopify')
+        # The order hasn't been fetched from Shopify yet, so it's fetched in the background for next time.
+        self.assertNotContains(r, 'Products ordered')
+        r = self.client.get(order.get_absolute_url())
         self.assertContains(r, 'Products ordered')
 
     @mock.patch('SalsaVerde.orders.views.shopify.session.request')
     def test_add_product_batch_codes(self, mock_shopify):
         mock_shopify.side_effect = fake_shopify()
         order = OrderFactory(company=self.company, shopify_id=456)
+        update_order_details(order.id, self.company.id)
         r = self.client.get(reverse('order-packed-product', args=[order.id]))
         self.assertContains(r, 'Bramley apple')
         p1 = ProductFactory(product_type__company=self.company, product_type__name='Foo')
         p2 = ProductFactory(product_type__company=self.company, product_type__name='Bar')
+        p1_size = p1.yield_containers.first().container.container_type
+        p2_size = p2.yield_containers.first().container.container_type
         formset_data = empty_formset('form')
         formset_data['form-TOTAL_FORMS'] = 2
         form_data = {
             'form-0-product': p1.id,
+            'form-0-container_type': p1_size.id,
             'form-0-quantity': 2,
             'form-1-product': p2.id,
+            'form-1-container_type': p2_size.id,
             'form-1-quantity': 3,
             **formset_data,
         }
@@ -353,8 +408,10 @@ class OrderTestCase(SVTestCase):
         # Now delete one
         form_data = {
             'form-0-product': p1.id,
+            'form-0-container_type': p1_size.id,
             'form-0-quantity': 0,
             'form-1-product': p2.id,
+            'form-1-container_type': p2_size.id,
             'form-1-quantity': 1,
             **formset_data,
         }
@@ -365,6 +422,84 @@ class OrderTestCase(SVTestCase):
         self.assertNotContains(r, 'Foo')
         self.assertContains(r, 'Bar')
 
+    @mock.patch('SalsaVerde.orders.views.shopify.session.request')
+    def test_packed_product_inventory(self, mock_shopify):
+        mock_shopify.side_effect = fake_shopify()
+        order = OrderFactory(company=self.company, shopify_id=456)
+        url = reverse('order-packed-product', args=[order.id])
+        product = ProductFactory(
+            product_type__company=self.company, product_type__name='Foo', yield_container_2=None, batch_code='FOO1'
+        )
+        size = product.yield_containers.get().container.container_type
+        sold_out = ProductFactory(
+            product_type__company=self.company, product_type__name='Gone', yield_container_2=None, batch_code='GONE1'
+        )
+        ProductOrder.objects.create(
+            order=OrderFactory(company=self.company),
+            product=sold_out,
+            container_type=sold_out.yield_containers.get().container.container_type,
+            quantity=10,
+        )
+        r = self.client.get(url)
+        # Only the selected batch is in the page, the others are searched for.
+        search_url = reverse('autocomplete', args=['PackedProductForm', 'product'])
+        self.assertContains(r, f'{search_url}?order={order.pk}')
+        self.assertNotContains(r, 'FOO1')
+        r = self.client.get(search_url, data={'order': order.pk})
+        assert [p['text'] for p in r.json()['results']] == [f'Foo - FOO1 ({size.name}: 10 available)']
+
+        formset_data = empty_formset('form')
+        formset_data['form-TOTAL_FORMS'] = 1
+        r = self.client.post(url, data={'form-0-product': product.id, 'form-0-quantity': 11, **formset_data})
+        self.assertContains(r, f'Only 10 of this batch left in {size.name}')
+
+        # The size is filled in when the batch was only bottled in one.
+        r = self.client.post(url, data={'form-0-product': product.id, 'form-0-quantity': 4, **formset_data})
+        self.assertRedirects(r, order.get_absolute_url())
+        assert order.products.get().container_type == size
+        inventory = ProductInventory.objects.get(product=product)
+        assert (inventory.bottled, inventory.packed, inventory.available) == (10, 4, 6)
+
+        # Editing the order replaces what it packed, so all 10 can be packed into it.
+        r = self.client.get(url)
+        self.assertContains(r, f'FOO1 ({size.name}: 6 available)')
+        r = self.client.post(url, data={'form-0-product': product.id, 'form-0-quantity': 10, **formset_data})
+        self.assertRedirects(r, order.get_absolute_url())
+        inventory.refresh_from_db()
+        assert inventory.available == 0
+        r = self.client.get(url)
+        self.assertContains(r, 'FOO1')
+
+        # Rows packing the same batch are checked against the stock together.
+        formset_data['form-TOTAL_FORMS'] = 2
+        rows = {'form-0-product': product.id, 'form-1-product': product.id, 'form-1-container_type': size.id}
+        r = self.client.post(url, data={**rows, 'form-0-quantity': 6, 'form-1-quantity': 5, **formset_data})
+        self.assertContains(r, f'Only 10 of this batch left in {size.name} across all the rows')
+        assert order.products.get().quantity == 10
+        with CaptureQueriesContext(connection) as queries:
+            r = self.client.post(url, data={**rows, 'form-0-quantity': 6, 'form-1-quantity': 4, **formset_data})
+        assert any('FOR UPDATE' in q['sql'] for q in queries.captured_queries)
+        self.assertRedirects(r, order.get_absolute_url())
+        assert sorted(order.products.values_list('quantity', flat=True)) == [4, 6]
+
+        order.products.all().delete()
+        inventory.refresh_from_db()
+        assert inventory.packed == 0
+
+        # A batch with nothing left can't be packed without a size either. Packed into this order before it was
+        # recorded by size, it can be packed again up to what was packed.
+        ProductOrder.objects.create(order=order, product=sold_out, quantity=2)
+        formset_data['form-TOTAL_FORMS'] = 1
+        r = self.client.post(url, data={'form-0-product': sold_out.id, 'form-0-quantity': 3, **formset_data})
+        self.assertContains(r, 'Only 2 of this batch left')
+        r = self.client.post(url, data={'form-0-product': sold_out.id, 'form-0-quantity': 2, **formset_data})
+        self.assertRedirects(r, order.get_absolute_url())
+        request = RequestFactory().get(url)
+        request.user = self.client.user
+        form = PackedProductForm({'product': sold_out.id, 'quantity': 1}, request=request, order=OrderFactory())
+        form.fields['product'].queryset = Product.objects.all()
+        assert form.errors == {'quantity': ['None of this batch left']}
+
     def test_remove_null_vals(self):
         from SalsaVerde.orders.views.dhl import remove_null_vals
 
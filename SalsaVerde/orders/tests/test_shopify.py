@@ -1,16 +1,37 @@
 import hashlib
 import hmac
 import json
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from io import StringIO
 from unittest import mock
 
-from django.test import Client
+import django_rq
+import requests
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import Client, override_settings
 from django.urls import reverse
 from django.utils.text import slugify
+from django.utils.timezone import now
+from rq.job import Job
+from rq.registry import ScheduledJobRegistry
 
 from SalsaVerde.common.tests import SVTestCase
-from SalsaVerde.company.models import User
-from SalsaVerde.orders.models import Order
-from SalsaVerde.orders.tests.mock_objs import fake_shopify
+from SalsaVerde.company.models import Company, User
+from SalsaVerde.orders.models import Order, ShopifyEvent
+from SalsaVerde.orders.shopify import (
+    SYNC_JOB_KEY,
+    ShopifySyncError,
+    process_shopify_events,
+    sync_changed_orders,
+    sync_orders,
+    upsert_orders,
+)
+from SalsaVerde.orders.tests.mock_objs import ShopifyStandIn, fake_shopify
+from SalsaVerde.orders.views.shopify import SHOPIFY_RETRIES, ShopifyBucket, session, shopify_request
 from SalsaVerde.stock.factories.company import CompanyFactory
 from SalsaVerde.stock.factories.users import UserFactory
 
@@ -38,8 +59,7 @@ class ShopifyWebhookTestCase(SVTestCase):
             HTTP_X_SHOPIFY_HMAC_SHA256=sig,
             content_type='application/json',
         )
-        # assert r.status_code == 403
-        assert r.status_code == 220
+        assert r.status_code == 403
         r = Client().post(
             self.callback_url,
             data={'foo': 'bar'},
@@ -47,8 +67,8 @@ class ShopifyWebhookTestCase(SVTestCase):
             HTTP_X_SHOPIFY_HMAC_SHA256='FOOBAR',
             content_type='application/json',
         )
-        # assert r.status_code == 403
-        assert r.status_code == 220
+        assert r.status_code == 403
+        assert not ShopifyEvent.objects.exists()
 
     def test_callback_company_doesnt_exist(self):
         r = Client().post(
@@ -60,7 +80,7 @@ class ShopifyWebhookTestCase(SVTestCase):
         )
         assert r.status_code == 299
 
-    def callback_request(self, data, event):
+    def callback_request(self, data, event, webhook_id=None):
         body = json.dumps(data)
         sig = hmac.new(self.company.shopify_webhook_key.encode(), body.encode(), hashlib.sha256).hexdigest()
         return Client().post(
@@ -69,6 +89,7 @@ class ShopifyWebhookTestCase(SVTestCase):
             HTTP_X_SHOPIFY_SHOP_DOMAIN=self.company.shopify_domain,
             HTTP_X_SHOPIFY_HMAC_SHA256=sig,
             HTTP_X_SHOPIFY_TOPIC=event,
+            HTTP_X_SHOPIFY_WEBHOOK_ID=webhook_id or uuid.uuid4().hex,
             content_type='application/json',
         )
 
@@ -83,7 +104,7 @@ class ShopifyWebhookTestCase(SVTestCase):
     def test_order_created_new_user(self, mock_shopify, mock_logger):
         mock_shopify.side_effect = fake_shopify()
         r = self.callback_request({'id': '123'}, 'orders/create')
-        assert r.status_code == 212
+        assert r.status_code == 200
         order = Order.objects.get()
         assert order.shopify_id == '123'
         assert order.company == self.company
@@ -91,7 +112,8 @@ class ShopifyWebhookTestCase(SVTestCase):
         assert user.get_full_name() == 'Brain Johnston'
         assert not user.administrator
         assert user.email == 'brain_johnston@fakemail.com'
-        mock_logger.assert_called_with('Shopify event status %s:%s', 212, 'Order 123 created')
+        mock_logger.assert_called_with('Shopify event status %s:%s', 200, 'Event orders/create 123 received')
+        assert ShopifyEvent.objects.get().processed
         assert not user.has_usable_password()
         assert order.user == user
         assert order.status == Order.STATUS_UNFULFILLED
@@ -144,7 +166,7 @@ class ShopifyWebhookTestCase(SVTestCase):
     def test_order_created_fulfilled_new_user_no_email(self, mock_shopify, mock_logger):
         mock_shopify.side_effect = fake_shopify()
         r = self.callback_request({'id': '456'}, 'orders/create')
-        assert r.status_code == 212
+        assert r.status_code == 200
         order = Order.objects.get()
         assert order.shopify_id == '456'
         assert order.company == self.company
@@ -152,8 +174,7 @@ class ShopifyWebhookTestCase(SVTestCase):
         assert user.get_full_name() == 'Tom Jones'
         assert not user.administrator
         assert user.email == 'tom_jones@inactive.salsa-verde.com'
-        calls = [c[0] for c in mock_logger.call_args_list]
-        assert calls[1] == ('Updated order %s with shopify data', order.id)
+        mock_logger.assert_any_call('Processed %d Shopify events for %d orders of %s', 1, 1, self.company)
         assert not user.has_usable_password()
         assert order.user == user
         assert order.status == Order.STATUS_FULFILLED
@@ -166,12 +187,13 @@ class ShopifyWebhookTestCase(SVTestCase):
 
         order = Order.objects.create(company=self.company, shopify_id='456', user=user, status=Order.STATUS_UNFULFILLED)
         r = self.callback_request({'id': '456'}, 'orders/updated')
-        assert r.status_code == 210
+        assert r.status_code == 200
         order = Order.objects.get(id=order.id)
         assert order.shopify_id == '456'
         assert order.user == user
         assert order.status == Order.STATUS_FULFILLED
-        mock_logger.assert_called_with('Shopify event status %s:%s', 210, 'Order 456 updated')
+        assert order.shopify_synced
+        mock_logger.assert_called_with('Shopify event status %s:%s', 200, 'Event orders/updated 456 received')
 
     @mock.patch('SalsaVerde.orders.views.shopify.session.request')
     def test_order_created_no_user(self, mock_shopify):
@@ -181,7 +203,7 @@ class ShopifyWebhookTestCase(SVTestCase):
 
         order = Order.objects.create(company=self.company, shopify_id='123', status=Order.STATUS_UNFULFILLED)
         r = self.callback_request({'id': '123'}, 'orders/updated')
-        assert r.status_code == 210
+        assert r.status_code == 200
         order = Order.objects.get(id=order.id)
         assert order.shopify_id == '123'
         assert not order.user
@@ -191,8 +213,15 @@ class ShopifyWebhookTestCase(SVTestCase):
     def test_order_created_already_exists(self, mock_shopify):
         mock_shopify.side_effect = fake_shopify()
         Order.objects.create(company=self.company, shopify_id='123', status=Order.STATUS_UNFULFILLED)
-        r = self.callback_request({'id': '123'}, 'orders/create')
-        assert r.status_code == 213
+        r = self.callback_request({'id': '123'}, 'orders/create', webhook_id='abc')
+        assert r.status_code == 200
+        assert Order.objects.get().extra_data['name'] == '#123'
+        # Shopify sending it again.
+        r = self.callback_request({'id': '123'}, 'orders/create', webhook_id='abc')
+        assert r.status_code == 200
+        assert r.content == b'Event orders/create 123 already received'
+        assert ShopifyEvent.objects.count() == 1
+        assert mock_shopify.call_count == 1
 
     @mock.patch('SalsaVerde.orders.views.shopify.session.request')
     def test_order_created_update_user(self, mock_shopify):
@@ -206,7 +235,7 @@ class ShopifyWebhookTestCase(SVTestCase):
         )
         order = Order.objects.create(company=self.company, shopify_id='123', status=Order.STATUS_UNFULFILLED)
         r = self.callback_request({'id': '123'}, 'orders/updated')
-        assert r.status_code == 210
+        assert r.status_code == 200
         order = Order.objects.get(id=order.id)
         assert order.shopify_id == '123'
         assert order.user == user
@@ -220,9 +249,346 @@ class ShopifyWebhookTestCase(SVTestCase):
 
         order = Order.objects.create(company=self.company, shopify_id='123', user=user, status=Order.STATUS_UNFULFILLED)
         r = self.callback_request({'id': '123'}, 'orders/cancelled')
-        assert r.status_code == 211
+        assert r.status_code == 200
         order = Order.objects.get(id=order.id)
         assert order.shopify_id == '123'
         assert order.user == user
         assert order.status == Order.STATUS_CANCELLED
-        mock_logger.assert_called_with('Shopify event status %s:%s', 211, 'Order 123 deleted')
+        mock_logger.assert_called_with('Shopify event status %s:%s', 200, 'Event orders/cancelled 123 received')
+        assert not mock_shopify.called
+
+    @override_settings(SHOPIFY_EVENT_DELAY=5)
+    @mock.patch('SalsaVerde.orders.views.shopify.session.request')
+    def test_events_coalesced(self, mock_shopify):
+        mock_shopify.side_effect = fake_shopify()
+        cancelled = Order.objects.create(company=self.company, shopify_id='789', status=Order.STATUS_UNFULFILLED)
+        registry = ScheduledJobRegistry(queue=django_rq.get_queue())
+        self.addCleanup(lambda: [registry.remove(job_id, delete_job=True) for job_id in registry.get_job_ids()])
+        for topic in ['orders/create', 'orders/paid', 'orders/updated', 'orders/fulfilled']:
+            assert self.callback_request({'id': '123'}, topic).status_code == 200
+            assert self.callback_request({'id': '456'}, topic).status_code == 200
+        assert self.callback_request({'id': '789'}, 'orders/updated').status_code == 200
+        assert self.callback_request({'id': '789'}, 'orders/delete').status_code == 200
+        assert self.callback_request({'id': '789'}, 'orders/delete').status_code == 200
+        # Stored to be processed in one go once they've stopped coming.
+        assert not Order.objects.filter(shopify_id__in=['123', '456']).exists()
+        assert ShopifyEvent.objects.filter(processed__isnull=True).count() == 11
+        assert len(registry.get_job_ids()) == 1
+
+        process_shopify_events(self.company.id)
+        # 123 and 456 fetched together, and 789 was deleted so it isn't fetched.
+        assert mock_shopify.call_count == 1
+        assert 'ids=123%2C456' in mock_shopify.call_args.args[1]
+        assert Order.objects.get(shopify_id='123').status == Order.STATUS_UNFULFILLED
+        assert Order.objects.get(shopify_id='456').status == Order.STATUS_FULFILLED
+        cancelled.refresh_from_db()
+        assert cancelled.status == Order.STATUS_CANCELLED
+        assert not ShopifyEvent.objects.filter(processed__isnull=True).exists()
+
+        # The next webhook is queued again, and old ones are cleared out.
+        ShopifyEvent.objects.update(processed=now() - timedelta(days=8))
+        assert self.callback_request({'id': '456'}, 'orders/paid').status_code == 200
+        assert len(registry.get_job_ids()) == 2
+        process_shopify_events(self.company.id)
+        assert mock_shopify.call_count == 2
+        assert ShopifyEvent.objects.count() == 1
+
+    @mock.patch('SalsaVerde.orders.views.shopify.session.request')
+    def test_events_fail(self, mock_shopify):
+        mock_shopify.side_effect = fake_shopify(error=True)
+        registry = ScheduledJobRegistry(queue=django_rq.get_queue())
+        self.addCleanup(lambda: [registry.remove(job_id, delete_job=True) for job_id in registry.get_job_ids()])
+        # The job fails, not the webhook, and it's tried again later.
+        assert self.callback_request({'id': '123'}, 'orders/create').status_code == 200
+        assert ShopifyEvent.objects.get().processed is None
+        assert not Order.objects.exists()
+        (job_id,) = registry.get_job_ids()
+
+        # The next one waits for the retry, which processes them both.
+        mock_shopify.side_effect = fake_shopify()
+        assert self.callback_request({'id': '456'}, 'orders/create').status_code == 200
+        assert not Order.objects.exists()
+        assert registry.get_job_ids() == [job_id]
+        Job.fetch(job_id, connection=django_rq.get_connection()).perform()
+        assert set(Order.objects.values_list('shopify_id', flat=True)) == {'123', '456'}
+        assert not ShopifyEvent.objects.filter(processed__isnull=True).exists()
+
+        # Once it's finished the next webhook is processed straight away.
+        assert self.callback_request({'id': '123'}, 'orders/cancelled').status_code == 200
+        assert Order.objects.get(shopify_id='123').status == Order.STATUS_CANCELLED
+
+    def test_invalid_data(self):
+        assert self.callback_request(['foo'], 'orders/create').status_code == 400
+        assert not ShopifyEvent.objects.exists()
+
+
+class ShopifyClientTestCase(SVTestCase):
+    def setUp(self):
+        self.company = CompanyFactory(shopify_api_key='Fookey', shopify_password='Foopass')
+        cache.delete(f'shopify-bucket:{self.company.pk}')
+
+    def request(self, stand_in, **kwargs):
+        with override_settings(SHOPIFY_BASE_URL=stand_in.url):
+            return shopify_request('orders.json', data={'limit': 250}, company=self.company, **kwargs)
+
+    def test_stand_in_rate_limits(self):
+        with ShopifyStandIn(bucket_size=10, leak_rate=1) as stand_in:
+            for _ in range(15):
+                requests.get(f'{stand_in.url}/orders.json', auth=('Fookey', 'Foopass'))
+        assert stand_in.rate_limited >= 4
+
+    @mock.patch('SalsaVerde.orders.views.shopify.SHOPIFY_BUCKET_DRAIN_SECONDS', 0.5)
+    def test_paced_within_limit(self):
+        # A bucket of 10 that drains in half a second.
+        with ShopifyStandIn(bucket_size=10, leak_rate=20) as stand_in:
+            start = time.monotonic()
+            results = [self.request(stand_in) for _ in range(30)]
+            elapsed = time.monotonic() - start
+        assert results == [(True, {'orders': []})] * 30
+        assert stand_in.rate_limited == 0
+        # The calls that didn't fit in the bucket waited for it to leak.
+        assert elapsed >= (30 - 10) / 20
+
+    @mock.patch('SalsaVerde.orders.views.shopify._sleep')
+    def test_retry_with_backoff(self, mock_sleep):
+        with ShopifyStandIn(fail=2) as stand_in:
+            assert self.request(stand_in) == (True, {'orders': []})
+        assert stand_in.requests == 3
+        first, second = (c.args[0] for c in mock_sleep.call_args_list)
+        assert 0 <= first <= 0.5
+        assert 0 <= second <= 1
+
+    @mock.patch('SalsaVerde.orders.views.shopify._sleep')
+    def test_retry_after(self, mock_sleep):
+        with ShopifyStandIn(fail=1, fail_status=429, retry_after='2.0') as stand_in:
+            assert self.request(stand_in) == (True, {'orders': []})
+        mock_sleep.assert_called_once_with(2)
+
+    @mock.patch('SalsaVerde.orders.views.shopify._sleep')
+    def test_gives_up(self, mock_sleep):
+        with ShopifyStandIn(fail=100) as stand_in:
+            success, error = self.request(stand_in, max_wait=100)
+        assert not success
+        assert stand_in.requests == SHOPIFY_RETRIES + 1
+
+        with ShopifyStandIn(fail=1, fail_status=404) as stand_in:
+            assert not self.request(stand_in)[0]
+        assert stand_in.requests == 1
+
+        # Waiting longer for the next retry than the request can wait.
+        with ShopifyStandIn(fail=1, fail_status=429, retry_after='10') as stand_in:
+            assert not self.request(stand_in)[0]
+        assert stand_in.requests == 1
+
+    @mock.patch('SalsaVerde.orders.views.shopify._sleep')
+    def test_full_bucket(self, mock_sleep):
+        cache.set(f'shopify-bucket:{self.company.pk}', (40, 40, time.time()))
+        with ShopifyStandIn() as stand_in:
+            assert self.request(stand_in, max_wait=1) == (False, 'Shopify rate limit reached')
+            assert stand_in.requests == 0
+            assert self.request(stand_in) == (True, {'orders': []})
+        # It waited for 3 calls to leak: the one made and the headroom.
+        self.assertAlmostEqual(mock_sleep.call_args.args[0], (40 + 1 - 38) / 2, delta=0.1)
+
+    @mock.patch('SalsaVerde.orders.views.shopify.time')
+    def test_bucket_slots_not_shared(self, mock_time):
+        mock_time.time.return_value = 1000
+        cache.set(f'shopify-bucket:{self.company.pk}', (38, 40, 1000))
+        bucket = ShopifyBucket(self.company)
+        with ThreadPoolExecutor(8) as executor:
+            waits = sorted(executor.map(lambda _: bucket.wait_for_call(100), range(16)))
+        # Every call waited for a slot of its own, half a second apart as the bucket leaks 2 a second.
+        assert waits == [(i + 1) / 2 for i in range(16)]
+
+    def test_bucket_update_keeps_reserved(self):
+        bucket = ShopifyBucket(self.company)
+        for _ in range(30):
+            bucket.wait_for_call(100)
+        r = requests.Response()
+        r.headers['X-Shopify-Shop-Api-Call-Limit'] = '3/40'
+        bucket.update(r)
+        # The calls reserved but not yet made are still counted.
+        self.assertAlmostEqual(cache.get(bucket.key)[0], 30, delta=0.5)
+        r.headers['X-Shopify-Shop-Api-Call-Limit'] = '36/40'
+        bucket.update(r)
+        self.assertAlmostEqual(cache.get(bucket.key)[0], 36, delta=0.5)
+
+    def test_session_per_shop(self):
+        assert session.for_shop(1) is session.for_shop(1)
+        assert session.for_shop(1) is not session.for_shop(2)
+
+
+class ShopifySyncTestCase(SVTestCase):
+    def setUp(self):
+        self.company = CompanyFactory(name='Burren', shopify_api_key='Fookey', shopify_password='Foopass')
+        cache.delete(f'shopify-bucket:{self.company.pk}')
+        template = fake_shopify().orders[0]
+        # The first 100 were last updated before the first sync goes back to.
+        updated = now() - timedelta(days=10)
+        self.orders = []
+        for i in range(600):
+            if i % 3:
+                customer = {'first_name': f'name{i % 7}', 'last_name': 'smith'}
+            else:
+                customer = {'first_name': 'Cus', 'last_name': f'Tomer{i % 10}', 'email': f'cust{i % 10}@example.com'}
+            self.orders.append(
+                {
+                    **template,
+                    'id': 1000 + i,
+                    'name': f'#{1000 + i}',
+                    'created_at': f'2020-08-{i % 28 + 1:02}T08:47:12+01:00',
+                    'updated_at': (updated + timedelta(days=3 * (i >= 100), minutes=i)).isoformat(),
+                    'fulfillment_status': 'fulfilled' if i % 2 else None,
+                    'customer': customer,
+                }
+            )
+
+    def tearDown(self):
+        registry = ScheduledJobRegistry(queue=django_rq.get_queue())
+        for job_id in registry.get_job_ids():
+            registry.remove(job_id, delete_job=True)
+
+    @mock.patch('SalsaVerde.orders.shopify.update_order_details.delay')
+    def test_sync_orders(self, mock_update):
+        customer = UserFactory(company=self.company, email='cust0@example.com', administrator=False)
+        cancelled = Order.objects.create(
+            company=self.company, shopify_id='1001', status=Order.STATUS_CANCELLED, user=customer
+        )
+        unfulfilled = Order.objects.create(company=self.company, shopify_id='1005', status=Order.STATUS_UNFULFILLED)
+        other_company = Order.objects.create(company=CompanyFactory(), shopify_id='1003')
+        users = User.objects.count()
+
+        with ShopifyStandIn(orders=self.orders) as stand_in:
+            with override_settings(SHOPIFY_BASE_URL=stand_in.url):
+                assert sync_orders(self.company, created_at_min='2020-08-01') == 599
+        # Every order in 3 pages, and none of them fetched again.
+        assert stand_in.requests == 3
+        assert not mock_update.called
+        first, *rest = stand_in.paths
+        assert 'created_at_min=' in first
+        assert 'fields=name%2Cbilling_address' in first
+        assert all('page_info=' in path and 'created_at_min' not in path for path in rest)
+
+        orders = Order.objects.filter(company=self.company)
+        assert orders.count() == 599
+        order = orders.get(shopify_id='1000')
+        assert order.extra_data == {**self.orders[0], 'id': 1000}
+        assert order.created == datetime(2020, 8, 1, 7, 47, 12, tzinfo=timezone.utc)
+        assert order.shopify_synced
+        assert order.user == customer
+        assert orders.get(shopify_id='1007').status == Order.STATUS_FULFILLED
+        assert orders.get(shopify_id='1002').status == Order.STATUS_UNFULFILLED
+
+        cancelled.refresh_from_db()
+        assert (cancelled.status, cancelled.user) == (Order.STATUS_CANCELLED, customer)
+        unfulfilled.refresh_from_db()
+        assert unfulfilled.status == Order.STATUS_FULFILLED
+        assert unfulfilled.user.email == 'name5_smith@inactive.burren.com'
+        other_company.refresh_from_db()
+        assert other_company.extra_data == {}
+
+        # A user for each of the other 9 emails and the 7 names.
+        assert User.objects.count() == users + 16
+        assert not orders.filter(user__isnull=True).exists()
+        user = User.objects.get(email='name1_smith@inactive.burren.com')
+        assert (user.first_name, user.last_name, user.has_usable_password()) == ('Name1', 'Smith', False)
+
+    def test_upsert_queries(self):
+        UserFactory(
+            company=self.company,
+            email='name1_smith@inactive.burren.com',
+            first_name='Name1',
+            last_name='Smith',
+            administrator=False,
+        )
+        upsert_orders(self.orders[:10], self.company)
+        # The same queries however many orders and customers there are.
+        with self.assertNumQueries(9):
+            upsert_orders(self.orders, self.company)
+        user = User.objects.get(first_name='Cus', last_name='Tomer1')
+        assert user.email == 'cust1@example.com'
+
+        # Orders keep their user.
+        self.orders[4]['customer']['email'] = 'name4@example.com'
+        order_id = upsert_orders([self.orders[4]], self.company)
+        assert Order.objects.get(id=order_id[0]).user.email == 'name4_smith@inactive.burren.com'
+        # A user without an email found by name gets the customer's.
+        self.orders[1]['customer']['email'] = 'Name1@example.com'
+        Order.objects.filter(shopify_id='1001').update(user=None)
+        upsert_orders([self.orders[1]], self.company)
+        assert Order.objects.get(shopify_id='1001').user.email == 'name1@example.com'
+
+    def test_sync_fails(self):
+        with ShopifyStandIn(fail=1, fail_status=404, orders=self.orders) as stand_in:
+            with override_settings(SHOPIFY_BASE_URL=stand_in.url):
+                with self.assertRaises(ShopifySyncError):
+                    sync_orders(self.company)
+        assert not Order.objects.exists()
+
+    def test_scheduled_sync(self):
+        # Companies without Shopify set up aren't synced.
+        CompanyFactory(shopify_api_key='', shopify_password='')
+        CompanyFactory(shopify_api_key='Fookey', shopify_password='')
+        CompanyFactory(shopify_api_key='', shopify_password='Foopass')
+        with ShopifyStandIn(orders=self.orders) as stand_in, override_settings(SHOPIFY_BASE_URL=stand_in.url):
+            out = StringIO()
+            call_command('update_shopify_orders', stdout=out)
+            assert out.getvalue() == 'Shopify sync scheduled\n'
+            # The orders updated in the last week, in 2 pages.
+            assert stand_in.requests == 2
+            assert Company.objects.filter(shopify_synced_to__isnull=False).get() == self.company
+            assert Order.objects.count() == 500
+            self.company.refresh_from_db()
+            assert self.company.shopify_synced_to == datetime.fromisoformat(self.orders[-1]['updated_at'])
+            job_id = cache.get(SYNC_JOB_KEY)
+            assert ScheduledJobRegistry(queue=django_rq.get_queue()).get_job_ids() == [job_id]
+
+            # With nothing changed, only the last order is fetched again.
+            assert sync_changed_orders(self.company) == 1
+            assert stand_in.requests == 3
+
+            self.orders[10].update(fulfillment_status='fulfilled', updated_at=now().isoformat())
+            self.orders[200].update(name='#Changed', updated_at=now().isoformat())
+            assert sync_changed_orders(self.company) == 3
+            assert stand_in.requests == 4
+            assert Order.objects.get(shopify_id='1010').status == Order.STATUS_FULFILLED
+            assert Order.objects.get(shopify_id='1200').extra_data['name'] == '#Changed'
+            self.company.refresh_from_db()
+            assert self.company.shopify_synced_to == datetime.fromisoformat(self.orders[200]['updated_at'])
+
+            # Scheduling it again replaces the scheduled sync, which stops when it runs.
+            call_command('update_shopify_orders', stdout=StringIO())
+            assert stand_in.requests == 5
+            assert cache.get(SYNC_JOB_KEY) != job_id
+            Job.fetch(job_id, connection=django_rq.get_connection()).perform()
+            assert stand_in.requests == 5
+
+    def test_scheduled_sync_stale_events(self):
+        Company.objects.filter(id=self.company.id).update(shopify_synced_to=now())
+        other_company = CompanyFactory()
+        for webhook_id, company, shopify_id in [('1', self.company, '1100'), ('2', other_company, '1101')]:
+            Order.objects.create(company=company, shopify_id=shopify_id, status=Order.STATUS_UNFULFILLED)
+            ShopifyEvent.objects.create(
+                company=company, webhook_id=webhook_id, topic='orders/cancelled', shopify_id=shopify_id, data={}
+            )
+        ShopifyEvent.objects.filter(webhook_id='1').update(received=now() - timedelta(minutes=11))
+        with ShopifyStandIn(orders=self.orders) as stand_in, override_settings(SHOPIFY_BASE_URL=stand_in.url):
+            call_command('update_shopify_orders', stdout=StringIO())
+        # Only the webhook that's been waiting too long is processed.
+        assert Order.objects.get(shopify_id='1100').status == Order.STATUS_CANCELLED
+        assert Order.objects.get(company=other_company).status == Order.STATUS_UNFULFILLED
+        assert list(ShopifyEvent.objects.filter(processed__isnull=True).values_list('webhook_id', flat=True)) == ['2']
+
+    @mock.patch('SalsaVerde.orders.shopify.logger.error')
+    def test_scheduled_sync_fails(self, mock_logger):
+        synced_to = now() - timedelta(days=1)
+        Company.objects.filter(id=self.company.id).update(shopify_synced_to=synced_to)
+        with ShopifyStandIn(fail=1, fail_status=404, orders=self.orders) as stand_in:
+            with override_settings(SHOPIFY_BASE_URL=stand_in.url):
+                call_command('update_shopify_orders', stdout=StringIO())
+        assert stand_in.requests == 1
+        assert mock_logger.call_args.args[1].args[0].startswith('Error syncing Shopify orders for Burren')
+        self.company.refresh_from_db()
+        assert self.company.shopify_synced_to == synced_to
+        # It's tried again next time.
+        assert ScheduledJobRegistry(queue=django_rq.get_queue()).get_job_ids() == [cache.get(SYNC_JOB_KEY)]
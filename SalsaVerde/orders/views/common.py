@@ -1,14 +1,17 @@
 from django.contrib import messages
-from django.shortcuts import redirect
+from django.db import transaction
+from django.shortcuts import get_object_or_404, redirect
 from django.urls import reverse
 from django.utils.safestring import mark_safe
+from django.views.decorators.http import require_POST
 from django.views.generic import TemplateView
 
 from SalsaVerde.common.views import DetailView, ModelListView, UpdateModelView
 from SalsaVerde.orders.forms.common import PackageFormSet, PackedProductFormSet
 from SalsaVerde.orders.models import Order, PackageTemplate, ProductOrder
-from SalsaVerde.orders.shopify import shopify_fulfill_order
-from SalsaVerde.orders.views.shopify import ShopifyHelperMixin, get_shopify_order
+from SalsaVerde.orders.shopify import get_order_data, shopify_fulfill_order, update_order_details
+from SalsaVerde.orders.views.shopify import ShopifyHelperMixin
+from SalsaVerde.stock.models import TraceLink
 
 
 class CreateShipmentError(Exception):
@@ -72,7 +75,11 @@ class OrdersList(ShopifyHelperMixin, ModelListView):
         ('Status', 'get_status_display'),
         ('Location', 'func|get_location'),
     ]
+    select_related = ['user']
     icon = 'fa-store'
+    keyset_pagination = True
+    cache_rows = True
+    stream_response = True
 
     def get_button_menu(self):
         return []
@@ -108,6 +115,11 @@ class OrderDetails(ShopifyHelperMixin, DetailView):
 
     def get_button_menu(self):
         yield {'name': 'Back', 'url': reverse('orders-list')}
+        yield {
+            'name': 'Trace',
+            'url': reverse('trace', kwargs={'node_type': TraceLink.NODE_ORDER, 'pk': self.object.pk}),
+            'icon': 'fa-route',
+        }
         if self.object.shopify_id:
             yield {
                 'name': 'View in Shopify',
@@ -115,6 +127,12 @@ class OrderDetails(ShopifyHelperMixin, DetailView):
                 'newtab': True,
                 'icon': 'fa-shopping-basket',
             }
+            yield {
+                'name': 'Refresh from Shopify',
+                'url': reverse('order-refresh', kwargs={'pk': self.object.pk}),
+                'method': 'POST',
+                'icon': 'fa-sync',
+            }
         if self.object.status == Order.STATUS_UNFULFILLED:
             yield {
                 'name': 'Fulfill with ExpressFreight',
@@ -137,16 +155,20 @@ class OrderDetails(ShopifyHelperMixin, DetailView):
                 yield {'name': f'Shipping Label {i + 1}', 'url': label.file.url, 'newtab': True}
 
     def get_context_data(self, **kwargs):
-        ctx = super().get_context_data(**kwargs)
-        if shopify_order := self.object.shopify_id:
-            _, order_data = get_shopify_order(shopify_order, company=self.request.user.company)
-            ctx.update(order_data=order_data['order'])
-        return ctx
+        return super().get_context_data(order_data=get_order_data(self.object), **kwargs)
 
 
 order_details = OrderDetails.as_view()
 
 
+@require_POST
+def order_refresh(request, pk):
+    order = get_object_or_404(Order.objects.request_qs(request).filter(shopify_id__isnull=False), pk=pk)
+    update_order_details.delay(order.pk, order.company_id)
+    messages.success(request, 'Refreshing the order from Shopify')
+    return redirect(order.get_absolute_url())
+
+
 class OrderUpdatePackedProduct(ShopifyHelperMixin, UpdateModelView):
     form_class = PackedProductFormSet
     title = 'Record product'
@@ -156,29 +178,39 @@ class OrderUpdatePackedProduct(ShopifyHelperMixin, UpdateModelView):
     def get_form_kwargs(self):
         form_kwargs = super().get_form_kwargs()
         form_kwargs.pop('instance')
+        form_kwargs['form_kwargs'] = {'order': self.object}
         return form_kwargs
 
     def get_initial(self):
         return [
-            {'product': po.product, 'quantity': po.quantity}
-            for po in self.object.products.select_related('product', 'product__product_type')
+            {'product': po.product, 'container_type': po.container_type, 'quantity': po.quantity}
+            for po in self.object.products.select_related('product', 'product__product_type', 'container_type')
         ]
 
     def form_valid(self, formset):
-        self.object.products.all().delete()
-        for form in formset.forms:
-            cd = form.cleaned_data
-            if cd.get('quantity'):
-                ProductOrder.objects.create(order=self.object, product=cd['product'], quantity=cd['quantity'])
+        # The product inventory is updated as the products are removed and added, so it all happens or none of it does.
+        with transaction.atomic():
+            # The stock is checked again with the inventory locked, otherwise another order saved since the formset was
+            # validated could have packed it.
+            if not formset.check_stock(lock=True):
+                return self.form_invalid(formset)
+            self.object.products.all().delete()
+            for form in formset.forms:
+                cd = form.cleaned_data
+                if cd.get('quantity'):
+                    ProductOrder.objects.create(
+                        order=self.object,
+                        product=cd['product'],
+                        container_type=cd.get('container_type'),
+                        quantity=cd['quantity'],
+                    )
         return redirect(self.object.get_absolute_url())
 
     def get_context_data(self, **kwargs):
-        ctx = super().get_context_data(**kwargs)
-        if self.object.shopify_id:
-            _, order_data = get_shopify_order(self.object.shopify_id, company=self.request.user.company)
-            ctx['order_data'] = order_data['order']
+        ctx = super().get_context_data(order_data=get_order_data(self.object), **kwargs)
         ctx['formset'] = ctx.pop('form')
-        if self.object.products.exists():
+        # The extra blank row isn't needed when editing what's packed, but a submitted row is always shown.
+        if not ctx['formset'].is_bound and self.object.products.exists():
             del ctx['formset'].forms[-1]
         return ctx
 
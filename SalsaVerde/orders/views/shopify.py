@@ -2,47 +2,197 @@ import hashlib
 import hmac
 import json
 import logging
+import random
 import secrets
+import threading
 import time
 from datetime import datetime
 from urllib.parse import urlencode
 
 import requests
 from django.conf import settings
+from django.core.cache import cache
 from django.core.handlers.wsgi import WSGIRequest
+from django.db import IntegrityError, transaction
 from django.http import HttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
+from requests.adapters import HTTPAdapter
 
 from SalsaVerde.common.views import display_dt
 from SalsaVerde.company.models import Company
+from SalsaVerde.orders.models import ShopifyEvent
 
-session = requests.Session()
 logger = logging.getLogger('salsa.shopify')
 
+# Shopify's REST API limits each shop with a leaky bucket: every call adds one, and it leaks at a steady rate, emptying
+# a full bucket in 20 seconds on every plan. How full it is comes back on each response, and is shared between
+# processes through the cache so calls can be spaced out before the bucket is full rather than after a 429.
+SHOPIFY_BUCKET_SIZE = 40
+SHOPIFY_BUCKET_DRAIN_SECONDS = 20
+# Calls left for other processes that haven't recorded theirs yet.
+SHOPIFY_BUCKET_HEADROOM = 2
+SHOPIFY_RETRIES = 5
+SHOPIFY_BACKOFF = 0.5
+SHOPIFY_MAX_BACKOFF = 8
+SHOPIFY_TIMEOUT = 30
+SHOPIFY_POOL_SIZE = 4
 
-def shopify_request(url, method='GET', data=None, *, company: Company, retries=0):
+
+class ShopifySessions:
+    """
+    A pooled requests.Session per shop, so each shop's connections are reused and one shop's slow responses don't
+    hold the connections of the others.
+    """
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def for_shop(self, shop_id: int) -> requests.Session:
+        with self._lock:
+            if not (shop_session := self._sessions.get(shop_id)):
+                shop_session = self._sessions[shop_id] = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=SHOPIFY_POOL_SIZE)
+                shop_session.mount('https://', adapter)
+                shop_session.mount('http://', adapter)
+            return shop_session
+
+    def request(self, method, url, *, shop_id: int, **kwargs) -> requests.Response:
+        return self.for_shop(shop_id).request(method, url, **kwargs)
+
+
+session = ShopifySessions()
+
+
+def _sleep(seconds: float):
+    time.sleep(seconds)
+
+
+class ShopifyBucket:
+    """
+    The last known level of a shop's leaky bucket, leaking away since it was recorded.
+    """
+
+    def __init__(self, company: Company):
+        self.key = f'shopify-bucket:{company.pk}'
+
+    def _lock(self):
+        # Held while the level is read and written back, so two processes can't take the same slot.
+        return cache.lock(f'{self.key}:lock', timeout=5, blocking_timeout=5)
+
+    def _level(self, now: float) -> tuple[float, int]:
+        used, size, at = cache.get(self.key) or (0, SHOPIFY_BUCKET_SIZE, now)
+        return max(used - (now - at) * size / SHOPIFY_BUCKET_DRAIN_SECONDS, 0), size
+
+    def _record(self, level: float, size: int, at: float):
+        cache.set(self.key, (level, size, at), SHOPIFY_BUCKET_DRAIN_SECONDS * 2)
+
+    def wait_for_call(self, max_wait: float) -> float | None:
+        """
+        Records a call about to be made, returning how long to wait first so it doesn't overflow the bucket, or None
+        without recording it if that's longer than max_wait.
+        """
+        with self._lock():
+            now = time.time()
+            level, size = self._level(now)
+            leak_rate = size / SHOPIFY_BUCKET_DRAIN_SECONDS
+            wait = max(level + 1 - (size - SHOPIFY_BUCKET_HEADROOM), 0) / leak_rate
+            if wait > max_wait:
+                return None
+            # The level is recorded as of when the call will be made, so calls made meanwhile wait their turn after it.
+            self._record(max(level - wait * leak_rate, 0) + 1, size, now + wait)
+            return wait
+
+    def update(self, r: requests.Response):
+        # eg. "32/40"
+        used, _, size = (r.headers.get('X-Shopify-Shop-Api-Call-Limit') or '').partition('/')
+        if used.isdigit() and size.isdigit():
+            with self._lock():
+                now = time.time()
+                # Calls reserved by other processes but not yet made aren't in Shopify's count, so it only ever raises
+                # the level recorded here.
+                self._record(max(int(used), self._level(now)[0]), int(size), now)
+
+
+def _retry_wait(r: requests.Response | None, attempt: int) -> float:
+    try:
+        return float(r.headers['Retry-After'])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        # Jittered exponential backoff, so calls that failed together don't retry together.
+        return random.uniform(0, min(SHOPIFY_BACKOFF * 2**attempt, SHOPIFY_MAX_BACKOFF))
+
+
+def _shopify_request(url, method, data, *, company: Company, max_wait: float | None):
     logger.info(f'Making request to Shopify {url}')
-    url = f'{settings.SHOPIFY_BASE_URL}/{url}'
-    data = data or {}
+    if '://' not in url:
+        url = f'{settings.SHOPIFY_BASE_URL}/{url}'.rstrip('?')
     if not (company.shopify_api_key and company.shopify_password):
-        return False, 'No API key for company'
-    else:
-        auth = (company.shopify_api_key, company.shopify_password)
+        return False, 'No API key for company', None
+    kwargs = {'auth': (company.shopify_api_key, company.shopify_password), 'timeout': SHOPIFY_TIMEOUT}
     if method == 'GET':
         if data:
-            url += f'?{urlencode(data)}'
-        r = session.request(method, url, auth=auth)
+            url += f"{'&' if '?' in url else '?'}{urlencode(data)}"
     else:
-        r = session.request(method, url, auth=auth, json=data)
-    if not (str(r.status_code).startswith('2')) or 'errors' in r.content.decode():
-        if retries == 5:
-            logger.warning('Request to Shopify failed after 5 attempts: %r', r.content.decode())
-            return False, r.content.decode()
+        kwargs['json'] = data or {}
+
+    waited, max_wait = 0, settings.SHOPIFY_MAX_WAIT if max_wait is None else max_wait
+    bucket = ShopifyBucket(company)
+    for attempt in range(SHOPIFY_RETRIES + 1):
+        if (wait := bucket.wait_for_call(max_wait - waited)) is None:
+            return False, 'Shopify rate limit reached', None
+        if wait:
+            _sleep(wait)
+            waited += wait
+        try:
+            r = session.request(method, url, shop_id=company.pk, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            r, error = None, str(e)
         else:
-            time.sleep(1)
-            shopify_request(url, method='GET', data=None, company=company, retries=retries + 1)
-    return True, r.json()
+            bucket.update(r)
+            error = r.content.decode()
+            if str(r.status_code).startswith('2'):
+                data = r.json()
+                if isinstance(data, dict) and 'errors' in data:
+                    break
+                return True, data, r
+            if r.status_code != 429 and r.status_code < 500:
+                # Anything else won't be any different when retried.
+                break
+        if attempt == SHOPIFY_RETRIES or waited + (wait := _retry_wait(r, attempt)) > max_wait:
+            break
+        logger.warning('Request to Shopify failed, retrying in %0.1fs: %s', wait, error)
+        _sleep(wait)
+        waited += wait
+    logger.warning('Request to Shopify failed: %r', error)
+    return False, error, r
+
+
+def shopify_request(url, method='GET', data=None, *, company: Company, max_wait: float | None = None):
+    """
+    Makes a request to Shopify, returning whether it succeeded and the response data or error.
+
+    Calls are spaced out to stay within the shop's rate limit, and are retried with backoff after a 429, a server error
+    or a connection error. max_wait is the longest to spend waiting (defaulting to SHOPIFY_MAX_WAIT, which is short
+    enough for web requests); the request fails rather than wait any longer.
+    """
+    success, data, _ = _shopify_request(url, method, data, company=company, max_wait=max_wait)
+    return success, data
+
+
+def shopify_pages(url, data=None, *, company: Company, max_wait: float | None = None):
+    """
+    Fetches every page of a list from Shopify, yielding whether each request succeeded and its data or error, as
+    shopify_request returns them. Pages are followed with the cursor in the Link header of each response, and it stops
+    at the last page or the first request that fails. max_wait applies to each page.
+    """
+    while url:
+        success, page, r = _shopify_request(url, 'GET', data, company=company, max_wait=max_wait)
+        yield success, page
+        if not success:
+            return
+        # The next page's URL has the cursor along with the limit and fields; the other filters can't be given with it.
+        url, data = r.links.get('next', {}).get('url'), None
 
 
 ORDER_FIELDS = [
@@ -60,11 +210,12 @@ ORDER_FIELDS = [
     'created_at',
     'fulfillment_status',
     'shipping_lines',
+    'updated_at',
 ]
 
 
-def get_shopify_order(id, company: Company):
-    return shopify_request(f"orders/{id}.json?fields={','.join(ORDER_FIELDS)}", company=company)
+def get_shopify_order(id, company: Company, max_wait: float | None = None):
+    return shopify_request(f"orders/{id}.json?fields={','.join(ORDER_FIELDS)}", company=company, max_wait=max_wait)
 
 
 class ShopifyHelperMixin:
@@ -79,26 +230,47 @@ class ShopifyHelperMixin:
 @require_POST
 @csrf_exempt
 def callback(request: WSGIRequest):
-    from SalsaVerde.orders.shopify import process_shopify_event
+    """
+    Stores the webhook for a worker to process (see process_shopify_events()), so Shopify gets a response straight away.
+    """
+    from SalsaVerde.orders.shopify import SHOPIFY_EVENTS, queue_shopify_events
 
     domain = request.headers.get('X-Shopify-Shop-Domain')
     company = Company.objects.filter(shopify_domain=domain, shopify_domain__isnull=False).first()
-    if company and (key := company.shopify_webhook_key):
-        data = json.loads(request.body.decode())
-        sig = request.headers.get('X-Shopify-Hmac-Sha256', '')
-        sig = sig.encode() if isinstance(sig, str) else sig
-        m = hmac.new(key.encode(), request.body, hashlib.sha256).hexdigest()
-        if not secrets.compare_digest(m.encode(), sig):
-            logger.error('Invalid signature for data', extra={'shopify_data': data, 'received_sig': sig, 'sig': m})
-            # raise PermissionDenied('Invalid signature')
-        topic = request.headers.get('X-Shopify-Topic', 'No/Topic')
-        try:
-            msg, status = process_shopify_event(topic, data, company=company)
-        except Exception as e:
-            logger.error('Error processing data', exc_info=e, extra={'shopify_data': data})
-            raise
-    else:
+    topic = request.headers.get('X-Shopify-Topic', 'No/Topic')
+    if not (company and (key := company.shopify_webhook_key)):
         status = 299
         msg = f'Company with domain {domain} does not exist'
+    elif not secrets.compare_digest(
+        hmac.new(key.encode(), request.body, hashlib.sha256).hexdigest().encode(),
+        request.headers.get('X-Shopify-Hmac-Sha256', '').encode(),
+    ):
+        status = 403
+        msg = 'Invalid signature'
+    elif topic not in SHOPIFY_EVENTS:
+        status = 220
+        msg = f'Unknown event {topic}'
+    else:
+        try:
+            data = json.loads(request.body.decode())
+            shopify_id = str(data['id'])
+        except (ValueError, TypeError, KeyError):
+            status, msg = 400, 'Invalid data'
+        else:
+            try:
+                with transaction.atomic():
+                    ShopifyEvent.objects.create(
+                        company=company,
+                        webhook_id=request.headers.get('X-Shopify-Webhook-Id') or secrets.token_hex(),
+                        topic=topic,
+                        shopify_id=shopify_id,
+                        data=data,
+                    )
+            except IntegrityError:
+                # Shopify sent it again
+                status, msg = 200, f'Event {topic} {shopify_id} already received'
+            else:
+                status, msg = 200, f'Event {topic} {shopify_id} received'
+                queue_shopify_events(company.id)
     logger.info('Shopify event status %s:%s', status, msg)
     return HttpResponse(msg, status=status)
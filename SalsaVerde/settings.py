@@ -51,6 +51,7 @@ INSTALLED_APPS = [
     'django.contrib.contenttypes',
     'django.contrib.sessions',
     'django.contrib.messages',
+    'django.contrib.postgres',
     'SalsaVerde.staticfiles',
     'django.contrib.staticfiles',
     'django_extensions',
@@ -148,6 +149,11 @@ DT_FORMAT = '%d/%m/%Y %H:%M'
 DATE_FORMAT = '%d/%m/%Y'
 
 AUTH_USER_MODEL = 'company.User'
+AUTHENTICATION_BACKENDS = [
+    'SalsaVerde.company.backends.TenantBackend',
+    # Sessions created before TenantBackend was added still reference ModelBackend.
+    'django.contrib.auth.backends.ModelBackend',
+]
 DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
 
 # Storage
@@ -254,6 +260,12 @@ RQ_QUEUES = {
     'default': {'USE_REDIS_CACHE': 'default', 'ASYNC': ASYNC_RQ},
 }
 
+# =======================================
+# Traceability
+# =======================================
+# Recalls are looked up in the TraceLink closure table, FALSE walks the batches with a recursive query instead.
+TRACE_CLOSURE = env_true('TRACE_CLOSURE', 'TRUE')
+
 # =======================================
 # Shopify
 # =======================================
@@ -261,6 +273,16 @@ SHOPIFY_API_VERSION = os.getenv('SHOPIFY_API_VERSION', '2020-07')
 SHOPIFY_BASE_URL = os.getenv(
     'SHOPIFY_BASE_URL', f'https://burren-balsamics.myshopify.com/admin/api/{SHOPIFY_API_VERSION}'
 )
+# The longest a request to Shopify waits for its rate limit and retries, in web requests and in jobs.
+SHOPIFY_MAX_WAIT = float(os.getenv('SHOPIFY_MAX_WAIT', 5))
+SHOPIFY_JOB_MAX_WAIT = float(os.getenv('SHOPIFY_JOB_MAX_WAIT', 120))
+# Order pages show the order as last fetched from Shopify, and refresh it in the background once it's older than this.
+SHOPIFY_ORDER_TTL = int(os.getenv('SHOPIFY_ORDER_TTL', 15 * 60))
+# How often the orders updated in Shopify are synced, in seconds, and how far back the first sync of a shop goes.
+SHOPIFY_SYNC_INTERVAL = int(os.getenv('SHOPIFY_SYNC_INTERVAL', 10 * 60))
+SHOPIFY_SYNC_FIRST_DAYS = int(os.getenv('SHOPIFY_SYNC_FIRST_DAYS', 7))
+# How long webhooks wait to be processed, in seconds, so the ones for an order that come together are processed once.
+SHOPIFY_EVENT_DELAY = int(os.getenv('SHOPIFY_EVENT_DELAY', 5))
 
 # =======================================
 # ExpressFreight
@@ -3,3 +3,9 @@ from django.apps import AppConfig
 
 class MainConfig(AppConfig):
     name = 'SalsaVerde.stock'
+
+    def ready(self):
+        # Connects the signals that invalidate cached list rows and recipes, and keep the stock ledger, inventory and
+        # traceability up to date.
+        from SalsaVerde.common import row_cache  # noqa: F401
+        from SalsaVerde.stock import inventory, ledger, recipes, trace  # noqa: F401
@@ -3,21 +3,46 @@ from datetime import date, datetime
 from django import forms
 from django.utils import timezone
 
-from SalsaVerde.stock.widgets import DateTimePicker
+from SalsaVerde.common.autocomplete import autocomplete_url, register_autocomplete_form
+from SalsaVerde.stock.widgets import AutocompleteSelect, DateTimePicker
 
 
 class SVFormMixin:
+    # The ModelChoiceFields whose options are searched for as they're typed rather than all rendered, and the lookups
+    # their search matches. See SalsaVerde.common.autocomplete.
+    autocomplete_fields: dict[str, list[str]] = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.autocomplete_fields:
+            register_autocomplete_form(cls)
+
     def __init__(self, *args, **kwargs):
         self.request = kwargs.pop('request', None)
         super().__init__(*args, **kwargs)
         self._prepare_fields()
         # self.set_layout()
 
+    @classmethod
+    def for_autocomplete(cls, request):
+        """
+        The form whose autocomplete fields' querysets are searched, see get_autocomplete_params.
+        """
+        return cls(request=request)
+
+    def get_autocomplete_params(self) -> dict:
+        """
+        Anything for_autocomplete needs from the request to build the same querysets as this form.
+        """
+        return {}
+
     def _prepare_fields(self):
         for field_name, field in self.fields.items():
             if isinstance(field.widget, forms.DateTimeInput):
                 field.widget = DateTimePicker(field)
             elif isinstance(field, forms.ModelChoiceField) and self.request:
+                if field_name in self.autocomplete_fields and not isinstance(field.widget, AutocompleteSelect):
+                    field.widget = AutocompleteSelect(autocomplete_url(self, field_name), attrs=field.widget.attrs)
                 field.queryset = field.queryset.request_qs(self.request)
 
     def get_layout(self) -> list[list[tuple[forms.BoundField, int]]]:
@@ -1,6 +1,7 @@
 import json
 
 from django import forms
+from django.db import transaction
 
 from SalsaVerde.stock.forms.base_forms import SVModelForm
 from SalsaVerde.stock.models import Container, ContainerType, YieldContainer
@@ -62,6 +63,10 @@ class ContainerForm(SVModelForm):
 
 
 class YieldContainersForm(SVModelForm):
+    autocomplete_fields = {
+        'container': ['container_type__name', 'batch_code'],
+        'cap': ['container_type__name', 'batch_code'],
+    }
     container = forms.ModelChoiceField(
         queryset=(Container.objects.filter(finished=False).exclude(container_type__type=ContainerType.TYPE_CAP))
     )
@@ -76,11 +81,15 @@ class YieldContainersForm(SVModelForm):
         return self.cleaned_data
 
     def save(self, commit=True):
-        obj = super().save(commit)
-        if self.cleaned_data['cap']:
-            YieldContainer.objects.create(
-                container=self.cleaned_data['cap'], quantity=self.cleaned_data['quantity'], product_id=obj.product.id
-            )
+        # The stock of packaging and of the product are updated as these are saved, so they're saved together.
+        with transaction.atomic():
+            obj = super().save(commit)
+            if self.cleaned_data['cap']:
+                YieldContainer.objects.create(
+                    container=self.cleaned_data['cap'],
+                    quantity=self.cleaned_data['quantity'],
+                    product_id=obj.product.id,
+                )
         return obj
 
     class Meta:
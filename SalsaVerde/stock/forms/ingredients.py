@@ -59,6 +59,8 @@ class IngredientForm(SVModelForm):
 
 
 class IngredientFilterForm(SVFilterForm):
+    autocomplete_fields = {'supplier': ['name'], 'intake_user': ['first_name', 'last_name', 'email']}
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.fields['finished'] = forms.ChoiceField(
@@ -66,9 +68,14 @@ class IngredientFilterForm(SVFilterForm):
             choices=[('not-finished', 'Not finished'), ('all', 'All'), ('finished', 'Finished')],
             required=False,
         )
+        self.fields['remaining_below'] = forms.DecimalField(label='Remaining less than', required=False)
 
     def filter_kwargs(self) -> dict:
         filter_kwargs = super().filter_kwargs()
+        # Taken from cleaned_data, as filter_kwargs leaves out 0 along with empty values.
+        filter_kwargs.pop('remaining_below', None)
+        if (remaining_below := self.cleaned_data.get('remaining_below')) is not None:
+            filter_kwargs['remaining_quantity__lt'] = remaining_below
         if fin_filter := filter_kwargs.pop('finished', None):
             if fin_filter == 'all':
                 # We don't need to add a filter for all
@@ -86,4 +93,5 @@ class IngredientFilterForm(SVFilterForm):
             ['ingredient_type', 'supplier'],
             ['intake_user', 'finished'],
             ['intake_date_from', 'intake_date_to'],
+            ['remaining_below'],
         ]
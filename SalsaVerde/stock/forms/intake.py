@@ -0,0 +1,159 @@
+"""
+Bulk intake of raw ingredients and packaging from a CSV, eg. the lines of a delivery.
+
+Every row is checked before anything is saved, and the types, suppliers and users named in the rows are looked up with
+one query each rather than one per row. The batches are then saved with a single bulk_create in one transaction.
+bulk_create doesn't call save(), so the company and remaining quantity are set on each batch here.
+"""
+
+import csv
+import io
+
+from django import forms
+from django.db import transaction
+from django.db.models import Q, Value
+from django.db.models.functions import Concat, Lower
+from django.utils import timezone
+
+from SalsaVerde.company.models import User
+from SalsaVerde.stock.forms.base_forms import SVForm
+from SalsaVerde.stock.models import Container, ContainerType, Ingredient, IngredientType, Supplier
+from SalsaVerde.stock.recipes import invalidate_recipes
+
+INTAKE_MAX_ROWS = 5000
+INTAKE_BATCH_SIZE = 1000
+DATE_FORMATS = ['%d/%m/%Y', '%d/%m/%Y %H:%M', '%Y-%m-%d', '%Y-%m-%d %H:%M']
+# The columns that are values rather than names to look up, and the fields they're for.
+VALUE_COLUMNS = {
+    'batch code': 'batch_code',
+    'quantity': 'quantity',
+    'intake date': 'intake_date',
+    'notes': 'intake_notes',
+}
+REQUIRED_COLUMNS = ['type', 'batch code', 'quantity']
+MAX_ERRORS = 50
+
+
+def _lookup(qs, names, *fields) -> dict[str, int]:
+    """
+    Finds the objects in qs with any of the names in any of the fields, ignoring case, with a single query.
+    """
+    names = {n.lower() for n in names if n}
+    if not names:
+        return {}
+    qs = qs.annotate(**{f'_{f}': Lower(expr) for f, expr in fields})
+    found = qs.filter(Q(*[Q(**{f'_{f}__in': names}) for f, _ in fields], _connector=Q.OR))
+    return {key: pk for *keys, pk in found.values_list(*[f'_{f}' for f, _ in fields], 'pk') for key in keys}
+
+
+class BatchIntakeForm(SVForm):
+    model = NotImplemented
+    type_model = NotImplemented
+    type_field = NotImplemented
+
+    file = forms.FileField(label='CSV file', required=False)
+    rows = forms.CharField(
+        label='Or paste the rows',
+        widget=forms.Textarea({'rows': 8, 'class': 'resize-vertical-only'}),
+        required=False,
+        help_text=(
+            'The first row should be the column names: Type, Batch Code and Quantity, and optionally Supplier, '
+            'Received by (a name or email), Intake Date (dd/mm/yyyy) and Notes.'
+        ),
+    )
+
+    def _read_rows(self) -> list[dict]:
+        if file := self.cleaned_data.get('file'):
+            try:
+                text = file.read().decode('utf-8-sig')
+            except UnicodeDecodeError:
+                raise forms.ValidationError({'file': 'The file must be a CSV'})
+        else:
+            text = self.cleaned_data.get('rows', '')
+        if not text.strip():
+            raise forms.ValidationError({'rows': 'Upload a CSV file or paste the rows'})
+        # Rows copied from a spreadsheet are separated by tabs.
+        first_line = text.lstrip().partition('\n')[0]
+        delimiter = '\t' if '\t' in first_line else ','
+        reader = csv.reader(io.StringIO(text.strip()), delimiter=delimiter)
+        headers = [h.strip().lower() for h in next(reader)]
+        if missing := [c.title() for c in REQUIRED_COLUMNS if c not in headers]:
+            raise forms.ValidationError({'rows': f'Missing columns: {", ".join(missing)}'})
+        rows = [dict(zip(headers, (v.strip() for v in row))) for row in reader if any(v.strip() for v in row)]
+        if len(rows) > INTAKE_MAX_ROWS:
+            raise forms.ValidationError({'rows': f'At most {INTAKE_MAX_ROWS} rows can be added at once'})
+        return rows
+
+    def clean(self):
+        rows = self._read_rows()
+        company_id = self.request.user.company_id
+        types = _lookup(
+            self.type_model.objects.request_qs(self.request), (r.get('type') for r in rows), ('name', 'name')
+        )
+        suppliers = _lookup(
+            Supplier.objects.request_qs(self.request), (r.get('supplier') for r in rows), ('name', 'name')
+        )
+        users = _lookup(
+            User.objects.filter(company_id=company_id),
+            (r.get('received by') for r in rows),
+            ('email', 'email'),
+            ('name', Concat('first_name', Value(' '), 'last_name')),
+        )
+        form_fields = {f: self.model._meta.get_field(f).formfield() for f in ('batch_code', 'quantity', 'intake_notes')}
+        form_fields['intake_date'] = forms.DateTimeField(input_formats=DATE_FORMATS, required=False)
+        now = timezone.now()
+
+        batches, errors = [], []
+        # Rows are numbered as they are in the spreadsheet, after the column names.
+        for n, row in enumerate(rows, start=2):
+            type_name, supplier, received_by = (row.get(c, '') for c in ('type', 'supplier', 'received by'))
+            values = {
+                f'{self.type_field}_id': types.get(type_name.lower()),
+                'supplier_id': suppliers.get(supplier.lower()),
+                'intake_user_id': users.get(received_by.lower()) if received_by else self.request.user.pk,
+            }
+            row_errors = []
+            if not values[f'{self.type_field}_id']:
+                row_errors.append(f'Unknown {self.type_model._meta.verbose_name.lower()} "{type_name}"')
+            if supplier and not values['supplier_id']:
+                row_errors.append(f'Unknown supplier "{supplier}"')
+            if not values['intake_user_id']:
+                row_errors.append(f'Unknown user "{received_by}"')
+            for column, field in VALUE_COLUMNS.items():
+                try:
+                    values[field] = form_fields[field].clean(row.get(column) or None)
+                except forms.ValidationError as e:
+                    row_errors.append(f'{column.title()}: {" ".join(e.messages)}')
+            if row_errors:
+                errors.append(f'Row {n}: {"; ".join(row_errors)}')
+                continue
+            values['intake_date'] = values['intake_date'] or now
+            batches.append(self.model(company_id=company_id, remaining_quantity=values['quantity'], **values))
+
+        if errors:
+            if len(errors) > MAX_ERRORS:
+                errors = errors[:MAX_ERRORS] + [f'And {len(errors) - MAX_ERRORS} more rows with errors']
+            raise forms.ValidationError({'rows': errors})
+        self.cleaned_data['batches'] = batches
+        return self.cleaned_data
+
+    def save(self) -> list:
+        with transaction.atomic():
+            return self.model.objects.bulk_create(self.cleaned_data['batches'], batch_size=INTAKE_BATCH_SIZE)
+
+
+class IngredientIntakeForm(BatchIntakeForm):
+    model = Ingredient
+    type_model = IngredientType
+    type_field = 'ingredient_type'
+
+    def save(self) -> list:
+        batches = super().save()
+        invalidate_recipes(self.request.user.company_id)
+        return batches
+
+
+class ContainerIntakeForm(BatchIntakeForm):
+    model = Container
+    type_model = ContainerType
+    type_field = 'container_type'
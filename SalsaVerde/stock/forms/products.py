@@ -44,6 +44,7 @@ ProductTypeSizesFormSet = forms.inlineformset_factory(
 
 class ProductIngredientForm(SVModelForm):
     title = 'Raw Ingredients'
+    autocomplete_fields = {'ingredient': ['ingredient_type__name', 'batch_code']}
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -61,19 +62,24 @@ class AddProductForm(SVModelForm):
         super().__init__(*args, **kwargs)
         self.fields['product_type'].label = 'Product Type'
         # In this form, we want to render the ingredient fields dynamically as the product type is chosen. So we add
-        # 10 fields to the form, and then set the URL for the ingredient choices to be the product type chosen.
+        # 10 fields to the form, and then set the URL for the ingredient choices to be the product type chosen. The
+        # choices come from that URL, so the fields are just ids here and are looked up together in clean().
         self.fields['product_type'].widget.attrs['product-ingredient-choices-url-template'] = reverse(
             'product-ingredient-choices', kwargs={'pk': 999}
         )
-        ingredient_qs = Ingredient.objects.request_qs(self.request).filter(finished=False)
         # I'm hoping there are a max of 10 ingredients here.
         for i in range(10):
-            self.fields[f'ingredient_{i}'] = forms.ModelChoiceField(queryset=ingredient_qs, required=False)
+            self.fields[f'ingredient_{i}'] = forms.IntegerField(required=False)
             self.fields[f'ingredient_quantity_{i}'] = forms.DecimalField(required=False)
 
     def clean(self):
+        ingredient_ids = {v for i in range(10) if (v := self.cleaned_data.get(f'ingredient_{i}'))}
+        ingredients = Ingredient.objects.request_qs(self.request).filter(finished=False).in_bulk(ingredient_ids)
         has_ingredient = False
         for i in range(10):
+            if (ingred_id := self.cleaned_data.get(f'ingredient_{i}')) and ingred_id not in ingredients:
+                raise ValidationError({'__all__': 'Select a valid raw ingredient'})
+            self.cleaned_data[f'ingredient_{i}'] = ingredients.get(ingred_id)
             if self.cleaned_data.get(f'ingredient_{i}') and not self.cleaned_data.get(f'ingredient_quantity_{i}'):
                 raise ValidationError({'__all__': 'Quantity is required'})
             elif self.cleaned_data.get(f'ingredient_quantity_{i}') and not self.cleaned_data.get(f'ingredient_{i}'):
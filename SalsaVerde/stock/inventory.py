@@ -0,0 +1,145 @@
+"""
+Keeps ProductInventory, the number of units of each size of each product that have been bottled and packed, up to date.
+
+Bottling (a YieldContainer that isn't a cap) adds to bottled and packing an order (a ProductOrder with a size) adds to
+packed. Both are applied with a single F() update of the product's row for that size, so the stock left is a lookup of
+one row rather than adding up all of the bottling and packing. As with the ledger in SalsaVerde.stock.ledger, anything
+that doesn't send signals leaves it out of date and rebuild_inventory() (or the reconcile_stock command) fixes it.
+"""
+
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from SalsaVerde.orders.models import ProductOrder
+from SalsaVerde.stock.models import Container, ContainerType, Product, ProductInventory, YieldContainer
+
+REBUILD_BATCH_SIZE = 1000
+
+
+def _adjust(product_id: int, container_type_id: int, create: bool, **deltas):
+    """
+    Adds the deltas to the product's inventory for the size. The row is only created when create is True, ie. when the
+    product has just been bottled or packed. Otherwise it may have been deleted along with the product.
+    """
+    if not (product_id and container_type_id and any(deltas.values())):
+        return
+    qs = ProductInventory.objects.filter(product_id=product_id, container_type_id=container_type_id)
+    updates = {field: F(field) + delta for field, delta in deltas.items()}
+    if not qs.update(**updates) and create:
+        try:
+            with transaction.atomic():
+                ProductInventory.objects.create(
+                    product_id=product_id,
+                    container_type_id=container_type_id,
+                    company_id=Product.objects.values_list('company_id', flat=True).get(pk=product_id),
+                    **deltas,
+                )
+        except IntegrityError:
+            # Created by another request since we tried to update it.
+            qs.update(**updates)
+
+
+def _bottled_size(container_id: int) -> int | None:
+    # Caps are bottled along with the bottles, so they aren't counted as stock.
+    if container_id:
+        return (
+            Container.objects.exclude(container_type__type=ContainerType.TYPE_CAP)
+            .filter(pk=container_id)
+            .values_list('container_type_id', flat=True)
+            .first()
+        )
+
+
+def _usage(sender, instance) -> tuple[int, int | None, Decimal]:
+    if sender is YieldContainer:
+        return instance.product_id, _bottled_size(instance.container_id), Decimal(str(instance.quantity))
+    return instance.product_id, instance.container_type_id, Decimal(str(instance.quantity))
+
+
+def _field(sender) -> str:
+    return 'bottled' if sender is YieldContainer else 'packed'
+
+
+@receiver(pre_save, sender=YieldContainer)
+@receiver(pre_save, sender=ProductOrder)
+def _record_previous_usage(sender, instance, raw=False, **kwargs):
+    if not raw and not instance._state.adding:
+        previous = sender.objects.filter(pk=instance.pk).first()
+        instance._inventory_previous = previous and _usage(sender, previous)
+
+
+@receiver(post_save, sender=YieldContainer)
+@receiver(post_save, sender=ProductOrder)
+def _apply_usage(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    field = _field(sender)
+    if previous := not created and getattr(instance, '_inventory_previous', None):
+        _adjust(*previous[:2], create=False, **{field: -previous[2]})
+    instance._inventory_previous = None
+    product_id, container_type_id, quantity = _usage(sender, instance)
+    _adjust(product_id, container_type_id, create=True, **{field: quantity})
+
+
+@receiver(post_delete, sender=YieldContainer)
+@receiver(post_delete, sender=ProductOrder)
+def _return_usage(sender, instance, **kwargs):
+    product_id, container_type_id, quantity = _usage(sender, instance)
+    _adjust(product_id, container_type_id, create=False, **{_field(sender): -quantity})
+
+
+def rebuild_inventory(batch_size: int = REBUILD_BATCH_SIZE) -> int:
+    """
+    Recalculates the inventory of every product from its bottling and packing, a batch of products at a time. Returns
+    the number of inventory rows that were wrong. Bottling or packing while it runs can be missed, so it should be run
+    when the site is quiet.
+    """
+    fixed, last_pk = 0, 0
+    while products := dict(
+        Product.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'company_id')[:batch_size]
+    ):
+        last_pk = max(products)
+        expected = {}
+        for field, usage in [
+            (
+                'bottled',
+                YieldContainer.objects.filter(product_id__in=products)
+                .exclude(container__container_type__type=ContainerType.TYPE_CAP)
+                .values_list('product_id', 'container__container_type_id'),
+            ),
+            (
+                'packed',
+                ProductOrder.objects.filter(product_id__in=products, container_type__isnull=False).values_list(
+                    'product_id', 'container_type_id'
+                ),
+            ),
+        ]:
+            for product_id, container_type_id, total in usage.order_by().annotate(total=Sum('quantity')):
+                expected.setdefault((product_id, container_type_id), {'bottled': 0, 'packed': 0})[field] = total
+
+        current = {
+            (inv.product_id, inv.container_type_id): inv
+            for inv in ProductInventory.objects.filter(product_id__in=products)
+        }
+        wrong = []
+        for key in expected.keys() | current.keys():
+            totals = expected.get(key, {'bottled': 0, 'packed': 0})
+            inv = current.get(key) or ProductInventory(
+                product_id=key[0], container_type_id=key[1], company_id=products[key[0]]
+            )
+            if inv.pk is None or inv.bottled != totals['bottled'] or inv.packed != totals['packed']:
+                inv.bottled, inv.packed = totals['bottled'], totals['packed']
+                wrong.append(inv)
+        if wrong:
+            ProductInventory.objects.bulk_create(
+                wrong,
+                update_conflicts=True,
+                unique_fields=['product', 'container_type'],
+                update_fields=['bottled', 'packed'],
+            )
+            fixed += len(wrong)
+    return fixed
@@ -0,0 +1,114 @@
+"""
+Keeps the remaining_quantity of ingredient and packaging batches up to date as they're used in products.
+
+Every time a ProductIngredient or YieldContainer is created, changed or deleted the batch it uses is adjusted by the
+difference with a single F() update, so lists can sort and filter on what's left without adding up the usage of every
+batch. Anything that changes usage without sending signals (eg. bulk_create or QuerySet.update()) leaves the ledger
+out of date. Rows added with bulk_create can be applied with record_usage(), and reconcile() (or the reconcile_stock
+command) rebuilds it from the usage.
+"""
+
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db.models import Case, DecimalField, F, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from SalsaVerde.common.row_cache import bump_row_versions
+from SalsaVerde.stock.models import Container, Ingredient, ProductIngredient, YieldContainer
+
+RECONCILE_BATCH_SIZE = 5000
+
+# The model that records the usage of each kind of batch, and the field it points to the batch with.
+USAGE = {
+    Ingredient: (ProductIngredient, 'ingredient'),
+    Container: (YieldContainer, 'container'),
+}
+BATCH_MODELS = {usage_model: (model, field) for model, (usage_model, field) in USAGE.items()}
+
+
+def _adjust(model, pk: int, delta: Decimal):
+    if pk and delta:
+        model.objects.filter(pk=pk).update(remaining_quantity=F('remaining_quantity') + delta)
+        bump_row_versions(model, [pk])
+
+
+@receiver(pre_save, sender=ProductIngredient)
+@receiver(pre_save, sender=YieldContainer)
+def _record_previous_usage(sender, instance, raw=False, **kwargs):
+    # What the row used before this save, so the update can be applied as a difference.
+    if not raw and not instance._state.adding:
+        field = BATCH_MODELS[sender][1]
+        instance._ledger_previous = sender.objects.filter(pk=instance.pk).values_list(f'{field}_id', 'quantity').first()
+
+
+@receiver(post_save, sender=ProductIngredient)
+@receiver(post_save, sender=YieldContainer)
+def _apply_usage(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    model, field = BATCH_MODELS[sender]
+    batch_id, quantity = getattr(instance, f'{field}_id'), Decimal(str(instance.quantity))
+    previous_id, previous_quantity = (not created and getattr(instance, '_ledger_previous', None)) or (None, 0)
+    instance._ledger_previous = None
+    if previous_id == batch_id:
+        _adjust(model, batch_id, previous_quantity - quantity)
+    else:
+        _adjust(model, previous_id, previous_quantity)
+        _adjust(model, batch_id, -quantity)
+
+
+@receiver(post_delete, sender=ProductIngredient)
+@receiver(post_delete, sender=YieldContainer)
+def _return_usage(sender, instance, **kwargs):
+    model, field = BATCH_MODELS[sender]
+    _adjust(model, getattr(instance, f'{field}_id'), Decimal(str(instance.quantity)))
+
+
+def record_usage(usage_model, objs):
+    """
+    Takes what the usage rows use off their batches, for rows created with bulk_create (which doesn't send signals).
+    Every batch is updated with a single query.
+    """
+    model, field = BATCH_MODELS[usage_model]
+    used = defaultdict(Decimal)
+    for obj in objs:
+        used[getattr(obj, f'{field}_id')] += Decimal(str(obj.quantity))
+    if used:
+        model.objects.filter(pk__in=used).update(
+            remaining_quantity=F('remaining_quantity')
+            - Case(*[When(pk=pk, then=Value(q)) for pk, q in used.items()], output_field=DecimalField())
+        )
+        bump_row_versions(model, list(used))
+
+
+def reconcile(model, batch_size: int = RECONCILE_BATCH_SIZE) -> int:
+    """
+    Recalculates remaining_quantity from the usage for every batch of model (Ingredient or Container) where it's
+    wrong, in batches of primary keys so big tables aren't locked for long. Returns the number of batches fixed.
+    """
+    usage_model, field = USAGE[model]
+    used = (
+        usage_model.objects.filter(**{field: OuterRef('pk')})
+        .order_by()
+        .values(field)
+        .annotate(total=Sum('quantity'))
+        .values('total')
+    )
+    expected = F('quantity') - Coalesce(Subquery(used), Value(Decimal(0)))
+    fixed, last_pk = 0, 0
+    while pks := list(model.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True)[:batch_size]):
+        last_pk = pks[-1]
+        wrong = list(
+            model.objects.filter(pk__in=pks)
+            .annotate(_expected=expected)
+            .exclude(remaining_quantity=F('_expected'))
+            .values_list('pk', flat=True)
+        )
+        if wrong:
+            model.objects.filter(pk__in=wrong).update(remaining_quantity=expected)
+            bump_row_versions(model, wrong)
+            fixed += len(wrong)
+    return fixed
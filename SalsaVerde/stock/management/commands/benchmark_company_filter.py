@@ -0,0 +1,58 @@
+from timeit import timeit
+
+from django.core.management import BaseCommand
+from django.db.models import Count
+
+from SalsaVerde.company.models import Company
+from SalsaVerde.orders.models import ProductOrder
+from SalsaVerde.stock.models import Container, Document, Ingredient, Product, ProductIngredient, YieldContainer
+
+# How each model was scoped to a company before it had its own company column.
+JOIN_LOOKUPS = {
+    Ingredient: 'ingredient_type__company_id',
+    Container: 'container_type__company_id',
+    Product: 'product_type__company_id',
+    ProductIngredient: 'product__product_type__company_id',
+    YieldContainer: 'product__product_type__company_id',
+    ProductOrder: 'order__company_id',
+    Document: 'author__company_id',
+}
+
+
+def _plan_nodes(plan: str) -> str:
+    """
+    Summarises an EXPLAIN as its scans and joins, eg. "Hash Join, Seq Scan on stock_ingredient, Seq Scan on ...".
+    """
+    nodes = []
+    for line in plan.splitlines():
+        node = line.strip().removeprefix('->').split('  (')[0].strip()
+        if 'Scan' in node or 'Join' in node or 'Nested Loop' in node:
+            nodes.append(node)
+    return ', '.join(nodes)
+
+
+class Command(BaseCommand):
+    help = 'Compares the query plan and time of scoping to a company by joining to the parent vs the company column'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--company', type=int, help='Company to benchmark, defaults to the one with most products')
+        parser.add_argument('--rounds', type=int, default=20, help='Number of times to run each query')
+        parser.add_argument('--plans', action='store_true', help='Print the full query plans')
+
+    def handle(self, *args, company, rounds, plans, **options):
+        if not company:
+            company = Company.objects.annotate(n=Count('producttype__products')).order_by('-n').values_list('id')[0][0]
+        self.stdout.write(f'Company {company}:')
+        for model, join_lookup in JOIN_LOOKUPS.items():
+            joined = model.objects.filter(**{join_lookup: company}).order_by('pk')
+            scoped = model.objects.filter(company_id=company).order_by('pk')
+            joined_plan, scoped_plan = joined.explain(), scoped.explain()
+            before = timeit(lambda: list(joined.values_list('pk', flat=True)), number=rounds) / rounds * 1000
+            after = timeit(lambda: list(scoped.values_list('pk', flat=True)), number=rounds) / rounds * 1000
+            self.stdout.write(
+                f'{model.__name__:>18}: {scoped.count():>7} rows, {before:8.2f}ms joined, {after:8.2f}ms by column\n'
+                f'{"":>20}joined:    {_plan_nodes(joined_plan)}\n'
+                f'{"":>20}by column: {_plan_nodes(scoped_plan)}'
+            )
+            if plans:
+                self.stdout.write(f'{joined_plan}\n\n{scoped_plan}\n')
@@ -0,0 +1,90 @@
+import datetime
+from functools import partial
+from timeit import timeit
+
+from django.core.management import BaseCommand
+from django.utils.safestring import mark_safe
+
+from SalsaVerde.common.views import OBJ_URL, VIEW_FUNC, display_dt
+from SalsaVerde.company.views.users import UserList
+from SalsaVerde.orders.views.common import OrdersList
+from SalsaVerde.stock.views.containers.list import ContainerList
+from SalsaVerde.stock.views.ingredients.list import IngredientList
+from SalsaVerde.stock.views.products.list import ProductList
+from SalsaVerde.stock.views.suppliers import SupplierList
+
+LIST_VIEWS = [IngredientList, ContainerList, ProductList, SupplierList, OrdersList, UserList]
+
+
+def _get_attr(obj, attr_name):
+    for b in attr_name.split('__'):
+        if obj:
+            obj = getattr(obj, b)
+    return obj
+
+
+def uncompiled_value(view, obj, item):
+    """
+    How the value of a display item was found before display plans, by parsing the item again for every cell.
+    """
+    field = item[1] if isinstance(item, tuple) else item
+    if hasattr(obj, f'display_{field}'):
+        return getattr(obj, f'display_{field}')()
+    elif field.startswith(VIEW_FUNC):
+        field = field.replace(VIEW_FUNC, '')
+        return getattr(view, field)(obj)
+    elif field.startswith(OBJ_URL):
+        field = field.replace(OBJ_URL, '')
+        related_obj = _get_attr(obj, field)
+        if related_obj:
+            return mark_safe(f'<a href="{related_obj.get_absolute_url()}">{related_obj}</a>')
+        return '–'
+    attr = _get_attr(obj, field)
+    if isinstance(attr, partial) or callable(attr):
+        v = attr()
+    else:
+        v = attr
+    if isinstance(v, datetime.datetime):
+        return display_dt(v)
+    elif v is True:
+        return mark_safe('<span class="fa fa-check"></span')
+    elif v is False:
+        return mark_safe('<span class="fa fa-times"></span')
+    return v or '–'
+
+
+class Command(BaseCommand):
+    help = 'Compares the per-row cost of building display values with and without a compiled display plan'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=50, help='Number of rows to render per page')
+        parser.add_argument('--rounds', type=int, default=200, help='Number of pages to render')
+
+    def handle(self, *args, rows, rounds, **options):
+        for view_cls in LIST_VIEWS:
+            objects = list(view_cls.model.objects.all()[:rows])
+            if not objects:
+                self.stdout.write(f'{view_cls.__name__:>16}: no objects, skipping')
+                continue
+            view = view_cls()
+            display_items = view.get_display_items()
+            plan = view_cls.get_display_plan(display_items)
+            # Render once first so related objects are cached on the instances and we only time the display code.
+            for obj in objects:
+                plan.values(view, obj)
+
+            def uncompiled():
+                for obj in objects:
+                    [uncompiled_value(view, obj, item) for item in display_items]
+
+            def compiled():
+                _plan = view_cls.get_display_plan(display_items)
+                for obj in objects:
+                    _plan.values(view, obj)
+
+            before = timeit(uncompiled, number=rounds) / (rounds * len(objects)) * 1e6
+            after = timeit(compiled, number=rounds) / (rounds * len(objects)) * 1e6
+            self.stdout.write(
+                f'{view_cls.__name__:>16}: {before:7.2f}µs/row uncompiled, {after:7.2f}µs/row compiled '
+                f'({before / after:.1f}x)'
+            )
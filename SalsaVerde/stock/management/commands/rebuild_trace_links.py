@@ -0,0 +1,12 @@
+from django.core.management import BaseCommand
+
+from SalsaVerde.company.models import Company
+from SalsaVerde.stock.trace import rebuild_trace_links
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the traceability closure table of every company from its ingredients, packaging and orders'
+
+    def handle(self, *args, **options):
+        for company in Company.objects.order_by('pk'):
+            self.stdout.write(f'{company}: {rebuild_trace_links(company.pk)} links')
@@ -0,0 +1,20 @@
+from django.core.management import BaseCommand
+
+from SalsaVerde.stock.inventory import rebuild_inventory
+from SalsaVerde.stock.ledger import RECONCILE_BATCH_SIZE, USAGE, reconcile
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuilds the remaining quantity of every ingredient and packaging batch from its usage, and the inventory of '
+        'every product from its bottling and packing'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=RECONCILE_BATCH_SIZE, help='Batches to check at a time')
+
+    def handle(self, *args, batch_size, **options):
+        for model in USAGE:
+            fixed = reconcile(model, batch_size=batch_size)
+            self.stdout.write(f'{model._meta.verbose_name_plural}: {fixed} fixed')
+        self.stdout.write(f'Product Inventory: {rebuild_inventory()} fixed')
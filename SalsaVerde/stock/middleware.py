@@ -1,8 +1,7 @@
-import re
-
 from django.shortcuts import redirect
 
-EXEMPT_URLS = [re.compile(url) for url in [r'/login/$', r'/static/*', r'/orders/shopify/callback/$']]
+# URL names that can be viewed without being logged in as an administrator.
+EXEMPT_URL_NAMES = frozenset({'login', 'shopify-callback'})
 
 
 class AuthRequiredMiddleware(object):
@@ -10,8 +9,12 @@ class AuthRequiredMiddleware(object):
         self.get_response = get_response
 
     def __call__(self, request):
-        response = self.get_response(request)
-        exempt_url = any(m.match(request.path) for m in EXEMPT_URLS)
-        if (not request.user.is_authenticated or not getattr(request.user, 'administrator', False)) and not exempt_url:
+        return self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # This runs once the URL has been resolved but before the view, so nothing the view does happens for requests
+        # that aren't allowed.
+        if request.resolver_match.url_name in EXEMPT_URL_NAMES:
+            return None
+        if not request.user.is_authenticated or not getattr(request.user, 'administrator', False):
             return redirect('login')
-        return response
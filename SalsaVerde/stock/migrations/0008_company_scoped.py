@@ -0,0 +1,84 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('company', '0006_alter_user_options'),
+        ('stock', '0007_remove_container_goods_intake_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='container',
+            name='company',
+            field=models.ForeignKey(
+                editable=False,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name='+',
+                to='company.company',
+                verbose_name='Company',
+            ),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='company',
+            field=models.ForeignKey(
+                editable=False,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name='+',
+                to='company.company',
+                verbose_name='Company',
+            ),
+        ),
+        migrations.AddField(
+            model_name='ingredient',
+            name='company',
+            field=models.ForeignKey(
+                editable=False,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name='+',
+                to='company.company',
+                verbose_name='Company',
+            ),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='company',
+            field=models.ForeignKey(
+                editable=False,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name='+',
+                to='company.company',
+                verbose_name='Company',
+            ),
+        ),
+        migrations.AddField(
+            model_name='productingredient',
+            name='company',
+            field=models.ForeignKey(
+                editable=False,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name='+',
+                to='company.company',
+                verbose_name='Company',
+            ),
+        ),
+        migrations.AddField(
+            model_name='yieldcontainer',
+            name='company',
+            field=models.ForeignKey(
+                editable=False,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name='+',
+                to='company.company',
+                verbose_name='Company',
+            ),
+        ),
+    ]
@@ -0,0 +1,42 @@
+from django.db import migrations
+from django.db.models import F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+BATCH_SIZE = 5000
+
+# Where each model gets its company from, in order of preference.
+COMPANY_SOURCES = {
+    'container': ['container_type__company_id'],
+    'document': ['author__company_id', 'order__company_id', 'supplier__company_id'],
+    'ingredient': ['ingredient_type__company_id'],
+    'product': ['product_type__company_id'],
+    'productingredient': ['product__product_type__company_id'],
+    'yieldcontainer': ['product__product_type__company_id'],
+}
+
+
+def backfill_company(apps, schema_editor):
+    """
+    Sets the company in batches of primary keys, each committed on its own, so big tables aren't locked for the whole
+    backfill and it can be resumed if it's interrupted.
+    """
+    for model_name, sources in COMPANY_SOURCES.items():
+        model = apps.get_model('stock', model_name)
+        source = Coalesce(*sources) if len(sources) > 1 else F(sources[0])
+        company_id = model.objects.filter(pk=OuterRef('pk')).annotate(_company_id=source).values('_company_id')
+        last_pk = 0
+        while pks := list(
+            model.objects.filter(pk__gt=last_pk, company__isnull=True)
+            .order_by('pk')
+            .values_list('pk', flat=True)[:BATCH_SIZE]
+        ):
+            model.objects.filter(pk__in=pks).update(company_id=Subquery(company_id))
+            last_pk = pks[-1]
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [('stock', '0008_company_scoped')]
+
+    operations = [migrations.RunPython(backfill_company, migrations.RunPython.noop)]
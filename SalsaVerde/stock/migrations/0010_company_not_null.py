@@ -0,0 +1,65 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Documents keep a nullable company as they can outlive the author, order and supplier it comes from.
+    dependencies = [('stock', '0009_backfill_company')]
+
+    operations = [
+        migrations.AlterField(
+            model_name='container',
+            name='company',
+            field=models.ForeignKey(
+                editable=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name='+',
+                to='company.company',
+                verbose_name='Company',
+            ),
+        ),
+        migrations.AlterField(
+            model_name='ingredient',
+            name='company',
+            field=models.ForeignKey(
+                editable=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name='+',
+                to='company.company',
+                verbose_name='Company',
+            ),
+        ),
+        migrations.AlterField(
+            model_name='product',
+            name='company',
+            field=models.ForeignKey(
+                editable=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name='+',
+                to='company.company',
+                verbose_name='Company',
+            ),
+        ),
+        migrations.AlterField(
+            model_name='productingredient',
+            name='company',
+            field=models.ForeignKey(
+                editable=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name='+',
+                to='company.company',
+                verbose_name='Company',
+            ),
+        ),
+        migrations.AlterField(
+            model_name='yieldcontainer',
+            name='company',
+            field=models.ForeignKey(
+                editable=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name='+',
+                to='company.company',
+                verbose_name='Company',
+            ),
+        ),
+    ]
@@ -0,0 +1,66 @@
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # The stock tables can be large, so build the indexes without locking out writes.
+    atomic = False
+
+    dependencies = [('stock', '0010_company_not_null')]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='container',
+            index=models.Index(
+                condition=models.Q(('finished', False)), fields=['company', 'intake_date'], name='container_open_date_idx'
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name='container',
+            index=models.Index(
+                condition=models.Q(('finished', False)),
+                fields=['company', 'container_type', 'intake_date'],
+                name='container_open_type_idx',
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name='container',
+            index=models.Index(
+                condition=models.Q(('finished', False)),
+                fields=['company', 'supplier', 'intake_date'],
+                name='container_open_supplier_idx',
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name='ingredient',
+            index=models.Index(
+                condition=models.Q(('finished', False)), fields=['company', 'intake_date'], name='ingredient_open_date_idx'
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name='ingredient',
+            index=models.Index(
+                condition=models.Q(('finished', False)),
+                fields=['company', 'ingredient_type', 'intake_date'],
+                name='ingredient_open_type_idx',
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name='ingredient',
+            index=models.Index(
+                condition=models.Q(('finished', False)),
+                fields=['company', 'supplier', 'intake_date'],
+                name='ingredient_open_supplier_idx',
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name='product',
+            index=models.Index(
+                models.F('company'),
+                models.F('finished'),
+                models.OrderBy(models.F('date_of_bottling'), descending=True, nulls_last=True),
+                models.OrderBy(models.F('id'), descending=True),
+                name='product_bottling_idx',
+            ),
+        ),
+    ]
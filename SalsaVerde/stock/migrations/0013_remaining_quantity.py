@@ -0,0 +1,22 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [('stock', '0012_search_indexes')]
+
+    operations = [
+        migrations.AddField(
+            model_name='container',
+            name='remaining_quantity',
+            field=models.DecimalField(
+                decimal_places=3, editable=False, max_digits=25, null=True, verbose_name='Remaining'
+            ),
+        ),
+        migrations.AddField(
+            model_name='ingredient',
+            name='remaining_quantity',
+            field=models.DecimalField(
+                decimal_places=3, editable=False, max_digits=25, null=True, verbose_name='Remaining'
+            ),
+        ),
+    ]
@@ -0,0 +1,45 @@
+from decimal import Decimal
+
+from django.db import migrations
+from django.db.models import F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+BATCH_SIZE = 5000
+
+# Each kind of batch, and the model and field that record its usage.
+USAGE = {'ingredient': ('productingredient', 'ingredient'), 'container': ('yieldcontainer', 'container')}
+
+
+def backfill_remaining_quantity(apps, schema_editor):
+    """
+    Sets the remaining quantity from the usage in batches of primary keys, each committed on its own, so big tables
+    aren't locked for the whole backfill and it can be resumed if it's interrupted.
+    """
+    for model_name, (usage_model_name, field) in USAGE.items():
+        model = apps.get_model('stock', model_name)
+        usage_model = apps.get_model('stock', usage_model_name)
+        used = (
+            usage_model.objects.filter(**{field: OuterRef('pk')})
+            .order_by()
+            .values(field)
+            .annotate(total=Sum('quantity'))
+            .values('total')
+        )
+        last_pk = 0
+        while pks := list(
+            model.objects.filter(pk__gt=last_pk, remaining_quantity__isnull=True)
+            .order_by('pk')
+            .values_list('pk', flat=True)[:BATCH_SIZE]
+        ):
+            model.objects.filter(pk__in=pks).update(
+                remaining_quantity=F('quantity') - Coalesce(Subquery(used), Value(Decimal(0)))
+            )
+            last_pk = pks[-1]
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [('stock', '0013_remaining_quantity')]
+
+    operations = [migrations.RunPython(backfill_remaining_quantity, migrations.RunPython.noop)]
@@ -0,0 +1,18 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [('stock', '0014_backfill_remaining_quantity')]
+
+    operations = [
+        migrations.AlterField(
+            model_name='container',
+            name='remaining_quantity',
+            field=models.DecimalField(decimal_places=3, editable=False, max_digits=25, verbose_name='Remaining'),
+        ),
+        migrations.AlterField(
+            model_name='ingredient',
+            name='remaining_quantity',
+            field=models.DecimalField(decimal_places=3, editable=False, max_digits=25, verbose_name='Remaining'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # The stock tables can be large, so build the indexes without locking out writes.
+    atomic = False
+
+    dependencies = [('stock', '0015_remaining_quantity_not_null')]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='container',
+            index=models.Index(
+                condition=models.Q(('finished', False)),
+                fields=['company', 'remaining_quantity', 'id'],
+                name='container_open_remaining_idx',
+            ),
+        ),
+        AddIndexConcurrently(
+            model_name='ingredient',
+            index=models.Index(
+                condition=models.Q(('finished', False)),
+                fields=['company', 'remaining_quantity', 'id'],
+                name='ingredient_open_remaining_idx',
+            ),
+        ),
+    ]
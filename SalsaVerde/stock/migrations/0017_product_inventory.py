@@ -0,0 +1,63 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('company', '0007_search_indexes'),
+        ('stock', '0016_remaining_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductInventory',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bottled', models.DecimalField(decimal_places=3, default=0, max_digits=25, verbose_name='Bottled')),
+                ('packed', models.DecimalField(decimal_places=3, default=0, max_digits=25, verbose_name='Packed')),
+                (
+                    'company',
+                    models.ForeignKey(
+                        editable=False,
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name='+',
+                        to='company.company',
+                        verbose_name='Company',
+                    ),
+                ),
+                (
+                    'container_type',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name='inventory',
+                        to='stock.containertype',
+                        verbose_name='Size',
+                    ),
+                ),
+                (
+                    'product',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name='inventory',
+                        to='stock.product',
+                        verbose_name='Product',
+                    ),
+                ),
+            ],
+            options={
+                'verbose_name': 'Product Inventory',
+                'verbose_name_plural': 'Product Inventory',
+                'indexes': [
+                    models.Index(
+                        condition=models.Q(('bottled__gt', models.F('packed'))),
+                        fields=['company', 'product'],
+                        name='inventory_available_idx',
+                    )
+                ],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='productinventory',
+            constraint=models.UniqueConstraint(fields=('product', 'container_type'), name='product_inventory_unique'),
+        ),
+    ]
@@ -0,0 +1,80 @@
+from django.db import migrations
+from django.db.models import Count, Sum
+
+BATCH_SIZE = 1000
+TYPE_CAP = 'cap'
+
+
+def backfill_product_inventory(apps, schema_editor):
+    """
+    Orders were packed without recording the size, so products only bottled in one size get that size set on their
+    orders. The inventory is then built from the bottling and packing of each batch of products in turn.
+    """
+    Product = apps.get_model('stock', 'Product')
+    ProductInventory = apps.get_model('stock', 'ProductInventory')
+    ProductOrder = apps.get_model('orders', 'ProductOrder')
+    YieldContainer = apps.get_model('stock', 'YieldContainer')
+
+    last_pk = 0
+    while products := dict(
+        Product.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'company_id')[:BATCH_SIZE]
+    ):
+        last_pk = max(products)
+        bottled = YieldContainer.objects.filter(product_id__in=products).exclude(container__container_type__type=TYPE_CAP)
+        sizes = (
+            bottled.order_by()
+            .values('product_id')
+            .annotate(n=Count('container__container_type_id', distinct=True))
+            .filter(n=1)
+            .values_list('product_id', flat=True)
+        )
+        for product_id, container_type_id in (
+            bottled.filter(product_id__in=sizes).values_list('product_id', 'container__container_type_id').distinct()
+        ):
+            ProductOrder.objects.filter(product_id=product_id, container_type__isnull=True).update(
+                container_type_id=container_type_id
+            )
+
+        inventory = {}
+        for product_id, container_type_id, total in (
+            bottled.order_by()
+            .values('product_id', 'container__container_type_id')
+            .annotate(total=Sum('quantity'))
+            .values_list('product_id', 'container__container_type_id', 'total')
+        ):
+            inventory[product_id, container_type_id] = ProductInventory(
+                product_id=product_id,
+                container_type_id=container_type_id,
+                company_id=products[product_id],
+                bottled=total,
+            )
+        for product_id, container_type_id, total in (
+            ProductOrder.objects.filter(product_id__in=products, container_type__isnull=False)
+            .order_by()
+            .values('product_id', 'container_type_id')
+            .annotate(total=Sum('quantity'))
+            .values_list('product_id', 'container_type_id', 'total')
+        ):
+            inventory.setdefault(
+                (product_id, container_type_id),
+                ProductInventory(
+                    product_id=product_id, container_type_id=container_type_id, company_id=products[product_id]
+                ),
+            ).packed = total
+        ProductInventory.objects.bulk_create(
+            inventory.values(),
+            update_conflicts=True,
+            unique_fields=['product', 'container_type'],
+            update_fields=['bottled', 'packed'],
+        )
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('orders', '0015_productorder_container_type'),
+        ('stock', '0017_product_inventory'),
+    ]
+
+    operations = [migrations.RunPython(backfill_product_inventory, migrations.RunPython.noop)]
@@ -0,0 +1,41 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+NODE_TYPES = [('ingredient', 'Raw Ingredient'), ('container', 'Packaging'), ('product', 'Product'), ('order', 'Order')]
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('company', '0007_search_indexes'),
+        ('stock', '0018_backfill_product_inventory'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TraceLink',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ancestor_type', models.CharField(choices=NODE_TYPES, max_length=10)),
+                ('ancestor_id', models.IntegerField()),
+                ('descendant_type', models.CharField(choices=NODE_TYPES, max_length=10)),
+                ('descendant_id', models.IntegerField()),
+                ('depth', models.PositiveSmallIntegerField()),
+                ('paths', models.IntegerField()),
+                (
+                    'company',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, related_name='+', to='company.company'
+                    ),
+                ),
+            ],
+            options={
+                'indexes': [models.Index(fields=['descendant_type', 'descendant_id'], name='trace_link_upstream_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='tracelink',
+            constraint=models.UniqueConstraint(
+                fields=('ancestor_type', 'ancestor_id', 'descendant_type', 'descendant_id'), name='trace_link_unique'
+            ),
+        ),
+    ]
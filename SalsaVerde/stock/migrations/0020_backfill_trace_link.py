@@ -0,0 +1,47 @@
+from django.db import migrations
+
+# The same as SalsaVerde.stock.trace.rebuild_trace_links(), as of this migration.
+EDGES_SQL = """
+SELECT 'ingredient'::text, ingredient_id, 'product'::text, product_id FROM stock_productingredient
+WHERE company_id = %(company_id)s
+UNION ALL SELECT 'container'::text, container_id, 'product'::text, product_id FROM stock_yieldcontainer
+WHERE company_id = %(company_id)s
+UNION ALL SELECT 'product'::text, product_id, 'order'::text, order_id FROM orders_productorder
+WHERE company_id = %(company_id)s
+"""
+
+
+def backfill_trace_links(apps, schema_editor):
+    """
+    Builds the closure table a company at a time, so each insert only holds the one company's paths.
+    """
+    Company = apps.get_model('company', 'Company')
+    for company_id in Company.objects.order_by('pk').values_list('pk', flat=True):
+        schema_editor.execute(
+            f"""
+            INSERT INTO stock_tracelink
+            (company_id, ancestor_type, ancestor_id, descendant_type, descendant_id, depth, paths)
+            WITH RECURSIVE edges (a_type, a_id, d_type, d_id) AS ({EDGES_SQL}),
+            paths (a_type, a_id, d_type, d_id, depth) AS (
+                SELECT a_type, a_id, d_type, d_id, 1 FROM edges
+                UNION ALL
+                SELECT p.a_type, p.a_id, e.d_type, e.d_id, p.depth + 1
+                FROM paths p JOIN edges e ON e.a_type = p.d_type AND e.a_id = p.d_id
+            )
+            SELECT %(company_id)s, a_type, a_id, d_type, d_id, min(depth), count(*)
+            FROM paths GROUP BY a_type, a_id, d_type, d_id
+            ON CONFLICT DO NOTHING
+            """,
+            {'company_id': company_id},
+        )
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('orders', '0015_productorder_container_type'),
+        ('stock', '0019_trace_link'),
+    ]
+
+    operations = [migrations.RunPython(backfill_trace_links, migrations.RunPython.noop)]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.9 on 2026-10-18 12:10
+
+import django.contrib.postgres.indexes
+import django.db.models.functions.text
+from django.contrib.postgres.operations import AddIndexConcurrently, TrigramExtension
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [('stock', '0020_backfill_trace_link')]
+
+    operations = [
+        TrigramExtension(),
+        AddIndexConcurrently(
+            model_name='container',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('batch_code'), name='gin_trgm_ops'), name='container_batch_code_trgm_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='ingredient',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('batch_code'), name='gin_trgm_ops'), name='ingredient_batch_code_trgm_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='product',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('batch_code'), name='gin_trgm_ops'), name='product_batch_code_trgm_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='producttypesize',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('name'), name='gin_trgm_ops'), name='product_size_name_trgm_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='supplier',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('name'), name='gin_trgm_ops'), name='supplier_name_trgm_idx'),
+        ),
+    ]
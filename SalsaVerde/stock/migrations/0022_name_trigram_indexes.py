@@ -0,0 +1,27 @@
+# Generated by Django 4.2.9 on 2026-10-18 12:40
+
+import django.contrib.postgres.indexes
+import django.db.models.functions.text
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [('stock', '0021_trigram_indexes')]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='containertype',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('name'), name='gin_trgm_ops'), name='container_type_name_trgm_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='ingredienttype',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('name'), name='gin_trgm_ops'), name='ingredient_type_name_trgm_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='producttype',
+            index=django.contrib.postgres.indexes.GinIndex(django.contrib.postgres.indexes.OpClass(django.db.models.functions.text.Upper('name'), name='gin_trgm_ops'), name='product_type_name_trgm_idx'),
+        ),
+    ]
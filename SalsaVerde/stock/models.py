@@ -1,13 +1,24 @@
 from decimal import Decimal
 
+from django.contrib.postgres.indexes import GinIndex
 from django.db import models
-from django.db.models import QuerySet
+from django.db.models import F, Q, QuerySet
 from django.forms import JSONField
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.safestring import mark_safe
 
-from SalsaVerde.company.models import BaseModel, CompanyNameBaseModel, User
+from SalsaVerde.common.row_cache import bump_row_versions
+from SalsaVerde.company.models import (
+    Company,
+    CompanyNameBaseModel,
+    CompanyQueryset,
+    CompanyScopedModel,
+    User,
+    display_related,
+    search_vector,
+    trigram_index,
+)
 from SalsaVerde.storage_backends import PrivateMediaStorage
 
 
@@ -49,6 +60,10 @@ class Supplier(CompanyNameBaseModel):
         ordering = ('name',)
         verbose_name = 'Supplier'
         verbose_name_plural = 'Suppliers'
+        indexes = [
+            GinIndex(search_vector('name'), name='supplier_search_idx'),
+            trigram_index('name', 'supplier_name_trgm_idx'),
+        ]
 
 
 class IngredientType(CompanyNameBaseModel):
@@ -71,11 +86,7 @@ class IngredientType(CompanyNameBaseModel):
         ordering = ('name',)
         verbose_name = 'Raw Ingredient Type'
         verbose_name_plural = 'Raw Ingredients Types'
-
-
-class IngredientQuerySet(QuerySet):
-    def request_qs(self, request):
-        return self.filter(ingredient_type__company=request.user.company)
+        indexes = [trigram_index('name', 'ingredient_type_name_trgm_idx')]
 
 
 def _display_dec(v: Decimal):
@@ -84,8 +95,43 @@ def _display_dec(v: Decimal):
     return v
 
 
-class Ingredient(BaseModel):
-    objects = IngredientQuerySet.as_manager()
+class StockBatch(CompanyScopedModel):
+    """
+    A batch of stock received in one intake. remaining_quantity starts as the intake quantity and is then kept up to
+    date by SalsaVerde.stock.ledger as the batch is used. After it's created it's only ever changed with F() updates,
+    never written from the instance, so a stale instance being saved can't undo usage recorded since it was loaded.
+    """
+
+    remaining_quantity = models.DecimalField('Remaining', max_digits=25, decimal_places=3, editable=False)
+
+    def save(self, *args, update_fields=None, **kwargs):
+        if self._state.adding:
+            if self.remaining_quantity is None:
+                self.remaining_quantity = self.quantity
+            return super().save(*args, update_fields=update_fields, **kwargs)
+
+        if update_fields is None:
+            update_fields = [f.name for f in self._meta.concrete_fields if not f.primary_key]
+        update_fields = [f for f in update_fields if f != 'remaining_quantity']
+        old_quantity = None
+        if 'quantity' in update_fields:
+            old_quantity = type(self).objects.filter(pk=self.pk).values_list('quantity', flat=True).first()
+        super().save(*args, update_fields=update_fields, **kwargs)
+        if old_quantity is not None and old_quantity != self.quantity:
+            # A corrected intake quantity changes what's left by the same amount.
+            type(self).objects.filter(pk=self.pk).update(
+                remaining_quantity=F('remaining_quantity') + (Decimal(str(self.quantity)) - old_quantity)
+            )
+            # post_save has already bumped the row version, so rows rendered since then would have the old value.
+            bump_row_versions(type(self), [self.pk])
+            self.refresh_from_db(fields=['remaining_quantity'])
+
+    class Meta:
+        abstract = True
+
+
+class Ingredient(StockBatch):
+    company_from = ('ingredient_type',)
 
     ingredient_type = models.ForeignKey(
         IngredientType,
@@ -131,9 +177,14 @@ class Ingredient(BaseModel):
     def get_absolute_url(self):
         return reverse('ingredients-details', kwargs={'pk': self.pk})
 
+    @display_related('ingredient_type')
     def display_quantity(self):
         return f'{float(self.quantity):,g} {dict(IngredientType.UNIT_TYPES)[self.ingredient_type.unit]}s'
 
+    @display_related('ingredient_type')
+    def display_remaining_quantity(self):
+        return f'{float(self.remaining_quantity):,g} {dict(IngredientType.UNIT_TYPES)[self.ingredient_type.unit]}s'
+
     def __str__(self):
         return mark_safe(f'{self.name} - {self.batch_code} - {self.intake_date:%d/%m/%Y}')
 
@@ -149,6 +200,30 @@ class Ingredient(BaseModel):
         ordering = ('ingredient_type__name',)
         verbose_name = 'Raw Ingredient'
         verbose_name_plural = 'Raw Ingredients'
+        # The list shows unfinished stock by default, filtered by the fields of IngredientFilterForm.
+        indexes = [
+            models.Index(
+                fields=['company', 'intake_date'], condition=Q(finished=False), name='ingredient_open_date_idx'
+            ),
+            models.Index(
+                fields=['company', 'ingredient_type', 'intake_date'],
+                condition=Q(finished=False),
+                name='ingredient_open_type_idx',
+            ),
+            models.Index(
+                fields=['company', 'supplier', 'intake_date'],
+                condition=Q(finished=False),
+                name='ingredient_open_supplier_idx',
+            ),
+            # For sorting and filtering by what's left, see the ledger in SalsaVerde.stock.ledger.
+            models.Index(
+                fields=['company', 'remaining_quantity', 'id'],
+                condition=Q(finished=False),
+                name='ingredient_open_remaining_idx',
+            ),
+            GinIndex(search_vector('batch_code'), name='ingredient_search_idx'),
+            trigram_index('batch_code', 'ingredient_batch_code_trgm_idx'),
+        ]
 
 
 class ContainerType(CompanyNameBaseModel):
@@ -173,15 +248,11 @@ class ContainerType(CompanyNameBaseModel):
     class Meta:
         verbose_name = 'Packaging Type'
         verbose_name_plural = 'Packaging Types'
+        indexes = [trigram_index('name', 'container_type_name_trgm_idx')]
 
 
-class ContainerQuerySet(QuerySet):
-    def request_qs(self, request):
-        return self.filter(container_type__company=request.user.company)
-
-
-class Container(BaseModel):
-    objects = ContainerQuerySet.as_manager()
+class Container(StockBatch):
+    company_from = ('container_type',)
 
     container_type = models.ForeignKey(
         ContainerType,
@@ -226,9 +297,14 @@ class Container(BaseModel):
     def prefix(cls):
         return 'containers'
 
+    @display_related('container_type')
     def display_quantity(self):
         return f'{float(self.quantity):,g} {dict(ContainerType.TYPE_CONTAINERS)[self.container_type.type]}s'
 
+    @display_related('container_type')
+    def display_remaining_quantity(self):
+        return f'{float(self.remaining_quantity):,g} {dict(ContainerType.TYPE_CONTAINERS)[self.container_type.type]}s'
+
     def get_absolute_url(self):
         return reverse('containers-details', kwargs={'pk': self.pk})
 
@@ -242,15 +318,34 @@ class Container(BaseModel):
     class Meta:
         verbose_name = 'Packaging'
         verbose_name_plural = 'Packaging'
-
-
-class YieldContainerQuerySet(QuerySet):
-    def request_qs(self, request):
-        return self.filter(product__product_type__company=request.user.company)
-
-
-class YieldContainer(BaseModel):
-    objects = YieldContainerQuerySet.as_manager()
+        # The list shows unfinished stock by default, filtered by the fields of ContainerFilterForm.
+        indexes = [
+            models.Index(
+                fields=['company', 'intake_date'], condition=Q(finished=False), name='container_open_date_idx'
+            ),
+            models.Index(
+                fields=['company', 'container_type', 'intake_date'],
+                condition=Q(finished=False),
+                name='container_open_type_idx',
+            ),
+            models.Index(
+                fields=['company', 'supplier', 'intake_date'],
+                condition=Q(finished=False),
+                name='container_open_supplier_idx',
+            ),
+            # For sorting and filtering by what's left, see the ledger in SalsaVerde.stock.ledger.
+            models.Index(
+                fields=['company', 'remaining_quantity', 'id'],
+                condition=Q(finished=False),
+                name='container_open_remaining_idx',
+            ),
+            GinIndex(search_vector('batch_code'), name='container_search_idx'),
+            trigram_index('batch_code', 'container_batch_code_trgm_idx'),
+        ]
+
+
+class YieldContainer(CompanyScopedModel):
+    company_from = ('product',)
 
     product = models.ForeignKey(
         'stock.Product', verbose_name='Product', related_name='yield_containers', on_delete=models.CASCADE
@@ -263,6 +358,7 @@ class YieldContainer(BaseModel):
     def get_absolute_url(self):
         return self.container.get_absolute_url()
 
+    @display_related('container__container_type')
     def display_quantity(self):
         return f'{float(self.quantity):,g} {dict(ContainerType.TYPE_CONTAINERS)[self.container.container_type.type]}s'
 
@@ -271,6 +367,7 @@ class YieldContainer(BaseModel):
         if self.container.container_type.size:
             return self.quantity * self.container.container_type.size
 
+    @display_related('container__container_type')
     def display_total_volume(self):
         return f'{float(self.total_volume):,g} litres'
 
@@ -287,17 +384,19 @@ class ProductType(CompanyNameBaseModel):
         return reverse('product-types-details', kwargs={'pk': self.pk})
 
     def display_ingredient_types(self):
-        return ', '.join(self.ingredient_types.values_list('name', flat=True).order_by('name'))
+        # Uses .all() so that prefetched ingredient types are used when rendering lists
+        return ', '.join(sorted(it.name for it in self.ingredient_types.all()))
 
     class Meta:
         ordering = ('name',)
         verbose_name = 'Product Type'
         verbose_name_plural = 'Product Types'
+        indexes = [trigram_index('name', 'product_type_name_trgm_idx')]
 
 
 class ProductTypeSizeQuerySet(QuerySet):
     def request_qs(self, request):
-        return self.filter(product_type__company=request.user.company)
+        return self.filter(product_type__company_id=request.user.company_id)
 
 
 class ProductTypeSize(models.Model):
@@ -316,13 +415,14 @@ class ProductTypeSize(models.Model):
     def prefix(cls):
         return 'product-type-sizes'
 
-
-class ProductQuerySet(QuerySet):
-    def request_qs(self, request):
-        return self.filter(product_type__company=request.user.company)
+    class Meta:
+        indexes = [
+            GinIndex(search_vector('name', 'sku_code', 'bar_code'), name='product_size_search_idx'),
+            trigram_index('name', 'product_size_name_trgm_idx'),
+        ]
 
 
-class Product(BaseModel):
+class Product(CompanyScopedModel):
     STATUS_INFUSED = 'infused'
     STATUS_BOTTLED = 'bottled'
     STATUSES = (
@@ -330,7 +430,7 @@ class Product(BaseModel):
         (STATUS_BOTTLED, 'Bottled'),
     )
 
-    objects = ProductQuerySet.as_manager()
+    company_from = ('product_type',)
 
     product_type = models.ForeignKey(
         ProductType, verbose_name='Product', related_name='products', on_delete=models.CASCADE
@@ -366,15 +466,68 @@ class Product(BaseModel):
         verbose_name = 'Product'
         verbose_name_plural = 'Products'
         ordering = ('product_type__name',)
+        indexes = [
+            # Matches the order ProductList pages through current or finished products in.
+            models.Index(
+                'company',
+                'finished',
+                F('date_of_bottling').desc(nulls_last=True),
+                F('id').desc(),
+                name='product_bottling_idx',
+            ),
+            GinIndex(search_vector('batch_code'), name='product_search_idx'),
+            trigram_index('batch_code', 'product_batch_code_trgm_idx'),
+        ]
+
+
+class ProductInventoryQuerySet(CompanyQueryset):
+    def available(self):
+        # The same condition as inventory_available_idx, so the index is used.
+        return self.filter(bottled__gt=F('packed'))
+
+
+class ProductInventory(CompanyScopedModel):
+    """
+    How many units of a product have been bottled in each size of container, and how many of them have been packed
+    into orders. Kept up to date by SalsaVerde.stock.inventory as products are bottled and packed.
+    """
+
+    company_from = ('product',)
+
+    product = models.ForeignKey(Product, verbose_name='Product', on_delete=models.CASCADE, related_name='inventory')
+    container_type = models.ForeignKey(
+        ContainerType, verbose_name='Size', on_delete=models.CASCADE, related_name='inventory'
+    )
+    bottled = models.DecimalField('Bottled', max_digits=25, decimal_places=3, default=0)
+    packed = models.DecimalField('Packed', max_digits=25, decimal_places=3, default=0)
 
+    objects = ProductInventoryQuerySet.as_manager()
 
-class ProductIngredientQuerySet(QuerySet):
-    def request_qs(self, request):
-        return self.filter(product__product_type__company=request.user.company)
+    @property
+    def available(self):
+        return self.bottled - self.packed
+
+    def display_available(self):
+        return f'{float(self.available):,g}'
+
+    def __str__(self):
+        return f'{self.container_type.name}: {self.display_available()} available'
+
+    class Meta:
+        verbose_name = 'Product Inventory'
+        verbose_name_plural = 'Product Inventory'
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'container_type'], name='product_inventory_unique'),
+        ]
+        indexes = [
+            models.Index(
+                fields=['company', 'product'], condition=Q(bottled__gt=F('packed')), name='inventory_available_idx'
+            ),
+        ]
 
 
-class ProductIngredient(BaseModel):
-    objects = ProductIngredientQuerySet.as_manager()
+class ProductIngredient(CompanyScopedModel):
+    company_from = ('product',)
 
     product = models.ForeignKey(
         Product, verbose_name='Product', on_delete=models.CASCADE, related_name='product_ingredients'
@@ -385,16 +538,50 @@ class ProductIngredient(BaseModel):
     def get_absolute_url(self):
         return self.ingredient.get_absolute_url()
 
+    @display_related('ingredient__ingredient_type')
     def display_quantity(self):
         return f'{float(self.quantity):,g} {dict(IngredientType.UNIT_TYPES)[self.ingredient.ingredient_type.unit]}'
 
 
-class DocumentQuerySet(QuerySet):
-    def request_qs(self, request):
-        return self.filter(author__company=request.user.company)
+class TraceLink(models.Model):
+    """
+    A closure table of the traceability graph: a row for every batch, product and order, and every product and order
+    made from or containing it, however many steps away. So everything up or downstream of something is found with a
+    single indexed lookup. Kept up to date by SalsaVerde.stock.trace, paths counts the routes between the two so a link
+    is only removed when the last of them is.
+    """
+
+    NODE_INGREDIENT = 'ingredient'
+    NODE_CONTAINER = 'container'
+    NODE_PRODUCT = 'product'
+    NODE_ORDER = 'order'
+    NODE_TYPES = (
+        (NODE_INGREDIENT, 'Raw Ingredient'),
+        (NODE_CONTAINER, 'Packaging'),
+        (NODE_PRODUCT, 'Product'),
+        (NODE_ORDER, 'Order'),
+    )
 
+    objects = CompanyQueryset.as_manager()
 
-class Document(BaseModel):
+    company = models.ForeignKey(Company, on_delete=models.CASCADE, related_name='+')
+    ancestor_type = models.CharField(max_length=10, choices=NODE_TYPES)
+    ancestor_id = models.IntegerField()
+    descendant_type = models.CharField(max_length=10, choices=NODE_TYPES)
+    descendant_id = models.IntegerField()
+    depth = models.PositiveSmallIntegerField()
+    paths = models.IntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['ancestor_type', 'ancestor_id', 'descendant_type', 'descendant_id'], name='trace_link_unique'
+            ),
+        ]
+        indexes = [models.Index(fields=['descendant_type', 'descendant_id'], name='trace_link_upstream_idx')]
+
+
+class Document(CompanyScopedModel):
     FORM_COM1 = 'com1'
     FORM_COM2 = 'com2'
     FORM_GL01 = 'gl01'
@@ -433,7 +620,12 @@ class Document(BaseModel):
         (FORM_VIS01, 'VIS01 - Visitor Questionnaire'),
     )
 
-    objects = DocumentQuerySet.as_manager()
+    company_from = ('author', 'order', 'supplier')
+
+    # Documents can outlive all of the objects their company comes from.
+    company = models.ForeignKey(
+        Company, verbose_name='Company', on_delete=models.CASCADE, editable=False, null=True, related_name='+'
+    )
 
     date_created = models.DateTimeField('Date Created', auto_now_add=True)
     author = models.ForeignKey(
@@ -480,6 +672,7 @@ class Document(BaseModel):
         if self.type:
             return dict(self.FORM_TYPES)[self.type]
 
+    @display_related('supplier')
     def display_supplier(self):
         if self.supplier:
             return link(self.supplier.get_absolute_url(), str(self.supplier))
@@ -0,0 +1,276 @@
+"""
+Recall impact reports: when a batch is flagged, everything made from it, how much of it there is and who it went to.
+
+Reports are built by an RQ job so they don't tie up a web worker. The products and orders come from the traceability
+closure table (see SalsaVerde.stock.trace), and are then read REPORT_CHUNK_SIZE at a time and written straight to a
+temporary file, so the job uses the same memory however many orders there are. The CSV is saved as a TRA01 document,
+and the job's progress is kept in its meta for the page waiting for it.
+"""
+
+import csv
+import io
+import tempfile
+
+from django.core.files import File
+from django.db.models import Count, Q, Sum
+from django.db.models.fields.json import KT
+from django.utils import timezone
+from django_rq import job
+from rq import get_current_job
+
+from SalsaVerde.common.views import export_value
+from SalsaVerde.company.models import User
+from SalsaVerde.orders.models import Order, ProductOrder
+from SalsaVerde.stock.models import Complaint, Container, Document, Ingredient, Product, ProductInventory, TraceLink
+from SalsaVerde.stock.trace import TRACE_MODELS, trace_ids
+
+REPORT_CHUNK_SIZE = 500
+
+
+def _chunks(ids) -> list[list[int]]:
+    ids = sorted(ids)
+    return [ids[i : i + REPORT_CHUNK_SIZE] for i in range(0, len(ids), REPORT_CHUNK_SIZE)]
+
+
+def _date(dt) -> str:
+    return f'{dt:%d/%m/%Y}' if dt else ''
+
+
+def _number(v) -> str:
+    return f'{float(v or 0):g}'
+
+
+def _write_rows(writer, rows):
+    # Names, addresses and complaints come from Shopify and customers, so are escaped like the list exports.
+    writer.writerows([export_value(v) for v in row] for row in rows)
+
+
+class _Progress:
+    """
+    Records how many of the chunks have been written in the meta of the job running the report, if there is one.
+    """
+
+    def __init__(self, total: int):
+        self.job = get_current_job()
+        self.total = max(total, 1)
+        self.done = 0
+        self.update(0)
+
+    def update(self, done: int):
+        self.done += done
+        if self.job:
+            self.job.meta['progress'] = int(100 * self.done / self.total)
+            self.job.save_meta()
+
+
+def _batch_rows(model, ids):
+    type_field = 'ingredient_type' if model is Ingredient else 'container_type'
+    for chunk in _chunks(ids):
+        yield [
+            [code, type_name, supplier or '', _date(intake_date), _number(quantity), _number(remaining)]
+            for code, type_name, supplier, intake_date, quantity, remaining in (
+                model.objects.filter(pk__in=chunk)
+                .order_by('intake_date', 'pk')
+                .values_list(
+                    'batch_code',
+                    f'{type_field}__name',
+                    'supplier__name',
+                    'intake_date',
+                    'quantity',
+                    'remaining_quantity',
+                )
+            )
+        ]
+
+
+def _product_rows(ids):
+    for chunk in _chunks(ids):
+        yield [
+            [
+                code or '',
+                type_name,
+                _date(infusion),
+                _date(bottling),
+                _date(best_before),
+                _number(bottled),
+                _number(packed),
+                _number((bottled or 0) - (packed or 0)),
+            ]
+            for code, type_name, infusion, bottling, best_before, bottled, packed in (
+                Product.objects.filter(pk__in=chunk)
+                .order_by('date_of_infusion', 'pk')
+                .annotate(bottled=Sum('inventory__bottled'), packed=Sum('inventory__packed'))
+                .values_list(
+                    'batch_code',
+                    'product_type__name',
+                    'date_of_infusion',
+                    'date_of_bottling',
+                    'date_of_best_before',
+                    'bottled',
+                    'packed',
+                )
+            )
+        ]
+
+
+def _order_rows(ids, product_ids):
+    statuses = dict(Order.STATUS_CHOICES)
+    for chunk in _chunks(ids):
+        packed = {}
+        for order_id, code, quantity in (
+            ProductOrder.objects.filter(order_id__in=chunk, product_id__in=product_ids)
+            .order_by('pk')
+            .values_list('order_id', 'product__batch_code', 'quantity')
+        ):
+            packed.setdefault(order_id, []).append(f'{code} x {_number(quantity)}')
+        # Only the parts of extra_data needed for the contact details, not the whole of every order.
+        orders = (
+            Order.objects.filter(pk__in=chunk)
+            .order_by('created', 'pk')
+            .values_list(
+                'pk',
+                KT('extra_data__name'),
+                'created',
+                'status',
+                'user__first_name',
+                'user__last_name',
+                'user__email',
+                'user__phone',
+                KT('extra_data__shipping_address__name'),
+                KT('extra_data__shipping_address__phone'),
+                KT('extra_data__shipping_address__address1'),
+                KT('extra_data__shipping_address__city'),
+                KT('extra_data__shipping_address__zip'),
+                KT('extra_data__shipping_address__country_code'),
+            )
+        )
+        rows = []
+        for pk, name, created, status, first_name, last_name, email, phone, *shipping in orders:
+            ship_name, ship_phone, *address = shipping
+            rows.append(
+                [
+                    name or f'#{pk}',
+                    _date(created),
+                    statuses[status],
+                    f'{first_name or ""} {last_name or ""}'.strip() or ship_name or '',
+                    email or '',
+                    phone or ship_phone or '',
+                    ', '.join(a for a in address if a),
+                    '; '.join(packed.get(pk, [])),
+                ]
+            )
+        yield rows
+
+
+def _complaint_rows(ids):
+    reasons = dict(Complaint.COMPLAINT_TYPES)
+    for chunk in _chunks(ids):
+        yield [
+            [_date(created), name, reasons.get(reason, reason), description]
+            for created, name, reason, description in (
+                Complaint.objects.filter(pk__in=chunk)
+                .order_by('date_created', 'pk')
+                .values_list('date_created', 'complainant_name', 'complaint_type', 'description')
+            )
+        ]
+
+
+@job
+def recall_report(company_id: int, node_type: str, pk: int, user_id: int) -> int:
+    """
+    Writes the recall impact report of the object as a TRA01 document, returning the document's id.
+    """
+    obj = TRACE_MODELS[node_type].objects.get(pk=pk, company_id=company_id)
+    traced = trace_ids(company_id, node_type, [pk])
+    product_ids, order_ids = traced[TraceLink.NODE_PRODUCT], traced[TraceLink.NODE_ORDER]
+    complaint_ids = set(
+        Complaint.affected_product.through.objects.filter(product_id__in=product_ids).values_list(
+            'complaint_id', flat=True
+        )
+    )
+    sections = [
+        (
+            'Raw Ingredients',
+            ['Batch Code', 'Ingredient', 'Supplier', 'Intake Date', 'Quantity', 'Remaining'],
+            traced[TraceLink.NODE_INGREDIENT],
+            _batch_rows(Ingredient, traced[TraceLink.NODE_INGREDIENT]),
+        ),
+        (
+            'Packaging',
+            ['Batch Code', 'Packaging', 'Supplier', 'Intake Date', 'Quantity', 'Remaining'],
+            traced[TraceLink.NODE_CONTAINER],
+            _batch_rows(Container, traced[TraceLink.NODE_CONTAINER]),
+        ),
+        (
+            'Products',
+            [
+                'Batch Code',
+                'Product',
+                'Date of Production',
+                'Date of Bottling',
+                'Best Before',
+                'Bottled',
+                'Packed',
+                'In Stock',
+            ],
+            product_ids,
+            _product_rows(product_ids),
+        ),
+        (
+            'Orders',
+            ['Order', 'Date', 'Status', 'Customer', 'Email', 'Phone', 'Address', 'Batches'],
+            order_ids,
+            _order_rows(order_ids, product_ids),
+        ),
+        (
+            'Complaints',
+            ['Date', 'Complainant', 'Reason', 'Description'],
+            complaint_ids,
+            _complaint_rows(complaint_ids),
+        ),
+    ]
+    progress = _Progress(sum(len(_chunks(ids)) for _, _, ids, _ in sections))
+
+    orders = Order.objects.filter(pk__in=order_ids)
+    summary = orders.aggregate(
+        shipped=Count('pk', filter=Q(status=Order.STATUS_FULFILLED)), customers=Count('user', distinct=True)
+    )
+    stock = ProductInventory.objects.filter(product_id__in=product_ids).aggregate(
+        bottled=Sum('bottled'), packed=Sum('packed')
+    )
+    with tempfile.TemporaryFile() as f:
+        text = io.TextIOWrapper(f, encoding='utf-8', newline='')
+        writer = csv.writer(text)
+        _write_rows(
+            writer,
+            [
+                ['Recall Impact Report'],
+                ['Traced from', str(obj)],
+                ['Generated', f'{timezone.now():%d/%m/%Y %H:%M}'],
+                ['Products', len(product_ids)],
+                ['Units bottled', _number(stock['bottled'])],
+                ['Units packed', _number(stock['packed'])],
+                ['Orders', len(order_ids)],
+                ['Orders shipped', summary['shipped']],
+                ['Customers', summary['customers']],
+                ['Complaints', len(complaint_ids)],
+            ],
+        )
+        for title, headers, _, rows in sections:
+            _write_rows(writer, [[], [title], headers])
+            for chunk in rows:
+                _write_rows(writer, chunk)
+                progress.update(1)
+        text.flush()
+        f = text.detach()
+        f.seek(0)
+
+        doc = Document(
+            type=Document.FORM_TRA01,
+            author=User.objects.filter(pk=user_id).first(),
+            supplier_id=getattr(obj, 'supplier_id', None),
+            company_id=company_id,
+        )
+        doc.file.save(f'tra01-recall-{node_type}-{pk}-{timezone.now():%Y-%m-%d}.csv', File(f), save=False)
+        doc.save()
+    return doc.pk
@@ -0,0 +1,81 @@
+"""
+The raw ingredient batches that can go into a new product of each product type, for the add product form.
+
+The batches for every ingredient type of a product type are fetched with one query (a left join, so ingredient types
+with nothing in stock are still listed), and the result is cached in Redis per company. Each company has a version
+token that's changed whenever its ingredients, ingredient types or product types change, and the cache keys include
+it, so a change makes every cached recipe of the company stale at once. Anything that changes those without sending
+signals (eg. bulk_create) needs to call invalidate_recipes().
+"""
+
+import uuid
+
+from django.core.cache import cache
+from django.db.models import FilteredRelation, Q
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from SalsaVerde.stock.models import Ingredient, IngredientType, ProductType
+
+RECIPE_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def _version_key(company_id: int) -> str:
+    return f'sv-recipever:{company_id}'
+
+
+def invalidate_recipes(company_id: int):
+    cache.set(_version_key(company_id), uuid.uuid4().hex, timeout=None)
+
+
+@receiver(post_save, sender=Ingredient)
+@receiver(post_delete, sender=Ingredient)
+@receiver(post_save, sender=IngredientType)
+@receiver(post_delete, sender=IngredientType)
+@receiver(post_save, sender=ProductType)
+@receiver(post_delete, sender=ProductType)
+def _invalidate_on_change(sender, instance, raw=False, **kwargs):
+    if not raw:
+        invalidate_recipes(instance.company_id)
+
+
+@receiver(m2m_changed, sender=ProductType.ingredient_types.through)
+def _invalidate_on_m2m_change(sender, instance, action, **kwargs):
+    if action.startswith('post_'):
+        invalidate_recipes(instance.company_id)
+
+
+def _fetch_recipe(company_id: int, product_type_id: int) -> list[dict] | None:
+    recipe = {}
+    for type_id, name, unit, ingredient_id, batch_code, intake_date in (
+        IngredientType.objects.filter(company_id=company_id, product_types=product_type_id)
+        .annotate(unfinished=FilteredRelation('ingredients', condition=Q(ingredients__finished=False)))
+        .order_by('name', 'pk', 'unfinished__intake_date', 'unfinished__pk')
+        .values_list('pk', 'name', 'unit', 'unfinished__pk', 'unfinished__batch_code', 'unfinished__intake_date')
+    ):
+        ingredient_type = recipe.setdefault(type_id, {'choices': [], 'unit': unit, 'name': name})
+        if ingredient_id:
+            # The same as str(Ingredient).
+            ingredient_type['choices'].append((ingredient_id, f'{name} - {batch_code} - {intake_date:%d/%m/%Y}'))
+    if not recipe and not ProductType.objects.filter(company_id=company_id, pk=product_type_id).exists():
+        return None
+    return list(recipe.values())
+
+
+def get_recipe(company_id: int, product_type_id: int) -> list[dict] | None:
+    """
+    Returns the ingredient types of the product type with their unit and the (id, name) of their unfinished batches,
+    or None if the company has no such product type.
+    """
+    version = cache.get(_version_key(company_id))
+    if not version:
+        version = uuid.uuid4().hex
+        cache.add(_version_key(company_id), version, timeout=None)
+        version = cache.get(_version_key(company_id), version)
+    key = f'sv-recipe:{company_id}:{version}:{product_type_id}'
+    recipe = cache.get(key)
+    if recipe is None:
+        recipe = _fetch_recipe(company_id, product_type_id)
+        if recipe is not None:
+            cache.set(key, recipe, RECIPE_CACHE_TIMEOUT)
+    return recipe
@@ -1,11 +1,55 @@
+import csv
+import datetime
+import re
+from unittest import mock
+
+from django.db import connection, transaction
+from django.db.models import F
 from django.test import Client
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 
+from SalsaVerde.common import row_cache, search, views as common_views
+from SalsaVerde.common.pagination import (
+    KeysetPaginator,
+    ObjectCount,
+    capped_count,
+    estimated_count,
+    exact_count,
+)
 from SalsaVerde.common.tests import SVTestCase
+from SalsaVerde.common.views import DisplayPlan, ExtraContentPanel
+from SalsaVerde.orders.factories.orders import OrderFactory
+from SalsaVerde.orders.models import Order
 from SalsaVerde.stock.factories.company import CompanyFactory
-from SalsaVerde.stock.factories.raw_materials import ContainerTypeFactory, IngredientTypeFactory, ProductTypeFactory
+from SalsaVerde.stock.factories.product import ProductFactory
+from SalsaVerde.stock.factories.raw_materials import (
+    ContainerFactory,
+    ContainerTypeFactory,
+    IngredientFactory,
+    IngredientTypeFactory,
+    ProductTypeFactory,
+    ProductTypeSizeFactory,
+)
 from SalsaVerde.stock.factories.supplier import SupplierFactory
-from SalsaVerde.stock.models import User
+from SalsaVerde.stock.factories.users import UserFactory
+from SalsaVerde.stock.models import (
+    Container,
+    ContainerType,
+    Document,
+    Ingredient,
+    IngredientType,
+    Product,
+    ProductIngredient,
+    ProductType,
+    Supplier,
+    User,
+    YieldContainer,
+)
+from SalsaVerde.stock.views.ingredients.details import IngredientDetails
+from SalsaVerde.stock.views.ingredients.list import IngredientList
+from SalsaVerde.stock.views.suppliers import SupplierDetails, SupplierList
 
 
 class QSTestCase(SVTestCase):
@@ -69,3 +113,602 @@ class SetupTestCase(SVTestCase):
         self.assertContains(r, 'Blackberry and Thyme')
         self.assertContains(r, 'IngredType')
         self.assertContains(r, 'ContainerType')
+
+
+class DisplayPlanTestCase(SVTestCase):
+    def setUp(self):
+        self.client = AuthenticatedClient()
+        self.company = self.client.user.company
+        self.ingredient = IngredientFactory(
+            ingredient_type__company=self.company,
+            ingredient_type__name='blackberries',
+            supplier__company=self.company,
+            supplier__name='good food',
+            batch_code='bb123',
+            quantity=10,
+        )
+
+    def test_plan_labels_and_values(self):
+        plan = IngredientDetails.get_display_plan(IngredientDetails.display_items)
+        assert plan.labels[:5] == ['Raw ingredient type', 'Quantity', 'Remaining', 'Batch Code', 'Supplier']
+        values = plan.values(IngredientDetails(), self.ingredient)
+        assert values[0] == f'<a href="{self.ingredient.ingredient_type.get_absolute_url()}">blackberries</a>'
+        assert values[1] == '10 kgs'
+        assert values[2] == '10 kgs'
+        assert values[3] == 'bb123'
+        assert values[7] == '<span class="fa fa-times"></span'
+        assert values[9] == '–'
+
+    def test_plan_reused_between_requests(self):
+        common_views._display_plans.clear()
+        with mock.patch('SalsaVerde.common.views._compile_getter', wraps=common_views._compile_getter) as compile:
+            self.consume(self.client.get(reverse('ingredients')))
+            assert compile.call_count == len(IngredientList.display_items)
+            r = self.consume(self.client.get(reverse('ingredients')))
+            assert compile.call_count == len(IngredientList.display_items)
+        self.assertContains(r, 'bb123')
+        plan = IngredientList.get_display_plan(IngredientList.display_items)
+        assert plan is IngredientList.get_display_plan(list(IngredientList.display_items))
+
+
+class QueryCountTestCase(SVTestCase):
+    """
+    Pages should select/prefetch everything their display items use, so adding more rows doesn't add more queries.
+    """
+
+    def setUp(self):
+        self.client = AuthenticatedClient()
+        self.user = self.client.user
+        self.company = self.user.company
+        self.company.main_contact = self.user
+        self.company.save()
+        self.supplier = SupplierFactory(company=self.company)
+        self.ingredient_type = IngredientTypeFactory(company=self.company)
+        self.container_type = ContainerTypeFactory(company=self.company)
+        self.product_type = ProductTypeFactory(company=self.company)
+
+    def add_rows(self, count):
+        for _ in range(count):
+            ingredient = IngredientFactory(
+                ingredient_type=self.ingredient_type, supplier=self.supplier, intake_user=self.user
+            )
+            container = ContainerFactory(
+                container_type=self.container_type, supplier=self.supplier, intake_user=self.user
+            )
+            product = ProductFactory(product_type=self.product_type)
+            ProductIngredient.objects.create(product=product, ingredient=ingredient, quantity=1)
+            YieldContainer.objects.create(product=product, container=container, quantity=1)
+            ProductTypeFactory(company=self.company)
+            ProductTypeSizeFactory(product_type=self.product_type)
+            UserFactory(company=self.company)
+            Document.objects.create(author=self.user, supplier=self.supplier, focus=self.user)
+            OrderFactory(company=self.company, user=UserFactory(company=self.company, administrator=False))
+
+    def query_count(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            r = self.consume(self.client.get(url))
+        assert r.status_code == 200, url
+        return len(queries)
+
+    def test_constant_queries(self):
+        self.add_rows(1)
+        product = self.product_type.products.first()
+        urls = [
+            reverse('ingredients'),
+            reverse('ingredients-details', args=[self.ingredient_type.ingredients.first().pk]),
+            reverse('ingredient-types-details', args=[self.ingredient_type.pk]),
+            reverse('containers'),
+            reverse('containers-details', args=[self.container_type.containers.first().pk]),
+            reverse('container-types-details', args=[self.container_type.pk]),
+            reverse('products'),
+            reverse('products-details', args=[product.pk]),
+            reverse('product-types'),
+            reverse('product-types-details', args=[self.product_type.pk]),
+            reverse('suppliers'),
+            reverse('suppliers-details', args=[self.supplier.pk]),
+            reverse('documents'),
+            reverse('users'),
+            reverse('users-details', args=[self.user.pk]),
+            reverse('orders-list'),
+            reverse('setup'),
+        ]
+        query_counts = {url: self.query_count(url) for url in urls}
+        self.add_rows(4)
+        for url in urls:
+            assert self.query_count(url) == query_counts[url], url
+
+
+class KeysetPaginationTestCase(SVTestCase):
+    def setUp(self):
+        self.client = AuthenticatedClient()
+        self.user = self.client.user
+        self.company = self.user.company
+        self.supplier = SupplierFactory(company=self.company)
+
+    def walk(self, paginator):
+        pages, page = [], paginator.page()
+        while True:
+            pages.append([obj.pk for obj in page])
+            if not page.has_next():
+                break
+            page = paginator.page(page.next_cursor)
+        backwards = [[obj.pk for obj in page]]
+        while page.has_previous():
+            page = paginator.page(page.previous_cursor)
+            backwards.insert(0, [obj.pk for obj in page])
+        assert backwards == pages
+        return pages
+
+    def test_ties_and_nulls(self):
+        product_type = ProductTypeFactory(company=self.company)
+        dt = timezone.now()
+        dates = [dt, None, dt - datetime.timedelta(days=1), dt, None, dt - datetime.timedelta(days=2), dt]
+        products = [ProductFactory(product_type=product_type, date_of_bottling=d) for d in dates]
+        expected = [
+            p.pk for p in Product.objects.order_by(F('date_of_bottling').desc(nulls_last=True), '-pk') if p in products
+        ]
+        paginator = KeysetPaginator(Product.objects.filter(product_type=product_type), ['-date_of_bottling'], 2)
+        pages = self.walk(paginator)
+        assert [len(p) for p in pages] == [2, 2, 2, 1]
+        assert sum(pages, []) == expected
+
+    def test_related_ordering(self):
+        types = [IngredientTypeFactory(company=self.company, name=n) for n in ['b', 'a', 'c']]
+        for i in range(7):
+            IngredientFactory(ingredient_type=types[i % 3], supplier=self.supplier)
+        expected = list(Ingredient.objects.order_by('ingredient_type__name', 'pk').values_list('pk', flat=True))
+        paginator = KeysetPaginator(Ingredient.objects.all(), ['ingredient_type__name'], 3)
+        assert sum(self.walk(paginator), []) == expected
+
+    def test_list_view(self):
+        ingredient_type = IngredientTypeFactory(company=self.company)
+        ingredients = [
+            IngredientFactory(ingredient_type=ingredient_type, supplier=self.supplier, batch_code=f'batch-{i}')
+            for i in range(3)
+        ]
+        with mock.patch.object(IngredientList, 'paginate_by', 2):
+            with CaptureQueriesContext(connection) as queries:
+                r = self.consume(self.client.get(reverse('ingredients')))
+            assert not any('OFFSET' in q['sql'] or 'COUNT(' in q['sql'] for q in queries.captured_queries)
+            self.assertContains(r, ingredients[0].batch_code)
+            self.assertContains(r, ingredients[1].batch_code)
+            self.assertNotContains(r, ingredients[2].batch_code)
+            next_cursor = re.search(r'\?cursor=([^"&]+)', r.content.decode()).group(1)
+
+            r = self.consume(self.client.get(reverse('ingredients') + f'?cursor={next_cursor}'))
+            self.assertNotContains(r, ingredients[0].batch_code)
+            self.assertContains(r, ingredients[2].batch_code)
+            self.assertContains(r, 'Previous')
+
+        r = self.client.get(reverse('ingredients') + '?cursor=foobar')
+        assert r.status_code == 404
+
+
+@mock.patch('SalsaVerde.common.pagination.COUNT_CAP', 3)
+class CountStrategyTestCase(SVTestCase):
+    def setUp(self):
+        self.client = AuthenticatedClient()
+        self.company = self.client.user.company
+        self.suppliers = [SupplierFactory(company=self.company, name=f'supplier {i}') for i in range(5)]
+
+    def test_strategies(self):
+        qs = Supplier.objects.filter(company=self.company)
+        assert exact_count(qs) == ObjectCount(5)
+        assert str(exact_count(qs)) == '5'
+        assert capped_count(qs) == ObjectCount(3, exact=False)
+        assert str(capped_count(qs)) == '3+'
+        assert capped_count(qs[:2]) == ObjectCount(2)
+        count = estimated_count(qs)
+        assert not count.exact
+        assert count.value > 3
+        assert str(count) == f'~{count.value:,}'
+        assert estimated_count(qs.filter(name='supplier 1')) == ObjectCount(1)
+
+    def test_list_view(self):
+        with mock.patch.object(SupplierList, 'paginate_by', 2):
+            with CaptureQueriesContext(connection) as queries:
+                r = self.client.get(reverse('suppliers'))
+            assert any(q['sql'].startswith('EXPLAIN') for q in queries.captured_queries)
+            self.assertContains(r, 'of ~')
+            self.assertContains(r, 'count exactly')
+
+            r = self.client.get(reverse('suppliers') + '?exact_count=1&page=3')
+            self.assertContains(r, '5&ndash;5 of 5')
+            self.assertContains(r, self.suppliers[4].name)
+            self.assertNotContains(r, 'count exactly')
+
+            r = self.client.get(reverse('suppliers') + '?exact_count=1&page=4')
+            assert r.status_code == 404
+
+    def test_capped_count_pages(self):
+        url = reverse('suppliers')
+        with mock.patch.object(SupplierList, 'paginate_by', 2):
+            with mock.patch.object(SupplierList, 'get_count_strategy', return_value=capped_count):
+                r = self.client.get(url + '?page=2')
+                self.assertContains(r, '3&ndash;4 of 3+')
+                # The cap puts the last page at 2 but there's a third page, and no link to a last page we can't know.
+                self.assertContains(r, 'href="?page=3"')
+                self.assertNotContains(r, '&raquo;</a>')
+
+                r = self.client.get(url + '?page=3')
+                self.assertContains(r, '5&ndash;5 of 3+')
+                self.assertContains(r, self.suppliers[4].name)
+                self.assertNotContains(r, 'href="?page=4"')
+
+                r = self.client.get(url + '?page=4')
+                assert r.status_code == 404
+
+    def test_estimate_too_high(self):
+        url = reverse('suppliers')
+        with mock.patch.object(SupplierList, 'paginate_by', 2):
+            with mock.patch.object(SupplierList, 'get_count_strategy', return_value=lambda qs: ObjectCount(500, False)):
+                r = self.client.get(url)
+                self.assertContains(r, 'of ~500')
+                self.assertContains(r, 'href="?page=2"')
+                self.assertNotContains(r, 'href="?page=3"')
+                self.assertNotContains(r, 'href="?page=250"')
+
+                r = self.client.get(url + '?page=3')
+                self.assertContains(r, self.suppliers[4].name)
+                self.assertNotContains(r, 'href="?page=4"')
+
+
+class ExtraContentPanelTestCase(SVTestCase):
+    def setUp(self):
+        self.client = AuthenticatedClient()
+        self.company = self.client.user.company
+        self.supplier = SupplierFactory(company=self.company)
+        self.ingredient_type = IngredientTypeFactory(company=self.company)
+        for _ in range(5):
+            IngredientFactory(ingredient_type=self.ingredient_type, supplier=self.supplier)
+
+    @mock.patch.object(ExtraContentPanel, 'size', 2)
+    def test_panel_more_link(self):
+        with CaptureQueriesContext(connection) as queries:
+            r = self.consume(self.client.get(reverse('suppliers-details', args=[self.supplier.pk])))
+        panel_queries = [q['sql'] for q in queries.captured_queries if 'LIMIT 3' in q['sql']]
+        # The panels fetch one row more than they show, rather than counting them all.
+        assert len(panel_queries) == 3
+        assert not any('COUNT(' in q['sql'] for q in queries.captured_queries)
+        assert r.content.decode().count('ingred_') == 2
+        list_url = reverse('ingredients') + f'?supplier={self.supplier.pk}&amp;finished=all'
+        self.assertContains(r, f'<a class="view-all" href="{list_url}">2+ &middot; View all</a>', html=True)
+
+        r = self.consume(self.client.get(reverse('ingredients') + f'?supplier={self.supplier.pk}&finished=all'))
+        assert r.content.decode().count('ingred_') == 5
+
+    def test_panels_lazy(self):
+        view = SupplierDetails()
+        view.request = mock.Mock(user=self.client.user)
+        view.object = self.supplier
+        with CaptureQueriesContext(connection) as queries:
+            panels = view._get_extra_content()
+        assert len(queries) == 0
+        assert [p.title for p in panels] == ['Supplied Raw Ingredients', 'Supplied Containers', 'Associated Documents']
+        with CaptureQueriesContext(connection) as queries:
+            assert len(panels[0].field_vals) == 5
+            assert not panels[0].has_more
+        assert len(queries) == 1
+
+
+class RowCacheTestCase(SVTestCase):
+    def setUp(self):
+        self.client = AuthenticatedClient()
+        self.company = self.client.user.company
+        self.supplier = SupplierFactory(company=self.company, name='Old supplier')
+        self.ingredient_type = IngredientTypeFactory(company=self.company)
+        self.ingredients = [
+            IngredientFactory(ingredient_type=self.ingredient_type, supplier=self.supplier) for _ in range(3)
+        ]
+
+    def render(self):
+        with mock.patch.object(DisplayPlan, 'values', autospec=True, side_effect=DisplayPlan.values) as values:
+            with mock.patch.object(row_cache.cache, 'get_many', wraps=row_cache.cache.get_many) as get_many:
+                r = self.consume(self.client.get(reverse('ingredients')))
+        assert get_many.call_count == 1
+        return r, values.call_count
+
+    def test_rows_cached(self):
+        r, rendered = self.render()
+        assert rendered == 3
+        r2, rendered = self.render()
+        assert rendered == 0
+        table = re.compile(r'<tbody>.*</tbody>', re.S)
+        assert table.search(r.content.decode()).group() == table.search(r2.content.decode()).group()
+
+    def test_invalidated_on_save(self):
+        self.render()
+        self.ingredients[0].batch_code = 'new batch code'
+        self.ingredients[0].save()
+        r, rendered = self.render()
+        assert rendered == 1
+        self.assertContains(r, 'new batch code')
+
+        self.supplier.name = 'New supplier'
+        self.supplier.save()
+        r, rendered = self.render()
+        assert rendered == 3
+        self.assertContains(r, 'New supplier')
+        self.assertNotContains(r, 'Old supplier')
+
+    def test_versions_changed_on_commit(self):
+        key = row_cache._version_key(self.ingredients[0])
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                self.ingredients[0].save()
+                version = row_cache.cache.get(key)
+                # Rendered by another request before the save is committed.
+                self.render()
+        assert version
+        assert row_cache.cache.get(key) != version
+        _, rendered = self.render()
+        assert rendered == 1
+        assert 0 < row_cache.cache.ttl(key) <= row_cache.VERSION_TIMEOUT
+
+    def test_evicted_version(self):
+        self.render()
+        row_cache.cache.delete(row_cache._version_key(self.ingredients[0]))
+        _, rendered = self.render()
+        assert rendered == 1
+        _, rendered = self.render()
+        assert rendered == 0
+
+
+class ExportTestCase(SVTestCase):
+    def setUp(self):
+        self.client = AuthenticatedClient()
+        self.company = self.client.user.company
+        self.supplier = SupplierFactory(company=self.company, name='=SUM(A1)')
+        self.ingredient_type = IngredientTypeFactory(company=self.company, name='Salt')
+        for _ in range(3):
+            IngredientFactory(ingredient_type=self.ingredient_type, supplier=self.supplier)
+        IngredientFactory(
+            ingredient_type=self.ingredient_type, supplier=SupplierFactory(company=self.company, name='-2+3+cmd|calc')
+        )
+        IngredientFactory(ingredient_type=self.ingredient_type, supplier=self.supplier, finished=True)
+
+    def export(self, url):
+        r = self.client.get(url)
+        assert r.status_code == 200
+        assert r.streaming
+        assert r['Content-Type'] == 'text/csv'
+        return list(csv.reader(b''.join(r.streaming_content).decode().splitlines()))
+
+    @mock.patch.object(IngredientList, 'paginate_by', 2)
+    def test_export_filtered(self):
+        rows = self.export(reverse('ingredients') + f'?supplier={self.supplier.pk}&export=csv&page=2')
+        assert rows[0] == ['Raw ingredient type', 'Batch Code', 'Intake date', 'Supplier', 'Quantity', 'Remaining']
+        assert len(rows) == 4
+        assert {r[0] for r in rows[1:]} == {'Salt'}
+        assert {r[3] for r in rows[1:]} == {"'=SUM(A1)"}
+
+        rows = self.export(reverse('ingredients') + '?finished=all&export=csv')
+        assert len(rows) == 6
+        assert {r[3] for r in rows[1:]} == {"'=SUM(A1)", "'-2+3+cmd|calc"}
+
+    def test_export_html_values(self):
+        order = OrderFactory(company=self.company)
+        rows = self.export(reverse('orders-list') + '?export=csv')
+        assert rows[0][0] == 'Order'
+        assert rows[1][0] == f'Order #{order.id}'
+
+    def test_export_link(self):
+        r = self.client.get(reverse('ingredients') + f'?supplier={self.supplier.pk}&page=2')
+        self.assertContains(r, f'href="?export=csv&supplier={self.supplier.pk}"')
+
+
+class StreamingResponseTestCase(SVTestCase):
+    def setUp(self):
+        self.client = AuthenticatedClient()
+        self.company = self.client.user.company
+        self.supplier = SupplierFactory(company=self.company)
+        IngredientFactory(ingredient_type__company=self.company, supplier=self.supplier, batch_code='streamed-123')
+
+    def test_list_rows_rendered_lazily(self):
+        with mock.patch.object(DisplayPlan, 'values', autospec=True, side_effect=DisplayPlan.values) as values:
+            r = self.client.get(reverse('ingredients'))
+            assert r.streaming
+            assert values.call_count == 0
+            self.assertContains(r, 'streamed-123')
+            assert values.call_count == 1
+
+    def test_panels_rendered_lazily(self):
+        with CaptureQueriesContext(connection) as queries:
+            r = self.client.get(reverse('suppliers-details', args=[self.supplier.pk]))
+            assert r.streaming
+            assert not any('FROM "stock_ingredient"' in q['sql'] for q in queries.captured_queries)
+            self.assertContains(r, 'streamed-123')
+            assert any('FROM "stock_ingredient"' in q['sql'] for q in queries.captured_queries)
+
+    def test_messages_shown_once(self):
+        order = OrderFactory(company=self.company, status=Order.STATUS_FULFILLED)
+        r = self.client.get(reverse('fulfill-order-dhl', kwargs={'pk': order.pk}), follow=True)
+        assert r.streaming
+        self.assertContains(r, 'Order already fulfilled')
+        r = self.client.get(reverse('orders-list'))
+        self.assertNotContains(r, 'Order already fulfilled')
+
+
+class AuthRequiredTestCase(SVTestCase):
+    def setUp(self):
+        self.company = CompanyFactory()
+        self.order = OrderFactory(company=self.company)
+        self.client = Client()
+
+    def test_anon_no_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            r = self.client.get(reverse('order-details', args=[self.order.pk]))
+        self.assertRedirects(r, reverse('login'), fetch_redirect_response=False)
+        assert len(queries) == 0
+
+    def test_not_administrator(self):
+        user = UserFactory(company=self.company, administrator=False)
+        self.client.force_login(user)
+        with CaptureQueriesContext(connection) as queries:
+            r = self.client.get(reverse('order-details', args=[self.order.pk]))
+        self.assertRedirects(r, reverse('login'), fetch_redirect_response=False)
+        # Only the session and user are loaded.
+        assert len(queries) == 2
+        assert not any('orders_order' in q['sql'] for q in queries.captured_queries)
+
+    def test_exempt(self):
+        r = self.client.get(reverse('login'))
+        assert r.status_code == 200
+        r = self.client.post(reverse('shopify-callback'))
+        assert r.status_code != 302
+
+
+class GlobalSearchTestCase(SVTestCase):
+    def setUp(self):
+        self.client = AuthenticatedClient()
+        self.company = self.client.user.company
+        self.ingredient = IngredientFactory(ingredient_type__company=self.company, batch_code='BB-20240611-07')
+        self.container = ContainerFactory(container_type__company=self.company, batch_code='CAP20240611')
+        self.supplier = SupplierFactory(company=self.company, name='Burren Balsamics')
+        self.size = ProductTypeSizeFactory(product_type__company=self.company, sku_code='SV-250', name='250ml')
+        self.order = OrderFactory(
+            company=self.company,
+            shopify_id='555',
+            extra_data={'name': '#1042', 'customer': {'first_name': 'Brian', 'last_name': 'Johnston'}},
+        )
+        IngredientFactory(batch_code='BB-20240611-99')
+
+    def search(self, q):
+        r = self.client.get(reverse('search'), {'q': q})
+        assert r.status_code == 200
+        return r.json()['results']
+
+    def test_partial_batch_code(self):
+        results = self.search('bb-2024')
+        assert results == [
+            {
+                'type': 'Raw Ingredient',
+                'title': f'{self.ingredient.ingredient_type.name} - BB-20240611-07',
+                'url': reverse('ingredients-details', args=[self.ingredient.pk]),
+            }
+        ]
+        assert [r['url'] for r in self.search('cap2024')] == [reverse('containers-details', args=[self.container.pk])]
+
+    def test_across_models(self):
+        assert self.search('burren') == [
+            {
+                'type': 'Supplier',
+                'title': 'Burren Balsamics',
+                'url': reverse('suppliers-details', args=[self.supplier.pk]),
+            }
+        ]
+        assert [r['url'] for r in self.search('sv-25')] == [
+            reverse('product-types-details', args=[self.size.product_type_id])
+        ]
+        assert [r['title'] for r in self.search('1042')] == ['Order #1042']
+        assert [r['title'] for r in self.search('brian john')] == ['Order #1042']
+        assert [r['title'] for r in self.search('tom owner')] == ['Tom Owner']
+
+    def test_substring(self):
+        assert {r['url'] for r in self.search('0611')} == {
+            reverse('ingredients-details', args=[self.ingredient.pk]),
+            reverse('containers-details', args=[self.container.pk]),
+        }
+        assert [r['title'] for r in self.search('alsam')] == ['Burren Balsamics']
+        # Too short to match other than as a prefix.
+        assert self.search('06') == []
+
+    def test_one_query(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.search('bb')
+        assert len([q for q in queries.captured_queries if 'to_tsquery' in q['sql']]) == 1
+
+    def test_no_terms(self):
+        assert self.search('') == []
+        assert self.search('-- & !') == []
+
+    def test_search_indexes_used(self):
+        query = search._search_query('bb')
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        for model, *_ in search.SEARCH_SOURCES:
+            plan = model.objects.annotate(_search=search._search_vector(model)).filter(_search=query).explain()
+            assert '_search_idx' in plan, plan
+
+    def test_trigram_indexes_used(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        for model, *_, substring_field in search.SEARCH_SOURCES:
+            if substring_field:
+                plan = model.objects.filter(**{f'{substring_field}__icontains': '0611'}).explain()
+                assert '_trgm_idx' in plan, plan
+
+
+class AutocompleteTestCase(SVTestCase):
+    def setUp(self):
+        self.client = AuthenticatedClient()
+        self.company = self.client.user.company
+        self.product = ProductFactory(product_type__company=self.company)
+        bottle = ContainerTypeFactory(company=self.company, name='250ml Bottle', type=ContainerType.TYPE_BOTTLE)
+        for i in range(25):
+            ContainerFactory(container_type=bottle, batch_code=f'BOT-{i}')
+        ContainerFactory(container_type=bottle, batch_code='BOT-FINISHED', finished=True)
+        ContainerFactory(
+            container_type__company=self.company, container_type__type=ContainerType.TYPE_CAP, batch_code='CAP-1'
+        )
+        ContainerFactory(container_type__name='250ml Bottle', batch_code='BOT-OTHER')
+        self.search_url = reverse('autocomplete', args=['YieldContainersForm', 'container'])
+
+    def search(self, url, **params):
+        r = self.client.get(url, params)
+        assert r.status_code == 200
+        return r.json()
+
+    def test_search(self):
+        r = self.client.get(reverse('yield-container-add', args=[self.product.pk]))
+        self.assertContains(r, f'data-autocomplete-url="{self.search_url}"')
+        self.assertNotContains(r, 'BOT-1')
+
+        data = self.search(self.search_url, q='250ml bot')
+        assert len(data['results']) == 20
+        assert data['pagination'] == {'more': True}
+        data_2 = self.search(self.search_url, q='250ml bot', page=2)
+        assert data_2['pagination'] == {'more': False}
+        codes = {r['text'].split(' - ')[1] for r in data['results'] + data_2['results']}
+        assert codes == {f'BOT-{i}' for i in range(25)}
+        # The bottles all share a name, so the pages are ordered by pk within it.
+        assert [r['id'] for r in data['results'] + data_2['results']] == sorted(
+            Container.objects.filter(batch_code__regex=r'^BOT-\d+$').values_list('pk', flat=True)
+        )
+
+        assert self.search(self.search_url, q='bot-13 250')['results'] == [
+            {'id': Container.objects.get(batch_code='BOT-13').pk, 'text': '250ml Bottle - BOT-13'}
+        ]
+        assert self.search(self.search_url, q='cap')['results'] == []
+        cap_url = reverse('autocomplete', args=['YieldContainersForm', 'cap'])
+        assert [r['text'] for r in self.search(cap_url, q='cap')['results']] == [
+            str(Container.objects.get(batch_code='CAP-1'))
+        ]
+
+    def test_selected_option(self):
+        alpha = SupplierFactory(company=self.company, name='Alpha Farm')
+        SupplierFactory(company=self.company, name='Beta Farm')
+        r = self.client.get(reverse('ingredients'), {'supplier': alpha.pk})
+        self.assertContains(r, f'<option value="{alpha.pk}" selected>Alpha Farm</option>', html=True)
+        self.assertNotContains(r, 'Beta Farm')
+        url = reverse('autocomplete', args=['IngredientFilterForm', 'supplier'])
+        assert [r['text'] for r in self.search(url, q='alp')['results']] == ['Alpha Farm']
+
+    def test_not_found(self):
+        assert self.client.get(reverse('autocomplete', args=['YieldContainersForm', 'quantity'])).status_code == 404
+        assert self.client.get(reverse('autocomplete', args=['AddProductForm', 'product_type'])).status_code == 404
+
+    def test_indexes_used(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        for model, field in [
+            (Ingredient, 'batch_code'),
+            (Container, 'batch_code'),
+            (Product, 'batch_code'),
+            (IngredientType, 'name'),
+            (ContainerType, 'name'),
+            (ProductType, 'name'),
+            (Supplier, 'name'),
+        ]:
+            plan = model.objects.filter(**{f'{field}__istartswith': 'bot'}).explain()
+            assert '_trgm_idx' in plan, plan
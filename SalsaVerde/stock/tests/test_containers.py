@@ -319,3 +319,21 @@ class ContainerListTestCase(SVTestCase):
         )
         self.assertContains(r, 'Bottle123')
         self.assertContains(r, 'Box123')
+
+
+class ContainerIntakeTestCase(SVTestCase):
+    def setUp(self):
+        self.client = AuthenticatedClient()
+        self.company = self.client.user.company
+
+    def test_import(self):
+        ContainerTypeFactory(company=self.company, name='250ml Bottle')
+        ContainerTypeFactory(company=self.company, name='Cap')
+        rows = 'Type,Batch Code,Quantity\n250ml bottle,BOT-1,1000\nCap,CAP-1,1000\n'
+        r = self.client.post(reverse('containers-import'), data={'rows': rows}, follow=True)
+        self.assertContains(r, '2 packaging batches added')
+        assert sorted(Container.objects.values_list('container_type__name', 'batch_code', 'remaining_quantity')) == [
+            ('250ml Bottle', 'BOT-1', 1000),
+            ('Cap', 'CAP-1', 1000),
+        ]
+        assert set(Container.objects.values_list('company', flat=True)) == {self.company.pk}
@@ -0,0 +1,122 @@
+import re
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from SalsaVerde.common.tests import SVTestCase
+from SalsaVerde.company.models import Company
+from SalsaVerde.stock.models import ContainerType, IngredientType, ProductType
+from SalsaVerde.stock.tests.test_common import AuthenticatedClient
+
+ROWS = 5_000
+COMPANIES = 50
+
+
+class ListIndexTestCase(SVTestCase):
+    """
+    Checks the default list queries can use an index rather than scanning and sorting the table. The rows are split
+    between companies and most of them are finished, as they would be in a real database, but there are too few of
+    them for the planner to prefer an index on its own, so scans and sorts are discouraged when explaining the queries.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company = Company.objects.create(name='Big Tenant')
+        companies = [cls.company] + Company.objects.bulk_create(
+            [Company(name=f'Tenant {i}') for i in range(COMPANIES - 1)]
+        )
+        cls.ingredient_type, *_ = IngredientType.objects.bulk_create(
+            [IngredientType(name='Thyme', unit=IngredientType.UNIT_KILO, company=c) for c in companies]
+        )
+        container_types = ContainerType.objects.bulk_create(
+            [ContainerType(name='200ml', size=0.2, company=c) for c in companies]
+        )
+        product_types = ProductType.objects.bulk_create(
+            [ProductType(name='Pesto', code='PE', company=c) for c in companies]
+        )
+        ingredient_types = list(IngredientType.objects.values_list('id', flat=True))
+        with connection.cursor() as cursor:
+            for table, type_col, type_ids in [
+                ('stock_ingredient', 'ingredient_type_id', ingredient_types),
+                ('stock_container', 'container_type_id', [ct.id for ct in container_types]),
+            ]:
+                cursor.execute(
+                    f"""
+                    INSERT INTO {table} ({type_col}, company_id, batch_code, intake_quality_check, quantity,
+                                         remaining_quantity, finished, intake_date)
+                    SELECT t.id, t.company_id, 'B' || i, true, 10, i %% 11, i %% 20 != 0, now() - i * interval '1 minute'
+                    FROM generate_series(0, %s) i JOIN {table}type t ON t.id = (%s::int[])[i %% %s + 1]
+                    """,
+                    [ROWS - 1, type_ids, len(type_ids)],
+                )
+            cursor.execute(
+                """
+                INSERT INTO stock_product (product_type_id, company_id, date_of_infusion, date_of_bottling,
+                                           date_of_best_before, batch_code, status, batch_code_applied,
+                                           best_before_applied, quality_check_successful, finished)
+                SELECT t.id, t.company_id, now(), now() - i * interval '1 minute', now(), 'P' || i, 'bottled', true,
+                       true, true, i %% 20 != 0
+                FROM generate_series(0, %s) i JOIN stock_producttype t ON t.id = (%s::int[])[i %% %s + 1]
+                """,
+                [ROWS - 1, [pt.id for pt in product_types], len(product_types)],
+            )
+            # Check the deferred foreign keys now, otherwise they're checked again at the end of every test.
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+            cursor.execute('SET CONSTRAINTS ALL DEFERRED')
+            cursor.execute(
+                'ANALYZE stock_ingredient, stock_container, stock_product, stock_ingredienttype, stock_containertype, '
+                'stock_producttype'
+            )
+
+    def setUp(self):
+        self.client = AuthenticatedClient(company=self.company)
+
+    def list_plan(self, url, table) -> str:
+        with CaptureQueriesContext(connection) as queries:
+            r = self.consume(self.client.get(url))
+        assert r.status_code == 200
+        (sql,) = [q['sql'] for q in queries if f'FROM "{table}"' in q['sql'] and 'LIMIT' in q['sql']]
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute('SET LOCAL enable_sort = off')
+            cursor.execute(f'EXPLAIN {sql}')
+            return '\n'.join(row[0] for row in cursor.fetchall())
+
+    def test_ingredient_list(self):
+        plan = self.list_plan(reverse('ingredients'), 'stock_ingredient')
+        # Any of the unfinished stock indexes can be used, they all start with the company.
+        assert re.search(r'Index Scan (on|using) ingredient_open_\w+_idx', plan), plan
+        assert not re.search(r'Seq Scan on stock_ingredient\b', plan), plan
+
+    def test_ingredient_list_type_filter(self):
+        plan = self.list_plan(
+            reverse('ingredients') + f'?ingredient_type={self.ingredient_type.id}&finished=not-finished',
+            'stock_ingredient',
+        )
+        assert re.search(r'Index Scan (on|using) ingredient_open_\w+_idx', plan), plan
+
+    def test_container_list(self):
+        plan = self.list_plan(reverse('containers'), 'stock_container')
+        assert re.search(r'Index Scan (on|using) container_open_\w+_idx', plan), plan
+        assert not re.search(r'Seq Scan on stock_container\b', plan), plan
+
+    def test_product_list(self):
+        plan = self.list_plan(reverse('products'), 'stock_product')
+        assert 'Index Scan using product_bottling_idx' in plan, plan
+        assert 'Sort' not in plan, plan
+
+    def test_finished_product_list(self):
+        plan = self.list_plan(reverse('products') + '?finished=true', 'stock_product')
+        assert 'Index Scan using product_bottling_idx' in plan, plan
+
+    def test_ingredient_list_by_remaining(self):
+        plan = self.list_plan(reverse('ingredients') + '?sort=remaining', 'stock_ingredient')
+        assert 'Index Scan using ingredient_open_remaining_idx' in plan, plan
+        assert 'Sort' not in plan, plan
+
+    def test_container_list_low_stock(self):
+        plan = self.list_plan(
+            reverse('containers') + '?remaining_below=2&finished=not-finished&sort=remaining', 'stock_container'
+        )
+        assert 'Index Scan using container_open_remaining_idx' in plan, plan
@@ -1,13 +1,20 @@
 from datetime import datetime, timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
 
 from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
 from django.urls import reverse
 
 from SalsaVerde.common.tests import SVTestCase
+from SalsaVerde.stock.factories.product import ProductFactory
 from SalsaVerde.stock.factories.raw_materials import IngredientFactory, IngredientTypeFactory
 from SalsaVerde.stock.factories.supplier import SupplierFactory
 from SalsaVerde.stock.factories.users import UserFactory
-from SalsaVerde.stock.models import Ingredient, IngredientType
+from SalsaVerde.stock.ledger import reconcile
+from SalsaVerde.stock.models import Ingredient, IngredientType, ProductIngredient
 from SalsaVerde.stock.tests.test_common import AuthenticatedClient
 
 
@@ -326,3 +333,176 @@ class IngredientTestCase(SVTestCase):
         self.assertRedirects(r, ing.get_absolute_url())
         assert Ingredient.objects.get().finished
         self.assertContains(r, 'Mark as In stock')
+
+
+class RemainingQuantityTestCase(SVTestCase):
+    def setUp(self):
+        self.client = AuthenticatedClient()
+        self.company = self.client.user.company
+        self.ingredient_type = IngredientTypeFactory(company=self.company, name='blackberries')
+        self.product = ProductFactory(
+            product_type__company=self.company, product_ingredient_1=None, product_ingredient_2=None
+        )
+
+    def remaining(self, ingredient):
+        ingredient.refresh_from_db()
+        return ingredient.remaining_quantity
+
+    def test_intake(self):
+        ingred = IngredientFactory(ingredient_type=self.ingredient_type, quantity=10)
+        assert self.remaining(ingred) == 10
+
+    def test_used(self):
+        ingred = IngredientFactory(ingredient_type=self.ingredient_type, quantity=10)
+        r = self.client.post(
+            reverse('product-ingredient-add', args=[self.product.pk]), {'ingredient': ingred.pk, 'quantity': 2.5}
+        )
+        self.assertRedirects(r, self.product.get_absolute_url())
+        assert self.remaining(ingred) == Decimal('7.5')
+        ProductIngredient.objects.create(product=self.product, ingredient=ingred, quantity=3)
+        assert self.remaining(ingred) == Decimal('4.5')
+
+    def test_usage_changed(self):
+        ingred = IngredientFactory(ingredient_type=self.ingredient_type, quantity=10)
+        other = IngredientFactory(ingredient_type=self.ingredient_type, quantity=20)
+        pi = ProductIngredient.objects.create(product=self.product, ingredient=ingred, quantity=3)
+        pi.quantity = 4
+        pi.save()
+        assert self.remaining(ingred) == 6
+
+        pi.ingredient = other
+        pi.save()
+        assert self.remaining(ingred) == 10
+        assert self.remaining(other) == 16
+
+    def test_usage_deleted(self):
+        ingred = IngredientFactory(ingredient_type=self.ingredient_type, quantity=10)
+        ProductIngredient.objects.create(product=self.product, ingredient=ingred, quantity=3)
+        ProductIngredient.objects.create(product=self.product, ingredient=ingred, quantity=4)
+        assert self.remaining(ingred) == 3
+        ProductIngredient.objects.filter(quantity=4).delete()
+        assert self.remaining(ingred) == 7
+        # Deleting the product deletes its ingredients, so they go back into stock.
+        self.product.delete()
+        assert self.remaining(ingred) == 10
+
+    def test_quantity_corrected(self):
+        ingred = IngredientFactory(ingredient_type=self.ingredient_type, quantity=10)
+        ProductIngredient.objects.create(product=self.product, ingredient=ingred, quantity=3)
+        stale = Ingredient.objects.get(pk=ingred.pk)
+        ProductIngredient.objects.create(product=self.product, ingredient=ingred, quantity=2)
+
+        # Saving an instance loaded before the last usage doesn't undo it.
+        stale.intake_notes = 'Damaged'
+        stale.save()
+        assert self.remaining(ingred) == 5
+
+        stale.quantity = 12
+        with mock.patch('SalsaVerde.stock.models.bump_row_versions') as bump_row_versions:
+            stale.save()
+        bump_row_versions.assert_called_once_with(Ingredient, [ingred.pk])
+        assert self.remaining(ingred) == 7
+        stale.save(update_fields=['finished'])
+        assert self.remaining(ingred) == 7
+
+    def test_reconcile(self):
+        ingred = IngredientFactory(ingredient_type=self.ingredient_type, quantity=10)
+        unused = IngredientFactory(ingredient_type=self.ingredient_type, quantity=5)
+        ProductIngredient.objects.create(product=self.product, ingredient=ingred, quantity=3)
+        Ingredient.objects.update(remaining_quantity=0)
+
+        assert reconcile(Ingredient, batch_size=1) == 2
+        assert self.remaining(ingred) == 7
+        assert self.remaining(unused) == 5
+        assert reconcile(Ingredient) == 0
+
+        out = StringIO()
+        call_command('reconcile_stock', stdout=out)
+        assert 'Raw Ingredients: 0 fixed' in out.getvalue()
+
+    def test_list_remaining(self):
+        ingred = IngredientFactory(ingredient_type=self.ingredient_type, quantity=10, batch_code='Plenty')
+        low = IngredientFactory(ingredient_type=self.ingredient_type, quantity=10, batch_code='Low')
+        ProductIngredient.objects.create(product=self.product, ingredient=low, quantity=9)
+        ProductIngredient.objects.create(product=self.product, ingredient=ingred, quantity=1)
+
+        r = self.consume(self.client.get(reverse('ingredients')))
+        self.assertContains(r, '9 kgs')
+        self.assertContains(r, '1 kgs')
+
+        r = self.consume(self.client.get(reverse('ingredients') + '?remaining_below=5'))
+        self.assertContains(r, 'Low')
+        self.assertNotContains(r, 'Plenty')
+
+        r = self.consume(self.client.get(reverse('ingredients') + '?sort=remaining'))
+        content = r.content.decode()
+        assert content.index('Low') < content.index('Plenty')
+        self.assertContains(r, 'href="?sort=remaining"')
+
+        r = self.consume(self.client.get(reverse('ingredients') + '?remaining_below=5&sort=remaining'))
+        self.assertContains(r, 'Low')
+        self.assertNotContains(r, 'Plenty')
+
+        r = self.consume(self.client.get(reverse('ingredients') + '?remaining_below=0'))
+        self.assertNotContains(r, 'Low')
+        self.assertNotContains(r, 'Plenty')
+
+
+class IngredientIntakeTestCase(SVTestCase):
+    def setUp(self):
+        self.client = AuthenticatedClient()
+        self.user = self.client.user
+        self.company = self.user.company
+        self.url = reverse('ingredients-import')
+        self.ingred_type = IngredientTypeFactory(company=self.company, name='Garlic')
+        self.supplier = SupplierFactory(company=self.company, name='Burren Farm')
+        self.other_user = UserFactory(company=self.company, first_name='Sam', last_name='Smith')
+
+    def test_import_csv(self):
+        rows = 'Type,Batch Code,Quantity,Supplier,Received By,Intake Date\n'
+        rows += 'garlic,GAR-1,12.5,Burren Farm,sam smith,01/02/2024\n'
+        rows += ''.join(f'Garlic,GAR-{i},{i},,,\n' for i in range(2, 502))
+        self.client.get(self.url)
+        with self.assertNumQueries(8):
+            r = self.client.post(self.url, data={'file': SimpleUploadedFile('delivery.csv', rows.encode())})
+        self.assertRedirects(r, reverse('ingredients'))
+        assert Ingredient.objects.filter(company=self.company).count() == 501
+        first = Ingredient.objects.get(batch_code='GAR-1')
+        assert first.ingredient_type == self.ingred_type
+        assert first.supplier == self.supplier
+        assert first.intake_user == self.other_user
+        assert first.intake_date.date() == datetime(2024, 2, 1).date()
+        assert first.quantity == first.remaining_quantity == Decimal('12.5')
+        last = Ingredient.objects.get(batch_code='GAR-501')
+        assert last.intake_user == self.user
+        assert last.supplier is None
+        assert last.remaining_quantity == 501
+
+    def test_import_pasted_rows(self):
+        rows = 'Type\tBatch Code\tQuantity\tNotes\nGarlic\tGAR-1\t10\tFrom the spreadsheet\n'
+        r = self.client.post(self.url, data={'rows': rows}, follow=True)
+        self.assertContains(r, '1 raw ingredients added')
+        assert Ingredient.objects.get().intake_notes == 'From the spreadsheet'
+
+    def test_import_errors(self):
+        rows = 'Type,Batch Code,Quantity,Supplier,Received By\n'
+        rows += 'Garlic,GAR-1,10,,\n'
+        rows += 'Onion,GAR-2,abc,Nobody,nobody@example.com\n'
+        rows += 'Garlic,,10,,\n'
+        r = self.client.post(self.url, data={'rows': rows})
+        assert r.status_code == 200
+        self.assertContains(r, 'Row 3: Unknown raw ingredient type &#34;Onion&#34;; Unknown supplier &#34;Nobody&#34;')
+        self.assertContains(r, 'Unknown user &#34;nobody@example.com&#34;; Quantity: Enter a number.')
+        self.assertContains(r, 'Row 4: Batch Code: This field is required.')
+        assert not Ingredient.objects.exists()
+
+        r = self.client.post(self.url, data={'rows': 'Type,Quantity\nGarlic,10\n'})
+        self.assertContains(r, 'Missing columns: Batch Code')
+        r = self.client.post(self.url, data={})
+        self.assertContains(r, 'Upload a CSV file or paste the rows')
+
+    def test_import_other_company_type(self):
+        IngredientTypeFactory(name='Chilli')
+        r = self.client.post(self.url, data={'rows': 'Type,Batch Code,Quantity\nChilli,CH-1,10\n'})
+        self.assertContains(r, 'Unknown raw ingredient type')
+        assert not Ingredient.objects.exists()
@@ -1,7 +1,9 @@
 from datetime import datetime
+from decimal import Decimal
 
 from django.conf import settings
 from django.urls import reverse
+from pytz import utc
 
 from SalsaVerde.common.tests import SVTestCase
 from SalsaVerde.stock.factories.product import ProductFactory
@@ -11,14 +13,21 @@ from SalsaVerde.stock.factories.raw_materials import (
     IngredientTypeFactory,
     ProductTypeFactory,
 )
+from SalsaVerde.stock.inventory import rebuild_inventory
 from SalsaVerde.stock.models import (
     ContainerType,
+    Ingredient,
+    IngredientType,
     Product,
     ProductIngredient,
+    ProductInventory,
     ProductType,
     ProductTypeSize,
+    TraceLink,
+    YieldContainer,
 )
 from SalsaVerde.stock.tests.test_common import AuthenticatedClient
+from SalsaVerde.stock.trace import trace_ids
 
 
 class ProductTypeTestCase(SVTestCase):
@@ -114,6 +123,86 @@ class ProductTestCase(SVTestCase):
         r = self.client.get(reverse('products'))
         self.assertContains(r, pi.product.product_type.name)
 
+    def test_add_product_ledger_and_trace(self):
+        ingreds = [
+            IngredientFactory(quantity=10, ingredient_type__company=self.company),
+            IngredientFactory(quantity=5, ingredient_type__company=self.company),
+        ]
+        data = {
+            'product_type': self.product_type.id,
+            'batch_code': 'foobar',
+            'date_of_infusion': datetime(2018, 2, 2).strftime(settings.DT_FORMAT),
+            'ingredient_0': ingreds[0].pk,
+            'ingredient_quantity_0': 8,
+            'ingredient_1': ingreds[1].pk,
+            'ingredient_quantity_1': 1.5,
+        }
+        r = self.client.post(self.url, data=data)
+        product = Product.objects.get()
+        self.assertRedirects(r, reverse('products-details', args=[product.pk]))
+        assert set(ProductIngredient.objects.values_list('ingredient_id', 'company_id')) == {
+            (ingreds[0].pk, self.company.pk),
+            (ingreds[1].pk, self.company.pk),
+        }
+        assert [Ingredient.objects.get(pk=i.pk).remaining_quantity for i in ingreds] == [2, Decimal('3.5')]
+        assert trace_ids(self.company.pk, TraceLink.NODE_PRODUCT, [product.pk])[TraceLink.NODE_INGREDIENT] == {
+            i.pk for i in ingreds
+        }
+
+    def test_add_product_other_company_ingredient(self):
+        ingred = IngredientFactory(quantity=10)
+        data = {
+            'product_type': self.product_type.id,
+            'batch_code': 'foobar',
+            'date_of_infusion': datetime(2018, 2, 2).strftime(settings.DT_FORMAT),
+            'ingredient_0': ingred.pk,
+            'ingredient_quantity_0': 8,
+        }
+        r = self.client.post(self.url, data=data)
+        self.assertContains(r, 'Select a valid raw ingredient')
+        assert not Product.objects.exists()
+
+    def test_ingredient_choices(self):
+        garlic = IngredientTypeFactory(company=self.company, name='Garlic', unit=IngredientType.UNIT_KILO)
+        oil = IngredientTypeFactory(company=self.company, name='Oil', unit=IngredientType.UNIT_LITRE)
+        self.product_type.ingredient_types.set([garlic, oil])
+        garlic_1 = IngredientFactory(
+            ingredient_type=garlic, batch_code='G1', intake_date=datetime(2024, 1, 1, tzinfo=utc)
+        )
+        garlic_2 = IngredientFactory(
+            ingredient_type=garlic, batch_code='G2', intake_date=datetime(2024, 2, 1, tzinfo=utc)
+        )
+        IngredientFactory(ingredient_type=garlic, finished=True)
+        url = reverse('product-ingredient-choices', args=[self.product_type.pk])
+        with self.assertNumQueries(3):
+            data = self.client.get(url).json()
+        assert data == [
+            {
+                'name': 'Garlic',
+                'unit': IngredientType.UNIT_KILO,
+                'choices': [[garlic_1.pk, str(garlic_1)], [garlic_2.pk, str(garlic_2)]],
+            },
+            {'name': 'Oil', 'unit': IngredientType.UNIT_LITRE, 'choices': []},
+        ]
+        # Cached, only the session and user are fetched.
+        with self.assertNumQueries(2):
+            assert self.client.get(url).json() == data
+
+        # Intake, finishing a batch and changing the product type all invalidate it.
+        oil_1 = IngredientFactory(ingredient_type=oil, batch_code='O1')
+        assert self.client.get(url).json()[1]['choices'] == [[oil_1.pk, str(oil_1)]]
+        self.client.post(reverse('ingredient-status', args=[garlic_1.pk]))
+        assert self.client.get(url).json()[0]['choices'] == [[garlic_2.pk, str(garlic_2)]]
+        self.product_type.ingredient_types.remove(oil)
+        assert [i['name'] for i in self.client.get(url).json()] == ['Garlic']
+        self.client.post(reverse('ingredients-import'), data={'rows': 'Type,Batch Code,Quantity\nGarlic,G3,1\n'})
+        assert len(self.client.get(url).json()[0]['choices']) == 2
+        # As does deleting the product type.
+        self.product_type.delete()
+        assert self.client.get(url).status_code == 404
+
+        assert self.client.get(reverse('product-ingredient-choices', args=[ProductTypeFactory().pk])).status_code == 404
+
     def test_add_product_no_quantity(self):
         r = self.client.get(self.url)
         ingred = IngredientFactory(batch_code='foo123', quantity=10, ingredient_type__company=self.company)
@@ -221,6 +310,64 @@ class ProductTestCase(SVTestCase):
         self.assertRedirects(r, product.get_absolute_url())
         self.assertContains(r, 'foo456')
 
+    def test_add_yield_container_with_cap(self):
+        product = ProductFactory(product_type=self.product_type)
+        url = reverse('yield-container-add', args=[product.pk])
+        date = datetime(2018, 2, 2).strftime(settings.DT_FORMAT)
+        r = self.client.post(url, {'container': self.bottle.pk, 'cap': self.cap.pk, 'quantity': 12, 'date': date})
+        self.assertRedirects(r, product.get_absolute_url(), fetch_redirect_response=False)
+        assert set(
+            product.yield_containers.filter(container__in=[self.bottle, self.cap]).values_list(
+                'container_id', 'quantity'
+            )
+        ) == {(self.bottle.pk, 12), (self.cap.pk, 12)}
+
+    def test_add_yield_container_uses_stock(self):
+        product = ProductFactory(product_type=self.product_type)
+        url = reverse('yield-container-add', args=[product.pk])
+        date = datetime(2018, 2, 2).strftime(settings.DT_FORMAT)
+        r = self.client.post(url, {'container': self.bottle.pk, 'cap': self.cap.pk, 'quantity': 12, 'date': date})
+        self.assertRedirects(r, product.get_absolute_url(), fetch_redirect_response=False)
+        self.bottle.refresh_from_db()
+        self.cap.refresh_from_db()
+        assert self.bottle.remaining_quantity == self.bottle.quantity - 12
+        assert self.cap.remaining_quantity == self.cap.quantity - 12
+
+        YieldContainer.objects.filter(container=self.cap).delete()
+        self.cap.refresh_from_db()
+        assert self.cap.remaining_quantity == self.cap.quantity
+
+    def test_bottling_inventory(self):
+        product = ProductFactory(product_type=self.product_type, yield_container_1=None, yield_container_2=None)
+        url = reverse('yield-container-add', args=[product.pk])
+        date = datetime(2018, 2, 2).strftime(settings.DT_FORMAT)
+        self.client.post(url, {'container': self.bottle.pk, 'cap': self.cap.pk, 'quantity': 12, 'date': date})
+        self.client.post(url, {'container': self.bottle.pk, 'cap': self.cap.pk, 'quantity': 3, 'date': date})
+        # The caps are bottled along with the bottles, so they aren't counted separately.
+        inventory = ProductInventory.objects.get()
+        assert inventory.product == product
+        assert inventory.container_type == self.bottle.container_type
+        assert inventory.company == self.company
+        assert inventory.bottled == 15
+
+        r = self.client.get(product.get_absolute_url())
+        self.assertContains(r, 'Stock')
+
+        yc = YieldContainer.objects.get(container=self.bottle, quantity=3)
+        yc.quantity = 5
+        yc.save()
+        inventory.refresh_from_db()
+        assert inventory.bottled == 17
+        yc.delete()
+        inventory.refresh_from_db()
+        assert inventory.bottled == 12
+
+        ProductInventory.objects.update(bottled=0)
+        assert rebuild_inventory(batch_size=1) == 1
+        inventory.refresh_from_db()
+        assert inventory.bottled == 12
+        assert rebuild_inventory() == 0
+
     def test_bottled_fields_viewable(self):
         product = ProductFactory(product_type=self.product_type, status=Product.STATUS_INFUSED)
         r = self.client.get(product.get_absolute_url())
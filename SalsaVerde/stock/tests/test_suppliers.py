@@ -94,5 +94,4 @@ class SupplierTestCase(SVTestCase):
         self.assertContains(r, 'abc')
         self.assertContains(r, 'foo123')
         self.assertContains(r, '10 Bottles')
-        print(r.content.decode())
         self.assertContains(r, display_dt(container.intake_date))
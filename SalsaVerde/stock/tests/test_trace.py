@@ -0,0 +1,276 @@
+import csv
+import io
+import threading
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TransactionTestCase, override_settings
+from django.urls import resolve, reverse
+from django.utils import timezone
+
+from SalsaVerde.common.tests import SVTestCase
+from SalsaVerde.orders.factories.orders import OrderFactory
+from SalsaVerde.orders.models import Order, ProductOrder
+from SalsaVerde.stock.factories.company import CompanyFactory
+from SalsaVerde.stock.factories.product import ProductFactory
+from SalsaVerde.stock.factories.raw_materials import IngredientFactory
+from SalsaVerde.stock.factories.users import UserFactory
+from SalsaVerde.stock.models import Complaint, Document, ProductIngredient, TraceLink
+from SalsaVerde.stock.recall import recall_report
+from SalsaVerde.stock.tests.test_common import AuthenticatedClient
+from SalsaVerde.stock.trace import NODE_COMPLAINT, rebuild_trace_links, trace_ids
+
+
+def links(company):
+    return set(
+        TraceLink.objects.filter(company=company).values_list(
+            'ancestor_type', 'ancestor_id', 'descendant_type', 'descendant_id', 'depth', 'paths'
+        )
+    )
+
+
+class TraceTestCase(SVTestCase):
+    def setUp(self):
+        self.client = AuthenticatedClient()
+        self.company = self.client.user.company
+        self.product = ProductFactory(product_type__company=self.company, batch_code='TRACE1')
+        self.ingredient = self.product.product_ingredients.first().ingredient
+        self.container = self.product.yield_containers.first().container
+        self.order = OrderFactory(company=self.company)
+        ProductOrder.objects.create(order=self.order, product=self.product, quantity=2)
+
+    def test_trace_ids(self):
+        traced = trace_ids(self.company.pk, TraceLink.NODE_INGREDIENT, [self.ingredient.pk])
+        assert traced == {
+            TraceLink.NODE_INGREDIENT: {self.ingredient.pk},
+            TraceLink.NODE_PRODUCT: {self.product.pk},
+            TraceLink.NODE_ORDER: {self.order.pk},
+        }
+        traced = trace_ids(self.company.pk, TraceLink.NODE_ORDER, [self.order.pk])
+        assert traced[TraceLink.NODE_INGREDIENT] == set(
+            self.product.product_ingredients.values_list('ingredient_id', flat=True)
+        )
+        assert traced[TraceLink.NODE_CONTAINER] == set(
+            self.product.yield_containers.values_list('container_id', flat=True)
+        )
+        assert traced[TraceLink.NODE_PRODUCT] == {self.product.pk}
+        assert (
+            TraceLink.objects.get(
+                ancestor_type=TraceLink.NODE_INGREDIENT,
+                ancestor_id=self.ingredient.pk,
+                descendant_type=TraceLink.NODE_ORDER,
+                descendant_id=self.order.pk,
+            ).depth
+            == 2
+        )
+
+    def test_closure_matches_rebuild_and_cte(self):
+        # The same ingredient used twice in a product, and the product packed in two orders.
+        ProductIngredient.objects.create(product=self.product, ingredient=self.ingredient, quantity=1)
+        other_order = OrderFactory(company=self.company)
+        ProductOrder.objects.create(order=other_order, product=self.product, quantity=1)
+        other = ProductFactory(product_type__company=self.company)
+        ProductOrder.objects.create(order=other_order, product=other, quantity=1)
+
+        maintained = links(self.company)
+        assert rebuild_trace_links(self.company.pk) == len(maintained)
+        assert links(self.company) == maintained
+
+        for node_type, pk in [
+            (TraceLink.NODE_INGREDIENT, self.ingredient.pk),
+            (TraceLink.NODE_PRODUCT, other.pk),
+            (TraceLink.NODE_ORDER, other_order.pk),
+        ]:
+            closure = trace_ids(self.company.pk, node_type, [pk])
+            with override_settings(TRACE_CLOSURE=False):
+                assert trace_ids(self.company.pk, node_type, [pk]) == closure
+
+    def test_remove_edges(self):
+        extra = ProductIngredient.objects.create(product=self.product, ingredient=self.ingredient, quantity=1)
+        link = TraceLink.objects.get(
+            ancestor_type=TraceLink.NODE_INGREDIENT,
+            ancestor_id=self.ingredient.pk,
+            descendant_type=TraceLink.NODE_PRODUCT,
+            descendant_id=self.product.pk,
+        )
+        assert link.paths == 2
+        extra.delete()
+        link.refresh_from_db()
+        assert link.paths == 1
+
+        other_ingredient = IngredientFactory(ingredient_type__company=self.company)
+        pi = self.product.product_ingredients.get(ingredient=self.ingredient, quantity=10)
+        pi.ingredient = other_ingredient
+        pi.save()
+        assert not trace_ids(self.company.pk, TraceLink.NODE_INGREDIENT, [self.ingredient.pk])[TraceLink.NODE_ORDER]
+        traced = trace_ids(self.company.pk, TraceLink.NODE_INGREDIENT, [other_ingredient.pk])
+        assert traced[TraceLink.NODE_ORDER] == {self.order.pk}
+
+        self.order.products.all().delete()
+        assert not TraceLink.objects.filter(descendant_type=TraceLink.NODE_ORDER).exists()
+        self.product.delete()
+        assert not TraceLink.objects.exists()
+
+    def test_complaint(self):
+        complaint = Complaint.objects.create(
+            author=self.client.user,
+            complaint_type=Complaint.COMPLAINT_FOREIGN,
+            complainant_name='Jane',
+            complainant_address='1 High Street',
+            method='Email',
+            description='Something in the bottle',
+            cause='Unknown',
+            corrective_action_desc='None yet',
+            corrective_action_date=timezone.now(),
+            complaint_reply_date=timezone.now(),
+        )
+        complaint.affected_product.add(self.product)
+        traced = trace_ids(self.company.pk, NODE_COMPLAINT, [complaint.pk])
+        assert traced[NODE_COMPLAINT] == {complaint.pk}
+        assert traced[TraceLink.NODE_INGREDIENT] == set(
+            self.product.product_ingredients.values_list('ingredient_id', flat=True)
+        )
+        assert traced[TraceLink.NODE_ORDER] == {self.order.pk}
+
+        r = self.client.get(reverse('documents-details', args=[complaint.pk]))
+        self.assertContains(r, reverse('trace', args=[NODE_COMPLAINT, complaint.pk]))
+
+    def test_trace_page(self):
+        r = self.client.get(reverse('ingredients-details', args=[self.ingredient.pk]))
+        url = reverse('trace', args=[TraceLink.NODE_INGREDIENT, self.ingredient.pk])
+        self.assertContains(r, url)
+        r = self.client.get(url)
+        self.assertContains(r, self.product.get_absolute_url())
+        self.assertContains(r, self.order.get_absolute_url())
+        self.assertContains(r, f'Order {self.order.pk}')
+        self.assertNotContains(r, self.container.get_absolute_url())
+
+        r = self.client.get(reverse('trace-json', args=[TraceLink.NODE_PRODUCT, self.product.pk]))
+        data = r.json()
+        assert {i['id'] for i in data[TraceLink.NODE_INGREDIENT]} == set(
+            self.product.product_ingredients.values_list('ingredient_id', flat=True)
+        )
+        assert len(data[TraceLink.NODE_CONTAINER]) == 2
+        assert data[TraceLink.NODE_ORDER] == [
+            {'id': self.order.pk, 'name': str(self.order), 'url': self.order.get_absolute_url()}
+        ]
+
+    def test_trace_other_company(self):
+        other = ProductFactory()
+        r = self.client.get(reverse('trace', args=[TraceLink.NODE_PRODUCT, other.pk]))
+        assert r.status_code == 404
+        r = self.client.get(reverse('trace-json', args=['supplier', self.product.pk]))
+        assert r.status_code == 404
+
+    def test_rebuild_command(self):
+        TraceLink.objects.all().delete()
+        out = StringIO()
+        call_command('rebuild_trace_links', stdout=out)
+        assert f'{self.company}: {TraceLink.objects.filter(company=self.company).count()} links' in out.getvalue()
+        assert trace_ids(self.company.pk, TraceLink.NODE_ORDER, [self.order.pk])[TraceLink.NODE_PRODUCT] == {
+            self.product.pk
+        }
+
+
+class TraceConcurrencyTestCase(TransactionTestCase):
+    def test_interleaved_edges(self):
+        company = CompanyFactory()
+        product = ProductFactory(product_type__company=company)
+        ingredient = IngredientFactory(ingredient_type__company=company)
+        order = OrderFactory(company=company)
+
+        def pack():
+            try:
+                ProductOrder.objects.create(order=order, product=product, quantity=1)
+            finally:
+                connection.close()
+
+        with transaction.atomic():
+            ProductIngredient.objects.create(product=product, ingredient=ingredient, quantity=1)
+            # The order is packed while the ingredient's link to the product hasn't been committed.
+            thread = threading.Thread(target=pack)
+            thread.start()
+            thread.join(timeout=1)
+        thread.join()
+
+        closure = trace_ids(company.pk, TraceLink.NODE_INGREDIENT, [ingredient.pk])
+        assert closure[TraceLink.NODE_ORDER] == {order.pk}
+        with override_settings(TRACE_CLOSURE=False):
+            assert trace_ids(company.pk, TraceLink.NODE_INGREDIENT, [ingredient.pk]) == closure
+
+
+class RecallReportTestCase(SVTestCase):
+    def setUp(self):
+        self.client = AuthenticatedClient()
+        self.company = self.client.user.company
+        self.product = ProductFactory(product_type__company=self.company, batch_code='RECALL1')
+        self.ingredient = self.product.product_ingredients.first().ingredient
+        self.customer = UserFactory(company=self.company, first_name='Jane', last_name='Doe', email='jane@example.com')
+        self.orders = [
+            OrderFactory(
+                company=self.company,
+                user=self.customer,
+                status=Order.STATUS_FULFILLED,
+                extra_data={'name': f'#10{i}', 'shipping_address': {'address1': '=1 High St', 'city': 'Ennis'}},
+            )
+            for i in range(3)
+        ]
+        size = self.product.yield_containers.first().container.container_type
+        for order in self.orders:
+            ProductOrder.objects.create(order=order, product=self.product, container_type=size, quantity=2)
+
+    def read_report(self, doc):
+        with doc.file.open() as f:
+            return list(csv.reader(io.TextIOWrapper(f, encoding='utf-8')))
+
+    def test_report(self):
+        # Small chunks so every section takes more than one.
+        with mock.patch('SalsaVerde.stock.recall.REPORT_CHUNK_SIZE', 2):
+            doc_id = recall_report(self.company.pk, TraceLink.NODE_INGREDIENT, self.ingredient.pk, self.client.user.pk)
+        doc = Document.objects.get(pk=doc_id)
+        assert doc.type == Document.FORM_TRA01
+        assert doc.company == self.company
+        assert doc.supplier == self.ingredient.supplier
+        rows = self.read_report(doc)
+        assert ['Orders', '3'] in rows
+        assert ['Orders shipped', '3'] in rows
+        assert ['Customers', '1'] in rows
+        assert ['Units bottled', '20'] in rows
+        assert ['Units packed', '6'] in rows
+        assert [
+            '#101',
+            mock.ANY,
+            'Fulfilled',
+            'Jane Doe',
+            'jane@example.com',
+            self.customer.phone,
+            # Escaped so spreadsheets don't run it as a formula.
+            "'=1 High St, Ennis",
+            'RECALL1 x 2',
+        ] in rows
+        products = rows.index(['Products'])
+        assert rows[products + 2][:2] == ['RECALL1', self.product.product_type.name]
+        assert rows[products + 2][5:] == ['20', '6', '14']
+
+    def test_report_job(self):
+        url = reverse('trace', args=[TraceLink.NODE_PRODUCT, self.product.pk])
+        r = self.client.get(url)
+        start_url = reverse('recall-report', args=[TraceLink.NODE_PRODUCT, self.product.pk])
+        self.assertContains(r, start_url)
+
+        r = self.client.post(start_url)
+        assert r.status_code == 302
+        job_id = resolve(r.url).kwargs['job_id']
+        status_url = reverse('recall-report-status', args=[job_id])
+        r = self.client.get(r.url)
+        self.assertContains(r, status_url)
+        data = self.client.get(status_url).json()
+        doc = Document.objects.get(type=Document.FORM_TRA01)
+        assert data == {'status': 'finished', 'progress': 100, 'url': doc.get_absolute_url()}
+        assert ['Traced from', str(self.product)] in self.read_report(doc)
+
+        self.client.force_login(UserFactory())
+        assert self.client.get(status_url).status_code == 404
+        assert self.client.get(reverse('recall-report-status', args=['missing'])).status_code == 404
@@ -0,0 +1,243 @@
+"""
+Traceability: everything a batch went into, and everything a product or order was made from.
+
+The graph runs from ingredient and packaging batches (through ProductIngredient and YieldContainer) to products, and
+from products (through ProductOrder) to orders. TraceLink is its closure table, and the signals here keep it up to
+date as the edges are added and removed. When an edge A -> D is added, everything upstream of A (and A) gets a link to
+everything downstream of D (and D), with the number of paths between them multiplied out. Removing an edge takes the
+same paths away again, and deletes the links that have none left. Edges created with bulk_create don't send signals,
+so are added with add_edges(). The changes to a company's links are made one transaction at a time (see
+_lock_trace_links), otherwise two edges added together would each miss the links the other adds.
+
+trace_ids() looks up the closure table, or when TRACE_CLOSURE is off walks the edges themselves with a recursive CTE.
+Complaints are traced from the products they're about. The same CTE rebuilds the closure table with
+rebuild_trace_links() (or the rebuild_trace_links command).
+"""
+
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from SalsaVerde.orders.models import Order, ProductOrder
+from SalsaVerde.stock.models import (
+    Complaint,
+    Container,
+    Ingredient,
+    Product,
+    ProductIngredient,
+    TraceLink,
+    YieldContainer,
+)
+
+# Complaints aren't in the graph, they're traced through the products they're about.
+NODE_COMPLAINT = 'complaint'
+
+# What can be traced, and the models they're looked up with.
+TRACE_MODELS = {
+    TraceLink.NODE_INGREDIENT: Ingredient,
+    TraceLink.NODE_CONTAINER: Container,
+    TraceLink.NODE_PRODUCT: Product,
+    TraceLink.NODE_ORDER: Order,
+    NODE_COMPLAINT: Complaint,
+}
+
+# The models that are edges of the graph, and their (ancestor type, ancestor field, descendant type, descendant field).
+EDGES = {
+    ProductIngredient: (TraceLink.NODE_INGREDIENT, 'ingredient_id', TraceLink.NODE_PRODUCT, 'product_id'),
+    YieldContainer: (TraceLink.NODE_CONTAINER, 'container_id', TraceLink.NODE_PRODUCT, 'product_id'),
+    ProductOrder: (TraceLink.NODE_PRODUCT, 'product_id', TraceLink.NODE_ORDER, 'order_id'),
+}
+
+_EDGES_SQL = ' UNION ALL '.join(
+    f"SELECT '{a_type}'::text, {a_field}, '{d_type}'::text, {d_field} FROM {model._meta.db_table} "
+    f'WHERE company_id = %(company_id)s'
+    for model, (a_type, a_field, d_type, d_field) in EDGES.items()
+)
+
+
+# The first key of the advisory locks taken by _lock_trace_links(), the second is the company's id.
+TRACE_LOCK_KEY = 7201
+
+
+def _lock_trace_links(company_id: int):
+    """
+    Waits for any other transaction changing the company's links to finish, and stops another starting until this one
+    has. Must be called in a transaction.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_xact_lock(%s, %s)', [TRACE_LOCK_KEY, company_id])
+
+
+def _edge(sender, instance) -> tuple:
+    a_type, a_field, d_type, d_field = EDGES[sender]
+    return a_type, getattr(instance, a_field), d_type, getattr(instance, d_field)
+
+
+def _change_paths(company_id: int, edge: tuple, change: int):
+    """
+    Adds (or with a negative change, removes) the paths through the edge to the closure table.
+    """
+    a_type, a_id, d_type, d_id = edge
+    if not (a_id and d_id):
+        return
+    with transaction.atomic():
+        _lock_trace_links(company_id)
+        _write_paths(company_id, edge, change)
+
+
+def _write_paths(company_id: int, edge: tuple, change: int):
+    a_type, a_id, d_type, d_id = edge
+    upstream, downstream = [(a_type, a_id, 0, 1)], [(d_type, d_id, 0, 1)]
+    for link in TraceLink.objects.filter(
+        Q(descendant_type=a_type, descendant_id=a_id) | Q(ancestor_type=d_type, ancestor_id=d_id)
+    ).values_list('ancestor_type', 'ancestor_id', 'descendant_type', 'descendant_id', 'depth', 'paths'):
+        if link[2:4] == (a_type, a_id):
+            upstream.append((link[0], link[1], link[4], link[5]))
+        else:
+            downstream.append((link[2], link[3], link[4], link[5]))
+    rows = [
+        (company_id, up_type, up_id, down_type, down_id, up_depth + 1 + down_depth, change * up_paths * down_paths)
+        for up_type, up_id, up_depth, up_paths in upstream
+        for down_type, down_id, down_depth, down_paths in downstream
+    ]
+    table = TraceLink._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            INSERT INTO {table} (company_id, ancestor_type, ancestor_id, descendant_type, descendant_id, depth, paths)
+            VALUES {', '.join(['(%s, %s, %s, %s, %s, %s, %s)'] * len(rows))}
+            ON CONFLICT (ancestor_type, ancestor_id, descendant_type, descendant_id)
+            DO UPDATE SET paths = {table}.paths + EXCLUDED.paths
+            """,
+            [v for row in rows for v in row],
+        )
+        if change < 0:
+            # Every link that changed starts upstream of the edge.
+            cursor.execute(
+                f"""
+                DELETE FROM {table} WHERE paths <= 0
+                AND (ancestor_type, ancestor_id) IN ({', '.join(['(%s, %s)'] * len(upstream))})
+                """,
+                [v for up_type, up_id, _, _ in upstream for v in (up_type, up_id)],
+            )
+
+
+@receiver(pre_save, sender=ProductIngredient)
+@receiver(pre_save, sender=YieldContainer)
+@receiver(pre_save, sender=ProductOrder)
+def _record_previous_edge(sender, instance, raw=False, **kwargs):
+    if not raw and not instance._state.adding:
+        previous = sender.objects.filter(pk=instance.pk).first()
+        instance._trace_previous = previous and _edge(sender, previous)
+
+
+@receiver(post_save, sender=ProductIngredient)
+@receiver(post_save, sender=YieldContainer)
+@receiver(post_save, sender=ProductOrder)
+def _add_edge(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    edge = _edge(sender, instance)
+    previous = not created and getattr(instance, '_trace_previous', None)
+    instance._trace_previous = None
+    if previous != edge:
+        if previous:
+            _change_paths(instance.company_id, previous, -1)
+        _change_paths(instance.company_id, edge, 1)
+
+
+@receiver(post_delete, sender=ProductIngredient)
+@receiver(post_delete, sender=YieldContainer)
+@receiver(post_delete, sender=ProductOrder)
+def _remove_edge(sender, instance, **kwargs):
+    _change_paths(instance.company_id, _edge(sender, instance), -1)
+
+
+def add_edges(sender, instances):
+    """
+    Adds edges created with bulk_create to the closure table.
+    """
+    with transaction.atomic():
+        for company_id in sorted({instance.company_id for instance in instances}):
+            _lock_trace_links(company_id)
+        for instance in instances:
+            _change_paths(instance.company_id, _edge(sender, instance), 1)
+
+
+def _cte_trace_ids(company_id: int, node_type: str, ids: list[int]) -> list[tuple[str, int]]:
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            WITH RECURSIVE edges (a_type, a_id, d_type, d_id) AS ({_EDGES_SQL}),
+            downstream (type, id) AS (
+                SELECT %(node_type)s::text, unnest(%(ids)s::int[])
+                UNION SELECT e.d_type, e.d_id FROM edges e JOIN downstream ON e.a_type = type AND e.a_id = id
+            ),
+            upstream (type, id) AS (
+                SELECT %(node_type)s::text, unnest(%(ids)s::int[])
+                UNION SELECT e.a_type, e.a_id FROM edges e JOIN upstream ON e.d_type = type AND e.d_id = id
+            )
+            SELECT type, id FROM downstream UNION SELECT type, id FROM upstream
+            """,
+            {'company_id': company_id, 'node_type': node_type, 'ids': list(ids)},
+        )
+        return cursor.fetchall()
+
+
+def trace_ids(company_id: int, node_type: str, ids: list[int]) -> dict[str, set[int]]:
+    """
+    Returns the ids of everything upstream and downstream of the given nodes (including the nodes themselves), by
+    node type.
+    """
+    if node_type == NODE_COMPLAINT:
+        products = Complaint.affected_product.through.objects.filter(
+            complaint_id__in=ids, product__company_id=company_id
+        ).values_list('product_id', flat=True)
+        traced = trace_ids(company_id, TraceLink.NODE_PRODUCT, list(products))
+        traced[NODE_COMPLAINT].update(ids)
+        return traced
+
+    traced = defaultdict(set)
+    traced[node_type].update(ids)
+    if not settings.TRACE_CLOSURE:
+        for t, pk in _cte_trace_ids(company_id, node_type, ids):
+            traced[t].add(pk)
+        return traced
+
+    for a_type, a_id, d_type, d_id in TraceLink.objects.filter(
+        Q(descendant_type=node_type, descendant_id__in=ids) | Q(ancestor_type=node_type, ancestor_id__in=ids),
+        company_id=company_id,
+    ).values_list('ancestor_type', 'ancestor_id', 'descendant_type', 'descendant_id'):
+        traced[a_type].add(a_id)
+        traced[d_type].add(d_id)
+    return traced
+
+
+def rebuild_trace_links(company_id: int) -> int:
+    """
+    Rebuilds the company's closure table from the edges with a recursive CTE, returning the number of links.
+    """
+    table = TraceLink._meta.db_table
+    with transaction.atomic(), connection.cursor() as cursor:
+        _lock_trace_links(company_id)
+        cursor.execute(f'DELETE FROM {table} WHERE company_id = %(company_id)s', {'company_id': company_id})
+        cursor.execute(
+            f"""
+            INSERT INTO {table} (company_id, ancestor_type, ancestor_id, descendant_type, descendant_id, depth, paths)
+            WITH RECURSIVE edges (a_type, a_id, d_type, d_id) AS ({_EDGES_SQL}),
+            paths (a_type, a_id, d_type, d_id, depth) AS (
+                SELECT a_type, a_id, d_type, d_id, 1 FROM edges
+                UNION ALL
+                SELECT p.a_type, p.a_id, e.d_type, e.d_id, p.depth + 1
+                FROM paths p JOIN edges e ON e.a_type = p.d_type AND e.a_id = p.d_id
+            )
+            SELECT %(company_id)s, a_type, a_id, d_type, d_id, min(depth), count(*)
+            FROM paths GROUP BY a_type, a_id, d_type, d_id
+            """,
+            {'company_id': company_id},
+        )
+        return cursor.rowcount
@@ -20,6 +20,7 @@ from SalsaVerde.stock.views import (
     product_types,
     products,
     suppliers,
+    trace,
 )
 
 supplier_patterns = [
@@ -33,6 +34,7 @@ supplier_patterns = [
 container_patterns = [
     path('', containers.list.containers_list, name='containers'),
     path('add/', containers.form_views.container_add, name='container-add'),
+    path('import/', containers.form_views.container_import, name='containers-import'),
     path('<int:pk>/', containers.details.containers_details, name='containers-details'),
     path('<int:pk>/edit/', containers.form_views.containers_edit, name='containers-edit'),
     path('<int:pk>/delete/', DeleteObjectView.as_view(model=Container), name='containers-delete'),
@@ -51,6 +53,7 @@ ingredient_patterns = [
     path('<int:pk>/delete/', DeleteObjectView.as_view(model=Ingredient), name='ingredients-delete'),
     path('<int:pk>/status/', ingredients.form_views.change_ingredient_status, name='ingredient-status'),
     path('add/', ingredients.form_views.ingredient_add, name='ingredient-add'),
+    path('import/', ingredients.form_views.ingredient_import, name='ingredients-import'),
     path('types/', ingredient_types.list.ingredient_type_list, name='ingredient-types'),
     path('types/add/', ingredient_types.form_views.ingredient_type_add, name='ingredient-types-add'),
     path('types/<int:pk>/', ingredient_types.details.ingredient_type_details, name='ingredient-types-details'),
@@ -98,10 +101,19 @@ product_patterns = [
     ),
 ]
 
+trace_patterns = [
+    path('<str:node_type>/<int:pk>/', trace.trace, name='trace'),
+    path('<str:node_type>/<int:pk>/json/', trace.trace_json, name='trace-json'),
+    path('<str:node_type>/<int:pk>/recall-report/', trace.recall_report_start, name='recall-report'),
+    path('recall-report/<str:job_id>/', trace.recall_report_progress, name='recall-report-progress'),
+    path('recall-report/<str:job_id>/status/', trace.recall_report_status, name='recall-report-status'),
+]
+
 urlpatterns = [
     path('ingredients/', include(ingredient_patterns)),
     path('products/', include(product_patterns)),
     path('containers/', include(container_patterns)),
     path('suppliers/', include(supplier_patterns)),
     path('documents/', include(document_patterns)),
+    path('trace/', include(trace_patterns)),
 ]
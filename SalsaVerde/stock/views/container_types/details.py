@@ -1,3 +1,5 @@
+from django.urls import reverse
+
 from SalsaVerde.common.views import DetailView
 from SalsaVerde.stock.models import ContainerType
 
@@ -10,8 +12,9 @@ class ContainerTypeDetails(DetailView):
         return [
             {
                 'title': 'Containers',
-                'qs': self.object.containers.select_related('container_type').order_by('-intake_date'),
+                'qs': self.object.containers.order_by('-intake_date'),
                 'fields': ['container_type', 'batch_code', ('Intake date', 'intake_date'), 'supplier'],
+                'list_url': reverse('containers') + f'?container_type={self.object.pk}&finished=all',
             }
         ]
 
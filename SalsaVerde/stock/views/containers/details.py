@@ -1,14 +1,16 @@
 from django.urls import reverse
 
 from SalsaVerde.common.views import DetailView
-from SalsaVerde.stock.models import Container, Product
+from SalsaVerde.stock.models import Container, Product, TraceLink
 
 
 class ContainerDetails(DetailView):
     model = Container
+    trace_node = TraceLink.NODE_CONTAINER
     display_items = [
         'obj_url|container_type',
         'quantity',
+        'remaining_quantity',
         'batch_code',
         'obj_url|supplier',
         'intake_date',
@@ -39,7 +41,6 @@ class ContainerDetails(DetailView):
         products = (
             Product.objects.request_qs(self.request)
             .filter(yield_containers__container=self.object)
-            .select_related('product_type')
             .order_by('-date_of_bottling')
         )
         return [
@@ -1,9 +1,11 @@
+from django.contrib import messages
 from django.shortcuts import get_object_or_404, redirect
 from django.urls import reverse_lazy
 from django.views.decorators.http import require_POST
 
-from SalsaVerde.common.views import AddModelView, UpdateModelView
+from SalsaVerde.common.views import AddModelView, SVFormView, UpdateModelView
 from SalsaVerde.stock.forms.containers import ContainerForm
+from SalsaVerde.stock.forms.intake import ContainerIntakeForm
 from SalsaVerde.stock.models import Container
 
 
@@ -30,6 +32,20 @@ class ContainersAdd(AddModelView):
 container_add = ContainersAdd.as_view()
 
 
+class ContainerImport(SVFormView):
+    form_class = ContainerIntakeForm
+    cancel_url = reverse_lazy('containers')
+    title = 'Import Packaging'
+
+    def form_valid(self, form):
+        batches = form.save()
+        messages.success(self.request, f'{len(batches)} packaging batches added')
+        return redirect('containers')
+
+
+container_import = ContainerImport.as_view()
+
+
 class ContainerEdit(UpdateModelView):
     model = Container
     form_class = ContainerForm
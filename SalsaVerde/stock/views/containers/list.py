@@ -7,6 +7,8 @@ from SalsaVerde.stock.models import Container
 
 
 class ContainerFilterForm(SVFilterForm):
+    autocomplete_fields = {'supplier': ['name'], 'intake_user': ['first_name', 'last_name', 'email']}
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.fields['finished'] = forms.ChoiceField(
@@ -14,9 +16,14 @@ class ContainerFilterForm(SVFilterForm):
             choices=[('not-finished', 'Not finished'), ('all', 'All'), ('finished', 'Finished')],
             required=False,
         )
+        self.fields['remaining_below'] = forms.DecimalField(label='Remaining less than', required=False)
 
     def filter_kwargs(self) -> dict:
         filter_kwargs = super().filter_kwargs()
+        # Taken from cleaned_data, as filter_kwargs leaves out 0 along with empty values.
+        filter_kwargs.pop('remaining_below', None)
+        if (remaining_below := self.cleaned_data.get('remaining_below')) is not None:
+            filter_kwargs['remaining_quantity__lt'] = remaining_below
         if fin_filter := filter_kwargs.pop('finished', None):
             if fin_filter == 'all':
                 # We don't need to add a filter for all
@@ -34,24 +41,30 @@ class ContainerFilterForm(SVFilterForm):
             ['container_type', 'supplier'],
             ['intake_user', 'finished'],
             ['intake_date_from', 'intake_date_to'],
+            ['remaining_below'],
         ]
 
 
 class ContainerList(ModelListView):
     model = Container
-    display_items = ['container_type', 'batch_code', 'intake_date', 'supplier']
+    display_items = ['container_type', 'batch_code', 'intake_date', 'supplier', 'remaining_quantity']
     order_by = 'container_type__name'
+    sort_options = {'remaining': ('Remaining stock', 'remaining_quantity')}
     icon = 'fa-jar'
     filter_form = ContainerFilterForm
+    keyset_pagination = True
+    cache_rows = True
+    stream_response = True
 
     def get_queryset(self):
-        qs = super().get_queryset().select_related('container_type', 'supplier')
+        qs = super().get_queryset()
         if 'finished' not in self._mutable_get_args:
             qs = qs.filter(finished=False)
         return qs
 
     def get_button_menu(self):
         yield {'name': 'Record packaging intake', 'url': reverse('container-add'), 'icon': 'fa-plus'}
+        yield {'name': 'Import intake', 'url': reverse('containers-import'), 'icon': 'fa-file-import'}
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -1,5 +1,8 @@
+from django.urls import reverse
+
 from SalsaVerde.stock.forms.documents import UpdateDocumentForm
 from SalsaVerde.stock.models import Document
+from SalsaVerde.stock.trace import NODE_COMPLAINT
 
 from ...common.views import AddModelView, DetailView, ModelListView, UpdateModelView
 
@@ -12,9 +15,6 @@ class DocumentsList(ModelListView):
         'author',
     ]
 
-    def get_queryset(self):
-        return super().get_queryset().select_related('author')
-
 
 document_list = DocumentsList.as_view()
 
@@ -30,6 +30,19 @@ class DocumentDetails(DetailView):
         'focus',
     ]
 
+    def get_button_menu(self):
+        btns = super().get_button_menu()
+        if hasattr(self.object, 'complaint'):
+            btns.append(
+                {
+                    'name': 'Trace',
+                    'url': reverse('trace', kwargs={'node_type': NODE_COMPLAINT, 'pk': self.object.pk}),
+                    'icon': 'fa-route',
+                    'group': 1,
+                }
+            )
+        return btns
+
 
 document_details = DocumentDetails.as_view()
 
@@ -1,3 +1,5 @@
+from django.urls import reverse
+
 from SalsaVerde.common.views import DetailView
 from SalsaVerde.stock.models import IngredientType
 
@@ -10,8 +12,9 @@ class IngredientTypeDetails(DetailView):
         return [
             {
                 'title': 'Ingredients',
-                'qs': self.object.ingredients.select_related('ingredient_type').order_by('-intake_date'),
+                'qs': self.object.ingredients.order_by('-intake_date'),
                 'fields': ['ingredient_type', 'batch_code', ('Intake date', 'intake_date'), 'supplier'],
+                'list_url': reverse('ingredients') + f'?ingredient_type={self.object.pk}&finished=all',
             }
         ]
 
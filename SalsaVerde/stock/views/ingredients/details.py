@@ -1,14 +1,16 @@
 from django.urls import reverse
 
 from SalsaVerde.common.views import DetailView
-from SalsaVerde.stock.models import Ingredient, Product
+from SalsaVerde.stock.models import Ingredient, Product, TraceLink
 
 
 class IngredientDetails(DetailView):
     model = Ingredient
+    trace_node = TraceLink.NODE_INGREDIENT
     display_items = [
         'obj_url|ingredient_type',
         'quantity',
+        'remaining_quantity',
         'batch_code',
         'obj_url|supplier',
         'intake_date',
@@ -22,7 +24,6 @@ class IngredientDetails(DetailView):
         products = (
             Product.objects.request_qs(self.request)
             .filter(product_ingredients__ingredient=self.object)
-            .select_related('product_type')
             .order_by('-date_of_bottling')
         )
         return [
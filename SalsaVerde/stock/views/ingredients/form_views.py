@@ -1,9 +1,11 @@
+from django.contrib import messages
 from django.shortcuts import get_object_or_404, redirect
 from django.urls import reverse_lazy
 from django.views.decorators.http import require_POST
 
-from SalsaVerde.common.views import AddModelView, UpdateModelView
+from SalsaVerde.common.views import AddModelView, SVFormView, UpdateModelView
 from SalsaVerde.stock.forms.ingredients import IngredientForm
+from SalsaVerde.stock.forms.intake import IngredientIntakeForm
 from SalsaVerde.stock.models import Ingredient
 
 
@@ -30,6 +32,20 @@ class IngredientAdd(AddModelView):
 ingredient_add = IngredientAdd.as_view()
 
 
+class IngredientImport(SVFormView):
+    form_class = IngredientIntakeForm
+    cancel_url = reverse_lazy('ingredients')
+    title = 'Import Raw Ingredients'
+
+    def form_valid(self, form):
+        batches = form.save()
+        messages.success(self.request, f'{len(batches)} raw ingredients added')
+        return redirect('ingredients')
+
+
+ingredient_import = IngredientImport.as_view()
+
+
 class IngredientEdit(UpdateModelView):
     model = Ingredient
     form_class = IngredientForm
@@ -7,19 +7,24 @@ from SalsaVerde.stock.models import Ingredient
 
 class IngredientList(ModelListView):
     model = Ingredient
-    display_items = ['ingredient_type', 'batch_code', 'intake_date', 'supplier', 'quantity']
+    display_items = ['ingredient_type', 'batch_code', 'intake_date', 'supplier', 'quantity', 'remaining_quantity']
     order_by = 'ingredient_type__name'
+    sort_options = {'remaining': ('Remaining stock', 'remaining_quantity')}
     icon = 'fa-apple-whole'
     filter_form = IngredientFilterForm
+    keyset_pagination = True
+    cache_rows = True
+    stream_response = True
 
     def get_queryset(self):
-        qs = super().get_queryset().select_related('ingredient_type', 'supplier')
+        qs = super().get_queryset()
         if 'finished' not in self._mutable_get_args:
             qs = qs.filter(finished=False)
         return qs
 
     def get_button_menu(self):
         yield {'name': 'Record raw ingredients intake', 'url': reverse('ingredient-add'), 'icon': 'fa-plus'}
+        yield {'name': 'Import intake', 'url': reverse('ingredients-import'), 'icon': 'fa-file-import'}
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
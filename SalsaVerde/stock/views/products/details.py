@@ -3,11 +3,14 @@ import textwrap
 from django.urls import reverse
 
 from SalsaVerde.common.views import DetailView
-from SalsaVerde.stock.models import Product
+from SalsaVerde.stock.models import Product, TraceLink
 
 
 class ProductDetails(DetailView):
     model = Product
+    trace_node = TraceLink.NODE_PRODUCT
+    # Display items are decided by the product's status, so these can't be worked out before loading it
+    select_related = ['product_type']
 
     def get_title(self):
         return textwrap.shorten(self.object.product_type.name, width=35, placeholder='…') + self.object.batch_code
@@ -50,13 +53,13 @@ class ProductDetails(DetailView):
         return [
             {
                 'title': 'Ingredients',
-                'qs': self.object.product_ingredients.select_related('ingredient__ingredient_type'),
+                'qs': self.object.product_ingredients.all(),
                 'fields': [('Name', 'ingredient__ingredient_type'), 'ingredient__batch_code', 'quantity'],
                 'add_url': reverse('product-ingredient-add', kwargs={'pk': self.object.pk}),
             },
             {
                 'title': 'Yield',
-                'qs': self.object.yield_containers.select_related('container__container_type'),
+                'qs': self.object.yield_containers.all(),
                 'fields': [
                     ('Name', 'container__container_type'),
                     'container__batch_code',
@@ -65,6 +68,12 @@ class ProductDetails(DetailView):
                 ],
                 'add_url': reverse('yield-container-add', kwargs={'pk': self.object.pk}),
             },
+            {
+                'title': 'Stock',
+                'qs': self.object.inventory.order_by('container_type__name'),
+                'fields': ['container_type', 'bottled', 'packed', ('Available', 'available')],
+                'icon': 'fa-boxes-stacked',
+            },
         ]
 
 
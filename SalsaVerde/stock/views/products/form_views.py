@@ -1,30 +1,22 @@
 from django.contrib import messages
-from django.http import JsonResponse
+from django.db import transaction
+from django.http import Http404, JsonResponse
 from django.shortcuts import get_object_or_404, redirect
 from django.views.decorators.http import require_POST
 
 from SalsaVerde.common.views import AddModelView, UpdateModelView
 from SalsaVerde.stock.forms.containers import YieldContainersForm
 from SalsaVerde.stock.forms.products import AddProductForm, ProductIngredientForm, UpdateProductForm
-from SalsaVerde.stock.models import Ingredient, Product, ProductIngredient, ProductType, YieldContainer
+from SalsaVerde.stock.ledger import record_usage
+from SalsaVerde.stock.models import Product, ProductIngredient, YieldContainer
+from SalsaVerde.stock.recipes import get_recipe
+from SalsaVerde.stock.trace import add_edges
 
 
 def get_product_ingredient_choices(request, pk: int):
-    product_type = get_object_or_404(
-        ProductType.objects.request_qs(request).prefetch_related('ingredient_types'), pk=pk
-    )
-    ingreds = []
-    for ingred_type in product_type.ingredient_types.all():
-        choices = [
-            (i.id, str(i))
-            for i in (
-                Ingredient.objects.request_qs(request)
-                .filter(ingredient_type=ingred_type, finished=False)
-                .select_related('ingredient_type')
-            )
-        ]
-        ingreds.append({'choices': choices, 'unit': ingred_type.unit, 'name': ingred_type.name})
-    return JsonResponse(ingreds, safe=False)
+    if (recipe := get_recipe(request.user.company_id, pk)) is None:
+        raise Http404('Product type not found')
+    return JsonResponse(recipe, safe=False)
 
 
 class ProductAdd(AddModelView):
@@ -33,15 +25,23 @@ class ProductAdd(AddModelView):
     template_name = 'add_product_form.jinja'
 
     def form_valid(self, form):
-        obj = form.save(commit=False)
-        obj.status = Product.STATUS_INFUSED
-        obj.save()
-        for i in range(10):
-            if ingred := form.cleaned_data[f'ingredient_{i}']:
-                quantity = form.cleaned_data[f'ingredient_quantity_{i}']
-                ProductIngredient.objects.create(product=obj, ingredient=ingred, quantity=quantity)
-            else:
-                break
+        with transaction.atomic():
+            obj = form.save(commit=False)
+            obj.status = Product.STATUS_INFUSED
+            obj.save()
+            product_ingredients = []
+            for i in range(10):
+                if ingred := form.cleaned_data[f'ingredient_{i}']:
+                    quantity = form.cleaned_data[f'ingredient_quantity_{i}']
+                    product_ingredients.append(
+                        ProductIngredient(product=obj, ingredient=ingred, quantity=quantity, company_id=obj.company_id)
+                    )
+                else:
+                    break
+            # bulk_create doesn't send the signals that keep the stock ledger and traceability up to date.
+            product_ingredients = ProductIngredient.objects.bulk_create(product_ingredients)
+            record_usage(ProductIngredient, product_ingredients)
+            add_edges(ProductIngredient, product_ingredients)
         messages.success(self.request, 'New product added')
         return redirect(obj.get_absolute_url())
 
@@ -102,9 +102,9 @@ class YieldContainerAdd(AddModelView):
         return super().dispatch(request, *args, **kwargs)
 
     def form_valid(self, form):
-        obj = form.save(commit=False)
-        obj.product = self.product
-        obj.save()
+        # The form also records the cap against the product, so the product needs setting before it's saved.
+        form.instance.product = self.product
+        form.save()
         return redirect(self.product.get_absolute_url())
 
 
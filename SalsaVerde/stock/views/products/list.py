@@ -16,13 +16,16 @@ class ProductList(ModelListView):
     order_by = '-date_of_bottling'
     icon = 'fa-bottle-droplet'
     paginate_by = 50
+    keyset_pagination = True
+    cache_rows = True
+    stream_response = True
 
     def dispatch(self, request, *args, **kwargs):
         self.view_finished = bool(self.request.GET.get('finished'))
         return super().dispatch(request, *args, **kwargs)
 
     def get_queryset(self):
-        return super().get_queryset().select_related('product_type').filter(finished=self.view_finished)
+        return super().get_queryset().filter(finished=self.view_finished)
 
     def get_button_menu(self):
         yield {'name': 'Record new product infusion', 'url': reverse('products-add')}
@@ -31,6 +31,7 @@ class SupplierDetails(DetailView):
         'phone',
         'email',
     ]
+    stream_response = True
 
     def extra_display_items(self):
         return [
@@ -38,11 +39,13 @@ class SupplierDetails(DetailView):
                 'title': 'Supplied Raw Ingredients',
                 'qs': self.object.ingredients.all(),
                 'fields': [('Ingredient', 'name'), 'batch_code', 'quantity', 'intake_date'],
+                'list_url': reverse('ingredients') + f'?supplier={self.object.pk}&finished=all',
             },
             {
                 'title': 'Supplied Containers',
                 'qs': self.object.containers.all(),
                 'fields': [('Container', 'name'), 'batch_code', 'quantity', 'intake_date'],
+                'list_url': reverse('containers') + f'?supplier={self.object.pk}&finished=all',
             },
             {
                 'title': 'Associated Documents',
@@ -0,0 +1,176 @@
+import django_rq
+from django.http import Http404, JsonResponse
+from django.shortcuts import redirect
+from django.urls import reverse
+from django.utils.functional import cached_property
+from django.utils.html import format_html
+from django.views import View
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
+
+from SalsaVerde.common.views import BasicView, ExtraContentView
+from SalsaVerde.stock.models import TraceLink
+from SalsaVerde.stock.recall import recall_report
+from SalsaVerde.stock.trace import TRACE_MODELS, trace_ids
+
+# The panels of the trace page: the node type, title, icon, the related objects to select and the fields to show.
+TRACE_PANELS = [
+    (
+        TraceLink.NODE_INGREDIENT,
+        'Raw Ingredients',
+        'fa-seedling',
+        ['ingredient_type'],
+        [('Name', 'ingredient_type'), 'batch_code', 'supplier', 'intake_date', 'remaining_quantity'],
+    ),
+    (
+        TraceLink.NODE_CONTAINER,
+        'Packaging',
+        'fa-wine-bottle',
+        ['container_type'],
+        [('Name', 'container_type'), 'batch_code', 'supplier', 'intake_date', 'remaining_quantity'],
+    ),
+    (
+        TraceLink.NODE_PRODUCT,
+        'Products',
+        'fa-flask',
+        ['product_type'],
+        ['product_type', 'batch_code', 'date_of_infusion', ('Stage', 'get_status_display')],
+    ),
+    (
+        TraceLink.NODE_ORDER,
+        'Orders',
+        'fa-store',
+        [],
+        [('Order', 'func|order_name'), 'created', ('Customer', 'user'), ('Status', 'get_status_display')],
+    ),
+]
+
+
+class TraceMixin:
+    def dispatch(self, request, *args, **kwargs):
+        if not (model := TRACE_MODELS.get(kwargs['node_type'])):
+            raise Http404('Nothing to trace')
+        self.node_type = kwargs['node_type']
+        self.object = model.objects.request_qs(request).filter(pk=kwargs['pk']).first()
+        if not self.object:
+            raise Http404(f'{model._meta.verbose_name} not found')
+        return super().dispatch(request, *args, **kwargs)
+
+    @cached_property
+    def traced(self) -> dict[str, set[int]]:
+        return trace_ids(self.request.user.company_id, self.node_type, [self.object.pk])
+
+    def traced_qs(self, node_type):
+        return TRACE_MODELS[node_type].objects.request_qs(self.request).filter(pk__in=self.traced[node_type])
+
+
+class Trace(TraceMixin, ExtraContentView):
+    """
+    Everything the object was made from and everything it went into, for recalls and complaints.
+    """
+
+    def get_title(self):
+        return f'Trace of {self.object}'
+
+    def get_button_menu(self):
+        return [
+            {'name': 'Back', 'url': self.object.get_absolute_url(), 'icon': 'fa-arrow-left'},
+            {
+                'name': 'Download',
+                'url': reverse('trace-json', kwargs={'node_type': self.node_type, 'pk': self.object.pk}),
+                'icon': 'fa-download',
+                'newtab': True,
+            },
+            {
+                'name': 'Recall Report',
+                'url': reverse('recall-report', kwargs={'node_type': self.node_type, 'pk': self.object.pk}),
+                'method': 'POST',
+                'icon': 'fa-file-csv',
+                'group': 2,
+            },
+        ]
+
+    def order_name(self, obj):
+        return str(obj)
+
+    def extra_display_items(self):
+        return [
+            {
+                'title': title,
+                'qs': self.traced_qs(node_type).order_by('-pk'),
+                'fields': fields,
+                'icon': icon,
+                'show_all': True,
+            }
+            for node_type, title, icon, _, fields in TRACE_PANELS
+        ]
+
+    def get_context_data(self, **kwargs):
+        traced_from = format_html('<a href="{}">{}</a>', self.object.get_absolute_url(), self.object)
+        counts = [(title, len(self.traced[node_type])) for node_type, title, *_ in TRACE_PANELS]
+        return super().get_context_data(display_items=[('Traced from', traced_from), *counts], **kwargs)
+
+
+trace = Trace.as_view()
+
+
+class TraceJson(TraceMixin, View):
+    def get(self, request, *args, **kwargs):
+        return JsonResponse(
+            {
+                node_type: [
+                    {'id': obj.pk, 'name': str(obj), 'url': obj.get_absolute_url()}
+                    for obj in self.traced_qs(node_type).select_related(*select_related).order_by('pk')
+                ]
+                for node_type, _, _, select_related, _ in TRACE_PANELS
+            }
+        )
+
+
+trace_json = TraceJson.as_view()
+
+
+class RecallReport(TraceMixin, View):
+    http_method_names = ['post']
+
+    def post(self, request, *args, **kwargs):
+        job = recall_report.delay(
+            company_id=request.user.company_id, node_type=self.node_type, pk=self.object.pk, user_id=request.user.pk
+        )
+        return redirect('recall-report-progress', job_id=job.id)
+
+
+recall_report_start = RecallReport.as_view()
+
+
+def _get_report_job(request, job_id) -> Job:
+    try:
+        job = Job.fetch(job_id, connection=django_rq.get_connection())
+    except NoSuchJobError:
+        raise Http404('Report not found')
+    if job.func_name != f'{recall_report.__module__}.{recall_report.__name__}':
+        raise Http404('Report not found')
+    if job.kwargs['company_id'] != request.user.company_id:
+        raise Http404('Report not found')
+    return job
+
+
+class RecallReportProgress(BasicView):
+    template_name = 'job_progress.jinja'
+    title = 'Recall Report'
+
+    def get_context_data(self, **kwargs):
+        job = _get_report_job(self.request, kwargs['job_id'])
+        return super().get_context_data(status_url=reverse('recall-report-status', kwargs={'job_id': job.id}), **kwargs)
+
+
+recall_report_progress = RecallReportProgress.as_view()
+
+
+def recall_report_status(request, job_id):
+    job = _get_report_job(request, job_id)
+    status = job.get_status()
+    data = {'status': status, 'progress': job.meta.get('progress', 0)}
+    if status == 'finished':
+        data['url'] = reverse('documents-details', kwargs={'pk': job.return_value()})
+    return JsonResponse(data)
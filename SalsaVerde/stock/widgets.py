@@ -1,4 +1,5 @@
 from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.forms import DateTimeField, widgets
 
 DT_OUTER_PICKER_HTML = """\
@@ -26,3 +27,29 @@ class DateTimePicker(widgets.DateTimeInput):
 
     def render(self, name, value, attrs=None, renderer=None):
         return DT_OUTER_PICKER_HTML.format(super().render(name, value, attrs=attrs, renderer=renderer))
+
+
+class AutocompleteSelect(widgets.Select):
+    """
+    A select for a ModelChoiceField that only renders the selected option, the others are searched for from url (see
+    SalsaVerde.common.autocomplete).
+    """
+
+    def __init__(self, url, attrs=None):
+        super().__init__({**(attrs or {}), 'data-autocomplete-url': url})
+
+    def optgroups(self, name, value, attrs=None):
+        field = self.choices.field
+        selected = []
+        if pks := [v for v in value if v not in (None, '')]:
+            try:
+                selected = [self.choices.choice(obj) for obj in field.queryset.filter(pk__in=pks)]
+            except (ValueError, ValidationError):
+                # Not a valid pk, so nothing to show as selected.
+                pass
+        choices, self.choices = self.choices, ([('', field.empty_label)] if field.empty_label is not None else [])
+        self.choices += selected
+        try:
+            return super().optgroups(name, value, attrs)
+        finally:
+            self.choices = choices
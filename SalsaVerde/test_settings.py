@@ -1,5 +1,11 @@
 import os
+import tempfile
 
 os.environ['ASYNC_RQ'] = 'FALSE'
+# Jobs aren't scheduled when they run synchronously.
+os.environ['SHOPIFY_EVENT_DELAY'] = '0'
 
 from SalsaVerde.settings import *  # noqa: F401, F403
+
+# Files saved by the tests (shipping labels, recall reports) go somewhere they can't be committed.
+MEDIA_ROOT = tempfile.mkdtemp(prefix='salsaverde-media-')
@@ -2,12 +2,16 @@ from django.conf import settings
 from django.contrib.auth import views as auth_views
 from django.urls import include, path
 
+from SalsaVerde.common.autocomplete import autocomplete
+from SalsaVerde.common.search import search
 from SalsaVerde.common.views import dashboard, login
 
 urlpatterns = [
     path('', dashboard, name='index'),
     path('login/', login, name='login'),
-    path('logout/', auth_views.LogoutView.as_view(template_name='base.jinja'), name='logout'),
+    path('search/', search, name='search'),
+    path('autocomplete/<str:form>/<str:field>/', autocomplete, name='autocomplete'),
+    path('logout/', auth_views.LogoutView.as_view(next_page='login'), name='logout'),
     path('', include('SalsaVerde.company.urls')),
     path('orders/', include('SalsaVerde.orders.urls')),
     path('stock/', include('SalsaVerde.stock.urls')),
@@ -8,6 +8,8 @@ $(document).ready(() => {
   init_dt_pickers()
   init_input_groups()
   init_product_add_form()
+  init_global_search()
+  init_job_progress()
 
   const package_formsets = $('.formset-packages-sending')
   if (package_formsets.length > 0) {
@@ -59,6 +61,16 @@ function init_select2 () {
     const $el = $(el)
     const is_required = $("label[for='" + $el.attr('id') + "']").hasClass('required')
     let opts = {allowClear: !is_required, placeholder: is_required ? null : '---------', theme: 'bootstrap-5'}
+    const autocomplete_url = $el.data('autocomplete-url')
+    if (autocomplete_url) {
+      // Only the selected option is in the page, the others are searched for a page at a time.
+      opts.ajax = {
+        url: autocomplete_url,
+        dataType: 'json',
+        delay: 250,
+        data: params => ({q: params.term || '', page: params.page || 1}),
+      }
+    }
     $el.select2(opts)
   })
 }
@@ -238,3 +250,77 @@ function init_product_add_form() {
   })
   $product_type.change()
 }
+
+function init_global_search () {
+  const $form = $('#global-search')
+  const $input = $form.find('input')
+  const $results = $form.find('.dropdown-menu')
+  let timeout = null
+  let request = null
+
+  $input.on('input', () => {
+    clearTimeout(timeout)
+    timeout = setTimeout(() => {
+      const q = $input.val().trim()
+      if (request) {
+        request.abort()
+      }
+      if (q.length < 2) {
+        $results.removeClass('show').empty()
+        return
+      }
+      request = $.getJSON($form.attr('action'), {q: q}, data => {
+        $results.empty()
+        $.each(data['results'], (i, result) => {
+          const $a = $('<a></a>').attr('class', 'dropdown-item').attr('href', result['url']).text(result['title'])
+          $('<small></small>').attr('class', 'text-muted d-block').text(result['type']).appendTo($a)
+          $a.appendTo($results)
+        })
+        if (data['results'].length === 0) {
+          $('<span></span>').attr('class', 'dropdown-item-text text-muted').text('No results').appendTo($results)
+        }
+        $results.addClass('show')
+      })
+    }, 200)
+  })
+
+  $form.submit(e => {
+    // Go straight to the best match rather than to the JSON
+    e.preventDefault()
+    const $first = $results.find('a.dropdown-item').first()
+    if ($first.length) {
+      document.location.href = $first.attr('href')
+    }
+  })
+
+  $(document).click(e => {
+    if (!$form.is(e.target) && $form.has(e.target).length === 0) {
+      $results.removeClass('show')
+    }
+  })
+}
+
+function init_job_progress () {
+  const $el = $('#job-progress')
+  if (!$el.length) {
+    return
+  }
+  const $bar = $el.find('.progress-bar')
+  const $message = $el.find('.job-message')
+
+  const poll = () => {
+    $.getJSON($el.data('status-url'), data => {
+      $bar.css('width', `${data['progress']}%`).text(`${data['progress']}%`)
+      if (data['status'] === 'finished') {
+        $bar.removeClass('progress-bar-animated')
+        $message.empty().append($('<a></a>').attr('href', data['url']).text('View the report'))
+      } else if (data['status'] === 'failed') {
+        $bar.removeClass('progress-bar-animated').addClass('bg-danger')
+        $message.text('Sorry, the report could not be created.')
+      } else {
+        setTimeout(poll, 1000)
+      }
+    })
+  }
+  poll()
+}